@@ -0,0 +1,110 @@
+"""
+Benchmark couplings which write in place against couplings alternating with Roll.
+
+Older versions of rolling_spline_coupling alternated NeuralSplineCoupling with Roll,
+which copies the whole input in each Roll, in the split of each coupling, and when the
+output of each coupling is assembled. The couplings now transform a static set of
+dimensions and write the result in place. Both chains use the same variables.
+
+Reported is the minimum time of the compiled log-likelihood, sampling, and training
+step (value and gradient of the mean negative log-likelihood), and the temporary
+memory of the compiled log-likelihood from the memory analysis of the compiler.
+
+Usage: python bench/bench_coupling.py [--dims D1 D2 ...] [--size N] [--layers W ...]
+"""
+
+import argparse
+import time
+
+import jax
+import jax.numpy as jnp
+import numpy as np
+
+from zenflow import Flow
+from zenflow.bijectors import (
+    Chain,
+    NeuralSplineCoupling,
+    Roll,
+    ShiftBounds,
+    rolling_spline_coupling,
+)
+from zenflow.distributions import Beta
+
+
+def rolled_chain(dim, layers):
+    """Return chain with Roll in between couplings, as in older versions."""
+    bijectors = [ShiftBounds()]
+    for _ in range(dim - 1):
+        bijectors += [NeuralSplineCoupling(layers=layers), Roll()]
+    bijectors.append(NeuralSplineCoupling(layers=layers))
+    return Chain(bijectors)
+
+
+def best_time(fn, args, repeat):
+    """Return minimum run time of compiled fn after a warm-up."""
+    fn = jax.jit(fn).lower(*args).compile()
+    jax.block_until_ready(fn(*args))
+    times = []
+    for _ in range(repeat):
+        t = time.perf_counter()
+        jax.block_until_ready(fn(*args))
+        times.append(time.perf_counter() - t)
+    return min(times)
+
+
+def main():
+    """Run benchmark."""
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--dims", type=int, nargs="+", default=[4, 16, 32])
+    parser.add_argument("--size", type=int, default=4096)
+    parser.add_argument("--layers", type=int, nargs="*", default=[32])
+    parser.add_argument("--repeat", type=int, default=10)
+    args = parser.parse_args()
+    layers = tuple(args.layers)
+
+    print("   D  chain      log_prob [ms]  sample [ms]  train step [ms]  temp [MiB]")
+    rng = np.random.default_rng(1)
+    for dim in args.dims:
+        x = rng.normal(size=(args.size, dim)).astype(np.float32)
+        c = rng.normal(size=(args.size, 2)).astype(np.float32)
+        variables = None
+        for name, bijector in (
+            ("Roll", rolled_chain(dim, layers)),
+            ("in place", rolling_spline_coupling(dim, layers=layers)),
+        ):
+            flow = Flow(bijector, Beta())
+            if variables is None:
+                variables = flow.init(jax.random.PRNGKey(0), x[:1], c[:1])
+                _, updates = flow.apply(
+                    variables, x, c, train=True, mutable=["batch_stats"]
+                )
+                variables = {**variables, **updates}
+            else:
+                flow.init(jax.random.PRNGKey(0), x[:1], c[:1])
+
+            def log_prob(v, x, c):
+                return flow.apply(v, x, c)
+
+            def sample(v, c):
+                return flow.apply(v, c, method="sample")
+
+            def loss(params, x, c):
+                v = {**variables, "params": params}
+                return -jnp.mean(flow.apply(v, x, c))
+
+            step = jax.value_and_grad(loss)
+            memory = (
+                jax.jit(log_prob).lower(variables, x, c).compile().memory_analysis()
+            )
+            t_log_prob = best_time(log_prob, (variables, x, c), args.repeat)
+            t_sample = best_time(sample, (variables, c), args.repeat)
+            t_step = best_time(step, (variables["params"], x, c), args.repeat)
+            print(
+                f"{dim:4d}  {name:9s}  {t_log_prob * 1e3:13.2f}"
+                f"  {t_sample * 1e3:11.2f}  {t_step * 1e3:15.2f}"
+                f"  {memory.temp_size_in_bytes / 2**20:10.1f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+"""
+Benchmark the import time of zenflow modules.
+
+Each module is imported in a fresh Python process with python -X importtime. The
+cumulative import time of the module is reported, which includes the time of all
+modules it imports, together with the heavy dependencies that were loaded. The time
+is the minimum over several runs.
+
+Usage: python bench/bench_import.py [--repeat R] [module ...]
+"""
+
+import argparse
+import re
+import subprocess
+import sys
+
+MODULES = [
+    "zenflow",
+    "zenflow.numpy_flow",
+    "zenflow.utils",
+    "zenflow.distributions",
+    "zenflow.bijectors",
+    "zenflow.flow",
+    "zenflow.train",
+]
+
+HEAVY = ["jax", "flax", "flax.linen", "optax", "rich", "tqdm"]
+
+
+def measure(module):
+    """Return cumulative import time in seconds and loaded heavy dependencies."""
+    code = f"import {module}; import sys; print(sorted(sys.modules))"
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    loaded = set(eval(result.stdout.strip().splitlines()[-1]))
+    cumulative = 0
+    for line in result.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package, nested imports are
+        # indented; zenflow and its submodules are imported at the top level
+        m = re.match(r"import time:\s*\d+ \|\s*(\d+) \| (\S+)", line)
+        if m and m.group(2).split(".")[0] == "zenflow":
+            cumulative += int(m.group(1))
+    return cumulative * 1e-6, [name for name in HEAVY if name in loaded]
+
+
+def main():
+    """Run benchmark."""
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("modules", nargs="*", default=MODULES)
+    args = parser.parse_args()
+
+    for module in args.modules:
+        runs = [measure(module) for _ in range(args.repeat)]
+        t = min(r[0] for r in runs)
+        heavy = ", ".join(runs[0][1]) or "-"
+        print(f"{module:24} {t * 1e3:8.0f} ms   {heavy}")
+
+
+if __name__ == "__main__":
+    main()
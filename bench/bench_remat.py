@@ -0,0 +1,76 @@
+"""
+Benchmark memory and time of a training step with and without rematerialization.
+
+The temporary memory of the compiled training step is taken from the memory analysis
+of the compiler, which is the peak memory needed for intermediate results beyond the
+inputs and outputs. The step time is the minimum over several runs.
+
+With remat, the couplings are run by RollingSplineCoupling in a scan over segments,
+which saves memory also on the CPU backend.
+
+Usage: python bench/bench_remat.py [--dim D] [--batch-size B] [--repeat R]
+"""
+
+import argparse
+import math
+import time
+from functools import partial
+
+import jax
+import numpy as np
+import optax
+
+from zenflow import Flow
+from zenflow.bijectors import rolling_spline_coupling
+from zenflow.train import _update
+
+
+def measure(dim, batch_size, repeat, remat, policy):
+    """Return temporary memory in bytes and time per step in seconds."""
+    flow = Flow(rolling_spline_coupling(dim, remat=remat, remat_policy=policy))
+    rng = np.random.default_rng(1)
+    x = rng.normal(size=(batch_size, dim)).astype(np.float32)
+    mask = np.ones(batch_size, dtype=bool)
+    variables = flow.init(jax.random.PRNGKey(0), x[:1])
+    optimizer = optax.adam(1e-3)
+    args = (
+        variables["params"],
+        variables["batch_stats"],
+        optimizer.init(variables["params"]),
+        x,
+        None,
+        mask,
+    )
+    step = jax.jit(partial(_update, flow, optimizer)).lower(*args).compile()
+    memory = step.memory_analysis().temp_size_in_bytes
+    jax.block_until_ready(step(*args))
+    times = []
+    for _ in range(repeat):
+        t = time.perf_counter()
+        jax.block_until_ready(step(*args))
+        times.append(time.perf_counter() - t)
+    return memory, min(times)
+
+
+def main():
+    """Run benchmark."""
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--dim", type=int, default=16)
+    parser.add_argument("--batch-size", type=int, default=4096)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    sqrt_n = round(math.sqrt(args.dim))
+    configs = [
+        ("off", False, None),
+        ("every coupling", True, None),
+        ("every coupling, save dots", True, jax.checkpoint_policies.dots_saveable),
+        (f"segments of {sqrt_n}", sqrt_n, None),
+    ]
+    for label, remat, policy in configs:
+        memory, t = measure(args.dim, args.batch_size, args.repeat, remat, policy)
+        print(f"{label:28} {memory / 2**20:10.1f} MiB {t * 1e3:10.1f} ms/step")
+
+
+if __name__ == "__main__":
+    main()
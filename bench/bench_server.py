@@ -0,0 +1,99 @@
+"""
+Benchmark latency and throughput of concurrent log_prob requests.
+
+Client threads send requests of a fixed size as fast as they can, each waiting for
+the result before sending the next. This is repeated with the clients calling the
+Predictor directly, with the InferenceServer in the same process, and with the
+InferenceServer over HTTP. The latencies are the wall times of single requests.
+
+Usage: python bench/bench_server.py [--clients N] [--request-size R] [--seconds S]
+"""
+
+import argparse
+import json
+import threading
+import time
+import urllib.request
+
+import jax
+import numpy as np
+
+from zenflow import Flow
+from zenflow.bijectors import rolling_spline_coupling
+from zenflow.server import InferenceServer, serve_http
+
+
+def run(call, clients, seconds):
+    """Return latencies in seconds of all requests and the elapsed time."""
+    latencies = [[] for _ in range(clients)]
+    stop = time.perf_counter() + seconds
+
+    def client(i):
+        while time.perf_counter() < stop:
+            t = time.perf_counter()
+            call(i)
+            latencies[i].append(time.perf_counter() - t)
+
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(clients)]
+    t = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return np.concatenate(latencies), time.perf_counter() - t
+
+
+def main():
+    """Run benchmark."""
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--dim", type=int, default=4)
+    parser.add_argument("--clients", type=int, default=16)
+    parser.add_argument("--request-size", type=int, default=8)
+    parser.add_argument("--seconds", type=float, default=5)
+    parser.add_argument("--max-delay", type=float, default=0.002)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(1)
+    x = rng.normal(size=(1000, args.dim)).astype(np.float32)
+    flow = Flow(rolling_spline_coupling(args.dim))
+    variables = flow.init(jax.random.PRNGKey(0), x)
+    predictor = flow.compile(variables, min_bucket=args.request_size)
+    xi = x[: args.request_size]
+    body = json.dumps({"x": xi.tolist()}).encode()
+
+    def direct(i):
+        np.asarray(predictor.log_prob(xi))
+
+    server = InferenceServer(
+        predictor,
+        max_batch_size=args.clients * args.request_size,
+        max_delay=args.max_delay,
+    )
+    httpd = serve_http(server)
+    url = "http://%s:%d/log_prob" % httpd.server_address
+
+    def http(i):
+        request = urllib.request.Request(url, data=body)
+        with urllib.request.urlopen(request) as response:
+            response.read()
+
+    configs = [
+        ("predictor", direct),
+        ("server", lambda i: server.log_prob(xi)),
+        ("server over http", http),
+    ]
+    for label, call in configs:
+        # warm up compiled programs for all batch sizes
+        run(call, args.clients, 1)
+        latencies, elapsed = run(call, args.clients, args.seconds)
+        p50, p99 = np.percentile(latencies, [50, 99]) * 1e3
+        rate = len(latencies) * args.request_size / elapsed
+        print(
+            f"{label:18} p50 {p50:8.2f} ms  p99 {p99:8.2f} ms  {rate:10.0f} samples/s"
+        )
+    httpd.shutdown()
+    server.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+"""
+Benchmark trace, compile, and run time of ShiftBounds for many dimensions.
+
+A third of the columns has a lower bound, a third an upper bound, and the rest is
+unbounded. Reported are the time to trace and lower the function, the time to compile
+it, and the minimum run time of the compiled function, for the forward transform in
+training mode, which updates the statistics, and for the inverse.
+
+Usage: python bench/bench_shift_bounds.py [--dims D1 D2 ...] [--size N] [--repeat R]
+"""
+
+import argparse
+import time
+
+import jax
+import numpy as np
+
+from zenflow.bijectors import ShiftBounds
+
+
+def measure(fn, args, repeat):
+    """Return trace, compile and run time of fn in seconds."""
+    t = time.perf_counter()
+    lowered = jax.jit(fn).lower(*args)
+    t_trace = time.perf_counter() - t
+    t = time.perf_counter()
+    compiled = lowered.compile()
+    t_compile = time.perf_counter() - t
+    jax.block_until_ready(compiled(*args))
+    times = []
+    for _ in range(repeat):
+        t = time.perf_counter()
+        jax.block_until_ready(compiled(*args))
+        times.append(time.perf_counter() - t)
+    return t_trace, t_compile, min(times)
+
+
+def main():
+    """Run benchmark."""
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--dims", type=int, nargs="+", default=[100, 300, 1000])
+    parser.add_argument("--size", type=int, default=10000)
+    parser.add_argument("--repeat", type=int, default=10)
+    args = parser.parse_args()
+
+    print("    D  method    trace [s]  compile [s]  run [ms]")
+    for dim in args.dims:
+        bounds = [(i, 0.0, None) for i in range(0, dim, 3)]
+        bounds += [(i, None, 0.0) for i in range(1, dim, 3)]
+        sb = ShiftBounds(bounds=bounds)
+        rng = np.random.default_rng(1)
+        x = rng.exponential(size=(args.size, dim)).astype(np.float32)
+        x[:, 1::3] *= -1
+        x[:, 2::3] -= 0.5
+        variables = sb.init(jax.random.PRNGKey(0), x[:1])
+        _, variables = sb.apply(variables, x, train=True, mutable=["batch_stats"])
+
+        def forward(v, x):
+            return sb.apply(v, x, train=True, mutable=["batch_stats"])
+
+        def inverse(v, z):
+            return sb.apply(v, z, method="inverse_and_log_det")
+
+        z = np.asarray(sb.apply(variables, x)[0])
+        for name, fn, a in (("forward", forward, x), ("inverse", inverse, z)):
+            t_trace, t_compile, t_run = measure(fn, (variables, a), args.repeat)
+            print(
+                f"{dim:5d}  {name:8s}  {t_trace:9.3f}  {t_compile:11.3f}"
+                f"  {t_run * 1e3:8.2f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
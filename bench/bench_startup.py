@@ -0,0 +1,103 @@
+"""
+Benchmark the time to the first log_prob and sample result in a cold process.
+
+A deep rolling_spline_coupling flow is evaluated in fresh Python processes in three
+ways:
+
+- jit: the flow is traced and compiled from scratch
+- cache: same as jit, but with a warm persistent compilation cache
+- aot: the executables are loaded with AotFlow.load, nothing is traced or compiled
+
+The reported time includes the Python and package import.
+
+Usage: python bench/bench_startup.py [--dim D] [--size N]
+"""
+
+import argparse
+import os
+import pickle
+import subprocess
+import sys
+import tempfile
+import time
+
+CHILD = """
+import pickle, sys
+import numpy as np
+mode, dim, size, tmp = sys.argv[1], int(sys.argv[2]), int(sys.argv[3]), sys.argv[4]
+x = np.random.default_rng(1).normal(size=(size, dim)).astype(np.float32)
+if mode == "aot":
+    from zenflow.aot import AotFlow
+
+    flow = AotFlow.load(f"{tmp}/flow.aot")
+    flow.log_prob(x).block_until_ready()
+    flow.sample(seed=1).block_until_ready()
+else:
+    import jax
+    from zenflow import Flow
+    from zenflow.bijectors import rolling_spline_coupling
+
+    if mode == "cache":
+        from zenflow.aot import enable_compilation_cache
+
+        enable_compilation_cache(f"{tmp}/cache")
+    with open(f"{tmp}/variables.pkl", "rb") as f:
+        variables = pickle.load(f)
+    flow = Flow(rolling_spline_coupling(dim))
+    jax.jit(flow.apply)(variables, x).block_until_ready()
+    sample = jax.jit(lambda v, seed: flow.apply(v, size, seed=seed, method="sample"))
+    sample(variables, 1).block_until_ready()
+"""
+
+
+def prepare(tmp, dim, size):
+    """Create trained-like variables and the AOT file."""
+    import jax
+    import numpy as np
+
+    from zenflow import Flow
+    from zenflow.aot import AotFlow
+    from zenflow.bijectors import rolling_spline_coupling
+
+    x = np.random.default_rng(1).normal(size=(size, dim)).astype(np.float32)
+    flow = Flow(rolling_spline_coupling(dim))
+    variables = flow.init(jax.random.PRNGKey(0), x)
+    _, updates = flow.apply(variables, x, train=True, mutable=["batch_stats"])
+    variables = jax.device_get({"params": variables["params"], **updates})
+    with open(f"{tmp}/variables.pkl", "wb") as f:
+        pickle.dump(variables, f)
+    AotFlow.compile(flow, variables, x.shape, sample_size=size).save(f"{tmp}/flow.aot")
+
+
+def run(mode, dim, size, tmp):
+    """Return wall time of a child process."""
+    t = time.perf_counter()
+    subprocess.run(
+        [sys.executable, "-c", CHILD, mode, str(dim), str(size), tmp],
+        check=True,
+        env=dict(os.environ, PYTHONWARNINGS="ignore"),
+    )
+    return time.perf_counter() - t
+
+
+def main():
+    """Run benchmark."""
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--dim", type=int, default=8)
+    parser.add_argument("--size", type=int, default=1000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        prepare(tmp, args.dim, args.size)
+        t_jit = run("jit", args.dim, args.size, tmp)
+        run("cache", args.dim, args.size, tmp)  # fill cache
+        t_cache = run("cache", args.dim, args.size, tmp)
+        t_aot = run("aot", args.dim, args.size, tmp)
+
+    print(f"jit   {t_jit:6.2f} s")
+    print(f"cache {t_cache:6.2f} s")
+    print(f"aot   {t_aot:6.2f} s")
+
+
+if __name__ == "__main__":
+    main()
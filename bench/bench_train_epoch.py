@@ -0,0 +1,73 @@
+"""
+Benchmark epochs per second of train() with and without fused_epoch.
+
+The workload uses a small two-dimensional flow and many small batches per epoch,
+where Python dispatch overhead per batch dominates. Compilation time is subtracted
+by timing two runs with different numbers of epochs, each repeated a few times.
+A temporary persistent compilation cache is used to make the repeated compilation
+in each train() call cheap and reduce the noise of the measurement.
+
+Usage: python bench/bench_train_epoch.py [--size N] [--batch-size B] [--epochs E]
+"""
+
+import argparse
+import tempfile
+import time
+
+import jax
+import numpy as np
+
+from zenflow import Flow, train
+from zenflow.bijectors import rolling_spline_coupling
+
+
+def run(flow, X_train, X_test, epochs, batch_size, fused_epoch):
+    """Return wall time of a train() call."""
+    t = time.perf_counter()
+    train(
+        flow,
+        X_train,
+        X_test,
+        epochs=epochs,
+        batch_size=batch_size,
+        patience=epochs,
+        warmup=epochs,
+        progress=False,
+        fused_epoch=fused_epoch,
+    )
+    return time.perf_counter() - t
+
+
+def main():
+    """Run benchmark."""
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size", type=int, default=4096)
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--epochs", type=int, default=10)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    cache_dir = tempfile.mkdtemp()
+    jax.config.update("jax_compilation_cache_dir", cache_dir)
+    jax.config.update("jax_persistent_cache_min_compile_time_secs", 0)
+
+    rng = np.random.default_rng(1)
+    X = rng.normal(size=(args.size, 2))
+    X_test = rng.normal(size=(args.size // 10, 2))
+    flow = Flow(rolling_spline_coupling(2, layers=(32, 32)))
+
+    for fused_epoch in (False, True):
+        t1 = min(
+            run(flow, X, X_test, 1, args.batch_size, fused_epoch)
+            for _ in range(args.repeat)
+        )
+        t2 = min(
+            run(flow, X, X_test, 1 + args.epochs, args.batch_size, fused_epoch)
+            for _ in range(args.repeat)
+        )
+        rate = args.epochs / (t2 - t1)
+        print(f"fused_epoch={fused_epoch!s:5} {rate:8.2f} epochs/s")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,46 @@
 """Import modules and set version."""
 
-from .flow import Flow
-from .train import train
+from importlib import import_module
+from typing import TYPE_CHECKING, Any, List
+import sys
+import types
 
-__all__ = "Flow", "train"
+if TYPE_CHECKING:
+    from .flow import Flow, ensemble_log_prob
+    from .train import train, train_ensemble
+
+__all__ = "Flow", "ensemble_log_prob", "train", "train_ensemble"
+
+# the public names are imported on first access, so that modules which do not need
+# JAX, like zenflow.numpy_flow, can be imported without it
+_LAZY = {
+    "Flow": ".flow",
+    "ensemble_log_prob": ".flow",
+    "train": ".train",
+    "train_ensemble": ".train",
+}
+
+
+def __getattr__(name: str) -> Any:
+    module = _LAZY.get(name)
+    if module is None:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = getattr(import_module(module, __name__), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__() -> List[str]:
+    return sorted(set(globals()) | set(_LAZY))
+
+
+class _Package(types.ModuleType):
+    # importing the submodule zenflow.train sets the attribute train of the package,
+    # which must remain the function of the same name
+    def __setattr__(self, name: str, value: Any) -> None:
+        if name == "train" and isinstance(value, types.ModuleType):
+            return
+        super().__setattr__(name, value)
+
+
+sys.modules[__name__].__class__ = _Package
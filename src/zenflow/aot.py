@@ -0,0 +1,212 @@
+"""Ahead-of-time compilation of trained flows and persistent compilation cache."""
+
+from typing import Any, Dict, Optional, Tuple
+import os
+import pickle
+
+import jax
+import jax.numpy as jnp
+import numpy as np
+from flax.typing import Array, ArrayPytree
+from jax.experimental import serialize_executable
+
+from .flow import Flow
+
+__all__ = ["enable_compilation_cache", "AotFlow"]
+
+_FORMAT_VERSION = 1
+
+
+def enable_compilation_cache(
+    path: Optional[str] = None, min_compile_time: float = 0.0
+) -> str:
+    """
+    Enable the persistent on-disk compilation cache of JAX.
+
+    Executables compiled by JAX, for example when calling a jitted flow.apply, are
+    written to the cache directory and loaded from there by later processes which
+    compile the same program. This removes most of the compilation time from the
+    startup of short-lived processes. Call this once at startup, before the first
+    computation.
+
+    Parameters
+    ----------
+    path : str or None, optional (default = None)
+        Cache directory. If None, the environment variable ZENFLOW_CACHE_DIR is used if
+        set, otherwise ~/.cache/zenflow/xla.
+    min_compile_time : float, optional (default = 0)
+        Only programs which take longer than this many seconds to compile are cached.
+
+    Returns
+    -------
+    str
+        The cache directory.
+
+    """
+    if path is None:
+        path = os.environ.get(
+            "ZENFLOW_CACHE_DIR",
+            os.path.join(os.path.expanduser("~"), ".cache", "zenflow", "xla"),
+        )
+    os.makedirs(path, exist_ok=True)
+    jax.config.update("jax_compilation_cache_dir", path)
+    jax.config.update("jax_persistent_cache_min_compile_time_secs", min_compile_time)
+    return path
+
+
+class AotFlow:
+    """
+    Trained flow with log_prob and sample compiled ahead-of-time.
+
+    The programs are lowered and compiled for declared input shapes. The compiled
+    executables can be saved to a file together with the variables and loaded in
+    another process, which then neither traces nor compiles the flow. Executables
+    are specific to the JAX version and the platform, they have to be recompiled
+    after an update.
+
+    Use AotFlow.compile to create an instance and AotFlow.load to load a saved one.
+    """
+
+    def __init__(
+        self,
+        variables: ArrayPytree,
+        executables: Dict[str, Any],
+        shapes: Dict[str, Any],
+    ):
+        self.variables = variables
+        self._executables = executables
+        self.shapes = shapes
+
+    @classmethod
+    def compile(
+        cls,
+        flow: Flow,
+        variables: ArrayPytree,
+        x_shape: Optional[Tuple[int, int]] = None,
+        c_shape: Optional[Tuple[int, ...]] = None,
+        sample_size: Optional[int] = None,
+        dtype: Any = jnp.float32,
+    ) -> "AotFlow":
+        """
+        Compile log_prob and sample for the declared shapes.
+
+        Parameters
+        ----------
+        flow : Flow
+            The flow.
+        variables : variables
+            Trained variables of the flow.
+        x_shape : (int, int) or None, optional (default = None)
+            Shape (N, D) of the input of log_prob. If None, log_prob is not compiled.
+        c_shape : tuple of int or None, optional (default = None)
+            Shape of the conditional variables. Its first dimension must be N if log_prob
+            is compiled. For conditional flows, sample is compiled for these conditions.
+        sample_size : int or None, optional (default = None)
+            Number of samples drawn by sample for unconditional flows. If None and
+            c_shape is None, sample is not compiled.
+        dtype : dtype, optional (default = float32)
+            Data type of the inputs.
+
+        """
+        executables = {}
+        shapes: Dict[str, Any] = {"x": x_shape, "c": c_shape, "sample": sample_size}
+        c_spec = None if c_shape is None else jax.ShapeDtypeStruct(c_shape, dtype)
+
+        if x_shape is not None:
+            x_spec = jax.ShapeDtypeStruct(x_shape, dtype)
+
+            def log_prob(variables, x, c):
+                return flow.apply(variables, x, c)
+
+            executables["log_prob"] = (
+                jax.jit(log_prob).lower(variables, x_spec, c_spec).compile()
+            )
+
+        seed_spec = jax.ShapeDtypeStruct((), jnp.uint32)
+        if c_shape is not None:
+
+            def sample_c(variables, c, seed):
+                return flow.apply(variables, c, seed=seed, method="sample")
+
+            executables["sample"] = (
+                jax.jit(sample_c).lower(variables, c_spec, seed_spec).compile()
+            )
+        elif sample_size is not None:
+
+            def sample(variables, seed):
+                return flow.apply(variables, sample_size, seed=seed, method="sample")
+
+            executables["sample"] = (
+                jax.jit(sample).lower(variables, seed_spec).compile()
+            )
+
+        return cls(variables, executables, shapes)
+
+    def log_prob(self, x: Array, c: Optional[Array] = None) -> Array:
+        """Return log-likelihood of the samples, see Flow.__call__."""
+        return self._call("log_prob", self.variables, x, c)
+
+    def sample(self, c: Optional[Array] = None, *, seed: int = 0) -> Array:
+        """
+        Return samples, see Flow.sample.
+
+        For conditional flows, c must have the declared shape. For unconditional
+        flows, c must be None and the declared number of samples is returned.
+        """
+        seed = np.uint32(seed)
+        if c is None:
+            return self._call("sample", self.variables, seed)
+        return self._call("sample", self.variables, c, seed)
+
+    def _call(self, name: str, *args):
+        try:
+            fn = self._executables[name]
+        except KeyError:
+            msg = f"{name} was not compiled"
+            raise ValueError(msg) from None
+        return fn(*args)
+
+    def save(self, path: str):
+        """Save variables and compiled executables to a file."""
+        data = {
+            "version": _FORMAT_VERSION,
+            "jax": jax.__version__,
+            "platform": jax.default_backend(),
+            "shapes": self.shapes,
+            "variables": jax.device_get(self.variables),
+            "executables": {
+                name: serialize_executable.serialize(fn)
+                for name, fn in self._executables.items()
+            },
+        }
+        with open(path, "wb") as f:
+            pickle.dump(data, f)
+
+    @classmethod
+    def load(cls, path: str) -> "AotFlow":
+        """
+        Load variables and compiled executables from a file.
+
+        Only load files from trusted sources, the file is unpickled.
+        """
+        with open(path, "rb") as f:
+            data = pickle.load(f)
+        if data["version"] != _FORMAT_VERSION:
+            msg = f"unsupported file format version {data['version']}"
+            raise ValueError(msg)
+        for key, value in (
+            ("jax", jax.__version__),
+            ("platform", jax.default_backend()),
+        ):
+            if data[key] != value:
+                msg = (
+                    f"file was compiled for {key} {data[key]}, but this is {value}; "
+                    "compile the flow again"
+                )
+                raise ValueError(msg)
+        executables = {
+            name: serialize_executable.deserialize_and_load(*args)
+            for name, args in data["executables"].items()
+        }
+        variables = jax.device_put(data["variables"])
+        return cls(variables, executables, data["shapes"])
@@ -1,16 +1,22 @@
 """Bijectors used in conditional normalizing flows."""
 
-from typing import Tuple, Sequence, Callable, Union, Optional, Dict
+from typing import Tuple, Sequence, Callable, Union, Optional, Dict, Any, List
+from typing import Mapping
 from typing_extensions import TypeGuard  # required for Python-3.9
 from abc import ABC, abstractmethod
-from jax import numpy as jnp
+from functools import partial
+import inspect
+import jax
+from jax import lax, numpy as jnp
 from .utils import (
     normalize_spline_params,
     rational_quadratic_spline_forward,
     rational_quadratic_spline_inverse,
+    rational_quadratic_spline_inverse_and_log_det,
 )
 from flax import linen as nn
-from flax.typing import Array
+from flax.linen.dtypes import promote_dtype
+from flax.typing import Array, ArrayPytree
 import numpy as np
 
 
@@ -19,9 +25,13 @@ __all__ = [
     "ShiftBounds",
     "Roll",
     "NeuralSplineCoupling",
+    "RollingSplineCoupling",
+    "ElementwiseSpline",
     "Chain",
     "chain",
     "rolling_spline_coupling",
+    "elementwise_spline",
+    "migrate_variables",
 ]
 
 
@@ -32,6 +42,12 @@ class Bijector(nn.Module, ABC):
     A bijector is a basic element that defines the normalizing flow. The bijector is
     learned during training to transform a simple base distribution to the target
     distribution.
+
+    The conditional variables c may have fewer rows than the samples x, if the number
+    of samples N is a multiple of the number of rows M. Row i of c then applies to
+    the N / M consecutive samples starting at i * N / M. This allows one to draw many
+    samples per condition without repeating the conditions in memory. Bijectors which
+    do not use c ignore this; bijectors which use c must support it.
     """
 
     @abstractmethod
@@ -60,6 +76,14 @@ class Bijector(nn.Module, ABC):
         log_det : Array of shape (N,)
             Logarithm of the determinant of the transformation.
 
+        Notes
+        -----
+        Bijectors which accumulate statistics over the batch in training mode may
+        accept an additional keyword argument mask, an Array of shape (N,). Samples
+        where the mask is False are excluded from the statistics. This is used to pad
+        batches to a fixed size. Chain and Flow pass the mask only to bijectors whose
+        __call__ method accepts it.
+
         """
         raise NotImplementedError
 
@@ -86,6 +110,36 @@ class Bijector(nn.Module, ABC):
         """
         raise NotImplementedError
 
+    def inverse_and_log_det(self, x: Array, c: Array = None) -> Tuple[Array, Array]:
+        """
+        Transform samples from the base distribution and return log-determinant.
+
+        The log-determinant is that of the forward transform at the result, so that
+        the log-likelihood of the result is the log-likelihood of x under the base
+        distribution plus the log-determinant. This default implementation calls the
+        forward transform on the result of the inverse transform. Bijectors override
+        it to compute the log-determinant in the inverse pass.
+
+        Parameters
+        ----------
+        x : Array of shape (N, D)
+            N samples from the D-dimensional base distribution.
+        c : Array of shape (N, K) or None, optional (default is None)
+            N values from a K-dimensional vector of variables which determines the shape
+            of the D-dimensional target distribution.
+
+        Returns
+        -------
+        y : Array of shape (N, D)
+            N samples of the target distribution.
+        log_det : Array of shape (N,)
+            Logarithm of the determinant of the forward transformation at y.
+
+        """
+        y = self.inverse(x, c)
+        _, log_det = self(y, c, False)
+        return y, log_det
+
 
 class Chain(Bijector, Sequence):
     """
@@ -100,13 +154,17 @@ class Chain(Bijector, Sequence):
 
     bijectors: Sequence[Bijector]
 
+    # bijectors which were given a name keep it, otherwise they are named bijectors_i
+    # after their index i, see rolling_spline_coupling
+    preserve_adopted_names = True
+
     @nn.compact
     def __call__(
-        self, x: Array, c: Array = None, train: bool = False
+        self, x: Array, c: Array = None, train: bool = False, *, mask: Array = None
     ) -> Tuple[Array, Array]:
         log_det = jnp.zeros(x.shape[0])
         for bijector in self.bijectors:
-            x, ld = bijector(x, c, train)
+            x, ld = bijector(x, c, train, **_mask_kwargs(bijector, mask))
             log_det += ld
         return x, log_det
 
@@ -115,6 +173,13 @@ class Chain(Bijector, Sequence):
             x = bijector.inverse(x, c)
         return x
 
+    def inverse_and_log_det(self, x: Array, c: Array = None) -> Tuple[Array, Array]:
+        log_det = jnp.zeros(x.shape[0])
+        for bijector in self.bijectors[::-1]:
+            x, ld = bijector.inverse_and_log_det(x, c)
+            log_det += ld
+        return x, log_det
+
     def __getitem__(self, idx: Union[int, slice]):
         """Get bijector at location idx."""
         return self.bijectors[idx]
@@ -124,6 +189,18 @@ class Chain(Bijector, Sequence):
         return len(self.bijectors)
 
 
+def _accepts(module: nn.Module, name: str) -> bool:
+    # whether the __call__ method of module has a parameter with this name
+    return name in inspect.signature(type(module).__call__).parameters
+
+
+def _mask_kwargs(bijector: nn.Module, mask: Optional[Array]) -> Dict[str, Array]:
+    # only pass mask if set and supported, so that bijectors without it still work
+    if mask is None or not _accepts(bijector, "mask"):
+        return {}
+    return {"mask": mask}
+
+
 def chain(*bijectors):
     """Create a chain directly from a variable number of bijector arguments."""
     return Chain(bijectors)
@@ -147,6 +224,11 @@ class ShiftBounds(Bijector):
     estimate the minimum and maximum value from the sample and use the known bounds. For
     samples which are bounded on one side, a log-transform is applied to make the
     variable unbounded before the usual processing.
+
+    The running minimum and maximum are stored in the batch_stats collection as arrays
+    xmin and xmax of shape (D,). Variables of older versions, which stored one pair of
+    scalars per dimension, are still accepted for evaluation. Convert them with
+    migrate_variables before training is resumed, train() does this automatically.
     """
 
     margin: float = 0.1
@@ -162,7 +244,7 @@ class ShiftBounds(Bijector):
 
     @nn.compact
     def __call__(
-        self, x: Array, c: Array = None, train: bool = False
+        self, x: Array, c: Array = None, train: bool = False, *, mask: Array = None
     ) -> Tuple[Array, Array]:
         if self.is_initializing():
             for i, a, b in self.bounds:
@@ -173,104 +255,204 @@ class ShiftBounds(Bijector):
                     if b < a:
                         raise ValueError("upper bound must be larger than lower bound")
 
-        bounds = {i: (a, b) for (i, a, b) in self.bounds}
-
+        # canonical dtype, for example float32 for float64 input without jax_enable_x64
+        x = jnp.asarray(x)
         if x.dtype.kind == "i":
             x = x.astype(jnp.float32)
 
-        z = jnp.empty_like(x)
-        log_det = jnp.zeros(x.shape[0], x.dtype)
-        for i in range(x.shape[1]):
-            xi = x[:, i]
-            a, b = bounds.get(i, (None, None))
-            if _is_set(a):
-                if _is_set(b):
-                    # fully bounded
-                    mul = 1 / (b - a)
-                    assert mul > 0
-                    zi = (xi - a) * mul
-                    ld = jnp.log(mul)
-                else:
-                    # only lower bound
-                    ti = safe_log(xi - a)
-                    zi, ld = self._transform_to_unit_interval(i, ti, train)
-                    ld -= ti
-            elif _is_set(b):
-                # only upper bound
-                ti = safe_log(b - xi)
-                zi, ld = self._transform_to_unit_interval(i, ti, train)
-                ld -= ti
-            else:
-                # no bounds
-                zi, ld = self._transform_to_unit_interval(i, xi, train)
-            z = z.at[:, i].set(zi)
-            log_det += ld
-        return z, log_det
-
-    def inverse(self, z: Array, c: Array = None) -> Array:
-        bounds = {i: (a, b) for (i, a, b) in self.bounds}
-
-        x = jnp.empty_like(z)
-        for i in range(z.shape[1]):
-            zi = z[:, i]
-            a, b = bounds.get(i, (None, None))
-            if _is_set(a):
-                if _is_set(b):
-                    # fully bounded
-                    xi = zi * b + (1 - zi) * a
-                else:
-                    # only lower bound
-                    xmin = self.get_variable("batch_stats", f"xmin_{i}")
-                    xmax = self.get_variable("batch_stats", f"xmax_{i}")
-                    ti = zi * xmax + (1 - zi) * xmin
-                    xi = jnp.exp(ti) + a
-            elif _is_set(b):
-                # only upper bound
-                xmin = self.get_variable("batch_stats", f"xmin_{i}")
-                xmax = self.get_variable("batch_stats", f"xmax_{i}")
-                ti = zi * xmax + (1 - zi) * xmin
-                xi = b - jnp.exp(ti)
-            else:
-                # no bounds
-                xmin = self.get_variable("batch_stats", f"xmin_{i}")
-                xmax = self.get_variable("batch_stats", f"xmax_{i}")
-                xi = zi * xmax + (1 - zi) * xmin
-            x = x.at[:, i].set(xi)
-
-        return x
+        both, lower_only, upper_only, a, b = self._columns(x.shape[1], x.dtype)
+        one_sided = lower_only | upper_only
+        # values with one bound are log-transformed to make them unbounded
+        t = jnp.where(lower_only, x - a, jnp.where(upper_only, b - x, x))
+        t = jnp.where(one_sided, safe_log(jnp.where(one_sided, t, 1)), t)
 
-    def _transform_to_unit_interval(self, i: int, x: Array, train: bool):
-        ra_min = self.variable(
-            "batch_stats", f"xmin_{i}", lambda s: jnp.full(s, np.inf), (1,)
+        xmin, xmax = _range_from_stats(
+            self.variables.get("batch_stats", {}), x.shape[1]
         )
-        ra_max = self.variable(
-            "batch_stats", f"xmax_{i}", lambda s: jnp.full(s, -np.inf), (1,)
-        )
-
+        if self.is_initializing():
+            self.put_variable("batch_stats", "xmin", xmin)
+            self.put_variable("batch_stats", "xmax", xmax)
         if train:
-            xmin = x.min()
-            xmax = x.max()
-            xdelta = 0.5 * (xmax - xmin) * self.margin
-            xmin -= xdelta
-            xmax += xdelta
-            xmin = jnp.minimum(ra_min.value, xmin)
-            xmax = jnp.maximum(ra_max.value, xmax)
+            where = None if mask is None else mask[:, None]
+            tmin = jnp.min(t, axis=0, where=where, initial=np.inf)
+            tmax = jnp.max(t, axis=0, where=where, initial=-np.inf)
+            tdelta = 0.5 * (tmax - tmin) * self.margin
+            xmin = jnp.minimum(xmin, tmin - tdelta)
+            xmax = jnp.maximum(xmax, tmax + tdelta)
             if not self.is_initializing():
-                ra_min.value = xmin
-                ra_max.value = xmax
-        else:
-            xmin = ra_min.value
-            xmax = ra_max.value
+                self.put_variable("batch_stats", "xmin", xmin)
+                self.put_variable("batch_stats", "xmax", xmax)
 
+        # known bounds replace the statistics
+        xmin = jnp.where(both, a, xmin)
+        xmax = jnp.where(both, b, xmax)
         mul = 1 / (xmax - xmin)
-        z = (x - xmin) * mul
-        ld = jnp.log(mul)
+        z = (t - xmin) * mul
         # If test sample has more extreme values than train sample, it is possible to
         # get z values outside of the interval [0, 1], which may cause the latent
         # distribution to be evaluated outside of its non-zero domain. We clip the
         # values as a workaround.
-        z = jnp.clip(z, 0, 1)
-        return z, ld
+        z = jnp.where(both, z, jnp.clip(z, 0, 1)).astype(x.dtype)
+        log_det = jnp.sum(jnp.log(mul)) - jnp.sum(jnp.where(one_sided, t, 0), axis=1)
+        return z, log_det.astype(x.dtype)
+
+    def inverse(self, z: Array, c: Array = None) -> Array:
+        return self.inverse_and_log_det(z, c)[0]
+
+    def inverse_and_log_det(self, z: Array, c: Array = None) -> Tuple[Array, Array]:
+        z = jnp.asarray(z)
+        both, lower_only, upper_only, a, b = self._columns(z.shape[1], z.dtype)
+        one_sided = lower_only | upper_only
+
+        xmin, xmax = _range_from_stats(
+            self.variables.get("batch_stats", {}), z.shape[1]
+        )
+        xmin = jnp.where(both, a, xmin)
+        xmax = jnp.where(both, b, xmax)
+        t = z * xmax + (1 - z) * xmin
+        x = jnp.where(
+            lower_only, jnp.exp(t) + a, jnp.where(upper_only, b - jnp.exp(t), t)
+        ).astype(z.dtype)
+        log_det = -jnp.sum(jnp.log(xmax - xmin)) - jnp.sum(
+            jnp.where(one_sided, t, 0), axis=1
+        )
+        return x, log_det.astype(z.dtype)
+
+    def domain(self) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Return the region which is mapped into the unit hypercube.
+
+        The region is the support of the flow if the latent distribution vanishes
+        outside of the unit hypercube. The result is infinite along dimensions for
+        which no statistics have been collected yet.
+
+        Returns
+        -------
+        lower : ndarray of shape (D,)
+            Lower edge of the region along each dimension.
+        upper : ndarray of shape (D,)
+            Upper edge of the region along each dimension.
+
+        """
+        stats = self.variables.get("batch_stats", {})
+        tmin, tmax = (
+            np.asarray(v, dtype=float) for v in _range_from_stats(stats, None)
+        )
+        dim = max([len(tmin)] + [i + 1 for i, _, _ in self.bounds])
+        both, lower_only, upper_only, a, b = self._columns(dim, np.float64)
+        if len(tmin) < dim:
+            tmin = np.append(tmin, np.full(dim - len(tmin), np.inf))
+            tmax = np.append(tmax, np.full(dim - len(tmax), -np.inf))
+        known = np.isfinite(tmin) & np.isfinite(tmax)
+        with np.errstate(invalid="ignore", over="ignore"):
+            lower = np.where(
+                lower_only,
+                a + np.exp(tmin),
+                np.where(upper_only, b - np.exp(tmax), tmin),
+            )
+            upper = np.where(
+                lower_only,
+                a + np.exp(tmax),
+                np.where(upper_only, b - np.exp(tmin), tmax),
+            )
+        lower = np.where(both, a, np.where(known, lower, -np.inf))
+        upper = np.where(both, b, np.where(known, upper, np.inf))
+        return lower, upper
+
+    @nn.nowrap
+    def _columns(self, dim: int, dtype: Any) -> Tuple[np.ndarray, ...]:
+        # masks of the columns with both bounds, only a lower bound, and only an upper
+        # bound, and the bounds, which are zero where they are not set
+        has_lower = np.zeros(dim, dtype=bool)
+        has_upper = np.zeros(dim, dtype=bool)
+        a = np.zeros(dim)
+        b = np.zeros(dim)
+        for i, ai, bi in self.bounds:
+            if _is_set(ai):
+                has_lower[i] = True
+                a[i] = ai
+            if _is_set(bi):
+                has_upper[i] = True
+                b[i] = bi
+        return (
+            has_lower & has_upper,
+            has_lower & ~has_upper,
+            has_upper & ~has_lower,
+            a.astype(dtype),
+            b.astype(dtype),
+        )
+
+
+def _range_from_stats(stats: Dict[str, Any], dim: Optional[int]) -> Tuple[Array, Array]:
+    # return the running minimum and maximum of ShiftBounds as arrays of shape (D,);
+    # older versions stored one variable of shape (1,) per column that has statistics,
+    # which are converted here, so that old trained variables can still be used
+    if "xmin" in stats:
+        if dim is not None and stats["xmin"].shape != (dim,):
+            msg = f"input has {dim} dimensions, expected {stats['xmin'].shape[0]}"
+            raise ValueError(msg)
+        return stats["xmin"], stats["xmax"]
+    if dim is None:
+        dim = max((int(k[5:]) + 1 for k in stats if k.startswith("xmin_")), default=0)
+    xmin = jnp.full(dim, np.inf, dtype=jnp.float32)
+    xmax = jnp.full(dim, -np.inf, dtype=jnp.float32)
+    for i in range(dim):
+        if f"xmin_{i}" in stats:
+            xmin = xmin.at[i].set(stats[f"xmin_{i}"][0])
+            xmax = xmax.at[i].set(stats[f"xmax_{i}"][0])
+    return xmin, xmax
+
+
+def migrate_variables(
+    variables: ArrayPytree, template: Optional[ArrayPytree] = None
+) -> ArrayPytree:
+    """
+    Convert variables of older versions to the current layout.
+
+    Older versions of ShiftBounds stored the running minimum and maximum as one pair of
+    variables xmin_i and xmax_i of shape (1,) per column i. These are replaced by the
+    arrays xmin and xmax of shape (D,). The old layout is still accepted for evaluation,
+    but training would store the new variables next to the old ones, which changes the
+    structure of the variables while training.
+
+    Parameters
+    ----------
+    variables : ArrayPytree
+        Variables of a flow or a bijector.
+    template : ArrayPytree or None, optional (default is None)
+        Variables in the current layout, for example from jax.eval_shape applied to
+        Flow.init, which provide the number of dimensions. If None, the number of
+        dimensions is inferred from the old variables, which is too small if the last
+        columns are fully bounded, since no statistics were stored for those.
+
+    Returns
+    -------
+    ArrayPytree
+        Variables in the current layout. Variables in the current layout are returned
+        unchanged.
+
+    """
+    if not isinstance(variables, Mapping):
+        return variables
+    if any(isinstance(k, str) and k.startswith("xmin_") for k in variables):
+        dim = None
+        if isinstance(template, Mapping) and "xmin" in template:
+            dim = template["xmin"].shape[0]
+        xmin, xmax = _range_from_stats(variables, dim)
+        result = {
+            k: v
+            for k, v in variables.items()
+            if not (isinstance(k, str) and k.startswith(("xmin_", "xmax_")))
+        }
+        result["xmin"] = xmin
+        result["xmax"] = xmax
+        return result
+    return {
+        k: migrate_variables(
+            v, template.get(k) if isinstance(template, Mapping) else None
+        )
+        for k, v in variables.items()
+    }
 
 
 class Roll(Bijector):
@@ -286,7 +468,7 @@ class Roll(Bijector):
     shift: int = 1
 
     def __call__(
-        self, x: Array, c: Array = None, train: bool = False
+        self, x: Array, c: Array = None, train: bool = False, *, mask: Array = None
     ) -> Tuple[Array, Array]:
         x = jnp.roll(x, shift=self.shift, axis=-1)
         log_det = jnp.zeros(x.shape[0])
@@ -296,6 +478,9 @@ class Roll(Bijector):
         x = jnp.roll(x, shift=-self.shift, axis=-1)
         return x
 
+    def inverse_and_log_det(self, x: Array, c: Array = None) -> Tuple[Array, Array]:
+        return self.inverse(x, c), jnp.zeros(x.shape[0])
+
 
 class NeuralSplineCoupling(Bijector):
     """
@@ -308,6 +493,22 @@ class NeuralSplineCoupling(Bijector):
     The spline only transform values in a hypercube with side intervals [0, 1]. For
     values outside of the hypercube the identity transform is applied.
 
+    The conditioner network, which computes the spline parameters, can be computed in a
+    lower precision by setting dtype, for example to jnp.bfloat16. The parameters of
+    the network, the spline arithmetic and the log-determinant are always computed in
+    the precision of the input.
+
+    If c has fewer rows than x, see Bijector, the contribution of c to the first layer
+    of the network is computed once per row of c outside of training.
+
+    By default, the lower half of the dimensions is transformed and the upper half is
+    used as conditioning input, so that Roll is needed in between couplings. If the
+    indices of the transformed dimensions are set, the coupling transforms these and
+    conditions on those in conditioning, in the given order; by default on the
+    remaining dimensions in ascending order. The transformed values are written in
+    place of the inputs, so that the other dimensions keep their positions and no Roll
+    is needed, see rolling_spline_coupling.
+
     For a derivation, discussion, and more information, see:
 
     Durkan, C., Bekasov, A., Murray, I., and Papamakarios, G. (2019). “Neural Spline
@@ -317,18 +518,45 @@ class NeuralSplineCoupling(Bijector):
     knots: int = 16
     layers: Sequence[int] = (128, 128)
     act: Callable[[Array], Array] = nn.swish
+    dtype: Optional[Any] = None
+    transformed: Optional[Sequence[int]] = None
+    conditioning: Optional[Sequence[int]] = None
+
+    @nn.nowrap
+    def _indices(self, dim: int) -> Tuple[Sequence[int], Sequence[int]]:
+        if self.transformed is None:
+            if self.conditioning is not None:
+                raise ValueError("conditioning requires transformed")
+            split = dim // 2
+            return range(split), range(split, dim)
+        transformed = list(self.transformed)
+        if self.conditioning is None:
+            conditioning = [i for i in range(dim) if i not in transformed]
+        else:
+            conditioning = list(self.conditioning)
+        if sorted(transformed + conditioning) != list(range(dim)):
+            msg = (
+                "transformed and conditioning must be a partition of the "
+                f"{dim} dimensions"
+            )
+            raise ValueError(msg)
+        return transformed, conditioning
+
+    @nn.nowrap
+    def _split(self, x: Array) -> Tuple[Array, Array]:
+        transformed, conditioning = self._indices(x.shape[1])
+        assert len(transformed) > 0 and len(conditioning) > 0
+        return _take(x, transformed), _take(x, conditioning)
 
     @nn.nowrap
-    @staticmethod
-    def _split(x: Array):
-        x_dim = x.shape[1]
-        x_split = x_dim // 2
-        assert x_split > 0 and x_split < x_dim
-        return x[:, :x_split], x[:, x_split:]
+    def _merge(self, x: Array, yt: Array, xc: Array) -> Array:
+        if self.transformed is None:
+            return jnp.hstack((yt, xc))
+        return _put(x, self._indices(x.shape[1])[0], yt)
 
     @nn.compact
     def _spline_params(
-        self, x: Array, c: Array, train: bool
+        self, x: Array, c: Array, train: bool, mask: Optional[Array] = None
     ) -> Tuple[Array, Array, Array, Array, Array]:
         # xt are transformed conditionally based on values xc
         xt, xc = self._split(x)
@@ -338,13 +566,27 @@ class NeuralSplineCoupling(Bijector):
 
         # calculate spline parameters as a function of xc variables
         # and external conditional variables c
-        x = jnp.hstack((xc, c)) if c is not None else xc
-        x = nn.BatchNorm(use_running_average=not train)(x)
-        for width in self.layers:
-            x = nn.Dense(width)(x)
+        norm = nn.BatchNorm(use_running_average=not train, dtype=self.dtype)
+        dense = [
+            nn.Dense(width, dtype=self.dtype)
+            for width in (*self.layers, dim * spline_dim)
+        ]
+        if c is not None and c.shape[0] != xc.shape[0]:
+            if xc.shape[0] % c.shape[0] != 0:
+                raise ValueError("number of samples must be a multiple of rows in c")
+            if train or self.is_initializing():
+                # batch statistics need all rows
+                c = jnp.repeat(c, xc.shape[0] // c.shape[0], axis=0)
+        if c is not None and c.shape[0] != xc.shape[0]:
+            x = _first_layer_per_condition(norm, dense[0], xc, c)
+        else:
+            x = jnp.hstack((xc, c)) if c is not None else xc
+            x = norm(x, mask=None if mask is None else mask[:, None])
+            x = dense[0](x)
+        for layer in dense[1:]:
             x = self.act(x)
-        x = nn.Dense(dim * spline_dim)(x)
-        x = x.reshape((xt.shape[0], dim, spline_dim))
+            x = layer(x)
+        x = x.reshape((xt.shape[0], dim, spline_dim)).astype(xt.dtype)
 
         return (
             xt,
@@ -357,19 +599,281 @@ class NeuralSplineCoupling(Bijector):
         )
 
     def __call__(
-        self, x: Array, c: Array = None, train: bool = False
+        self, x: Array, c: Array = None, train: bool = False, *, mask: Array = None
     ) -> Tuple[Array, Array]:
-        xt, xc, dx, dy, sl = self._spline_params(x, c, train)
+        xt, xc, dx, dy, sl = self._spline_params(x, c, train, mask)
         yt, log_det = rational_quadratic_spline_forward(xt, dx, dy, sl)
-        y = jnp.hstack((yt, xc))
+        y = self._merge(x, yt, xc)
         return y, log_det
 
     def inverse(self, y: Array, c: Array = None) -> Array:
         yt, yc, dx, dy, sl = self._spline_params(y, c, False)
         xt = rational_quadratic_spline_inverse(yt, dx, dy, sl)
-        x = jnp.hstack((xt, yc))
+        x = self._merge(y, xt, yc)
         return x
 
+    def inverse_and_log_det(self, y: Array, c: Array = None) -> Tuple[Array, Array]:
+        yt, yc, dx, dy, sl = self._spline_params(y, c, False)
+        xt, log_det = rational_quadratic_spline_inverse_and_log_det(yt, dx, dy, sl)
+        x = self._merge(y, xt, yc)
+        return x, log_det
+
+
+def _runs(indices: Sequence[int]) -> List[Tuple[int, int]]:
+    # split indices into runs of consecutive values, returned as (start, stop)
+    runs: List[Tuple[int, int]] = []
+    for i in indices:
+        if runs and runs[-1][1] == i:
+            runs[-1] = (runs[-1][0], i + 1)
+        else:
+            runs.append((i, i + 1))
+    return runs
+
+
+def _take(x: Array, indices: Sequence[int]) -> Array:
+    # static slices instead of a gather; indices are typically one or two runs
+    parts = [x[:, a:b] for a, b in _runs(indices)]
+    return parts[0] if len(parts) == 1 else jnp.concatenate(parts, axis=1)
+
+
+def _put(x: Array, indices: Sequence[int], y: Array) -> Array:
+    # write columns of y into x at indices with static updates
+    pos = 0
+    for a, b in _runs(indices):
+        x = lax.dynamic_update_slice_in_dim(x, y[:, pos : pos + b - a], a, axis=1)
+        pos += b - a
+    return x
+
+
+def _first_layer_per_condition(
+    norm: nn.BatchNorm, dense: nn.Dense, xc: Array, c: Array
+) -> Array:
+    # BatchNorm with running averages acts on each feature separately and the first
+    # layer is linear, so the part which depends on c is computed once per row of c;
+    # the zeros only complete the input of norm, which is elementwise
+    n, m = xc.shape[0], c.shape[0]
+    nx = xc.shape[1]
+    xn = norm(jnp.hstack((xc, jnp.zeros((n, c.shape[1]), xc.dtype))))[:, :nx]
+    cn = norm(jnp.hstack((jnp.zeros((m, nx), c.dtype), c)))[:, nx:]
+    kernel = dense.variables["params"]["kernel"]
+    bias = dense.variables["params"]["bias"]
+    xn, cn, kernel, bias = promote_dtype(xn, cn, kernel, bias, dtype=dense.dtype)
+    hx = jnp.dot(xn, kernel[:nx]).reshape(m, n // m, -1)
+    hc = jnp.dot(cn, kernel[nx:]) + bias
+    return (hx + hc[:, None]).reshape(n, -1)
+
+
+class ElementwiseSpline(Bijector):
+    """
+    Transform each dimension independently with a rational quadratic spline.
+
+    This bijector is meant for one-dimensional distributions, for which couplings do
+    not work. Without conditional variables, the spline parameters are trainable
+    parameters, one set per dimension, which are initialized so that the transform is
+    the identity. With conditional variables, the spline parameters are computed from
+    them with a feed-forward network, as in NeuralSplineCoupling. If c has fewer rows
+    than x, see Bijector, the network is computed once per row of c outside of
+    training.
+
+    Like NeuralSplineCoupling, the spline only transforms values in the interval
+    [0, 1] and applies the identity transform outside. The transform is monotonically
+    increasing.
+    """
+
+    knots: int = 16
+    layers: Sequence[int] = (128, 128)
+    act: Callable[[Array], Array] = nn.swish
+    dtype: Optional[Any] = None
+
+    @nn.compact
+    def _spline_params(
+        self, x: Array, c: Optional[Array], train: bool, mask: Optional[Array] = None
+    ) -> Tuple[Array, Array, Array]:
+        n, dim = x.shape
+        spline_dim = 3 * self.knots - 1
+        if c is None:
+            p = self.param("spline", nn.initializers.zeros, (dim, spline_dim))
+            p = jnp.broadcast_to(p, (n, dim, spline_dim))
+        else:
+            if c.shape[0] != n:
+                if n % c.shape[0] != 0:
+                    raise ValueError(
+                        "number of samples must be a multiple of rows in c"
+                    )
+                if train or self.is_initializing():
+                    # batch statistics need all rows
+                    c = jnp.repeat(c, n // c.shape[0], axis=0)
+            norm = nn.BatchNorm(use_running_average=not train, dtype=self.dtype)
+            p = norm(c, mask=None if mask is None or c.shape[0] != n else mask[:, None])
+            for i, width in enumerate((*self.layers, dim * spline_dim)):
+                if i > 0:
+                    p = self.act(p)
+                p = nn.Dense(width, dtype=self.dtype)(p)
+            p = p.reshape((c.shape[0], dim, spline_dim))
+            p = jnp.repeat(p, n // c.shape[0], axis=0)
+        p = p.astype(x.dtype)
+        return normalize_spline_params(
+            p[..., : self.knots],
+            p[..., self.knots : 2 * self.knots],
+            p[..., 2 * self.knots :],
+        )
+
+    def __call__(
+        self, x: Array, c: Array = None, train: bool = False, *, mask: Array = None
+    ) -> Tuple[Array, Array]:
+        dx, dy, sl = self._spline_params(x, c, train, mask)
+        return rational_quadratic_spline_forward(x, dx, dy, sl)
+
+    def inverse(self, y: Array, c: Array = None) -> Array:
+        dx, dy, sl = self._spline_params(y, c, False)
+        return rational_quadratic_spline_inverse(y, dx, dy, sl)
+
+    def inverse_and_log_det(self, y: Array, c: Array = None) -> Tuple[Array, Array]:
+        dx, dy, sl = self._spline_params(y, c, False)
+        return rational_quadratic_spline_inverse_and_log_det(y, dx, dy, sl)
+
+
+class RollingSplineCoupling(Bijector):
+    """
+    Rolling spline couplings with stacked parameters, recomputed in the backward pass.
+
+    This bijector applies a NeuralSplineCoupling once for each of the D dimensions of
+    the input, like the couplings created by rolling_spline_coupling, and computes the
+    same transform. The parameters and statistics of the D couplings are stacked along
+    a leading axis in the variable "coupling", so that the couplings are run in a
+    jax.lax.scan, in segments of the given number of couplings. The intermediate
+    results of a segment are not kept for the backward pass during training, but
+    recomputed, which trades computation time for memory. Only the input of each
+    segment is kept. The remat_policy is passed to jax.checkpoint and selects
+    intermediate results within a segment which are kept nevertheless, for example
+    jax.checkpoint_policies.dots_with_no_batch_dims_saveable.
+
+    Rematerialization saves memory on the XLA CPU backend only in this form, since the
+    scan prevents the compiler from moving the recomputation forward.
+    """
+
+    knots: int = 16
+    layers: Sequence[int] = (128, 128)
+    act: Callable[[Array], Array] = nn.swish
+    dtype: Optional[Any] = None
+    segment: int = 1
+    remat_policy: Optional[Callable[..., bool]] = None
+
+    @nn.nowrap
+    def _coupling(self) -> NeuralSplineCoupling:
+        # coupling k transforms the lower half of the input rolled by k dimensions
+        return NeuralSplineCoupling(
+            knots=self.knots,
+            layers=self.layers,
+            act=self.act,
+            dtype=self.dtype,
+            parent=None,
+        )
+
+    @nn.nowrap
+    def couplings(self, dim: int) -> List[NeuralSplineCoupling]:
+        """Return the equivalent couplings, which transform their input in place."""
+        return [
+            self._coupling().clone(transformed=t, conditioning=u)
+            for t, u in map(partial(_rolling_indices, dim), range(dim))
+        ]
+
+    @nn.compact
+    def __call__(
+        self, x: Array, c: Array = None, train: bool = False, *, mask: Array = None
+    ) -> Tuple[Array, Array]:
+        if self.segment < 1:
+            raise ValueError("segment must be a positive integer")
+        dim = x.shape[1]
+        coupling = self._coupling()
+        if self.is_initializing():
+            keys = jax.random.split(self.make_rng("params"), dim)
+            c0 = None if c is None else c[:1]
+            init = jax.vmap(lambda key: coupling.init(key, x[:1], c0))(keys)
+            for col in ("params", "batch_stats"):
+                self.put_variable(col, "coupling", init[col])
+        variables = self._stacked()
+
+        def step(x, variables):
+            if train:
+                (y, log_det), updates = coupling.apply(
+                    variables, x, c, True, mask=mask, mutable=["batch_stats"]
+                )
+                stats = updates["batch_stats"]
+            else:
+                y, log_det = coupling.apply(variables, x, c)
+                stats = variables["batch_stats"]
+            # the input of the next coupling is rolled by one more dimension
+            return jnp.roll(y, 1, axis=1), log_det, stats
+
+        def segment(carry, variables):
+            x, log_det = carry
+            stats = []
+            for k in range(jax.tree_util.tree_leaves(variables)[0].shape[0]):
+                x, ld, s = step(x, _index(variables, k))
+                log_det += ld
+                stats.append(s)
+            return (x, log_det), jax.tree_util.tree_map(lambda *s: jnp.stack(s), *stats)
+
+        segment = jax.checkpoint(segment, policy=self.remat_policy, prevent_cse=False)
+        n = dim // self.segment * self.segment
+        head = jax.tree_util.tree_map(
+            lambda v: v[:n].reshape((-1, self.segment) + v.shape[1:]), variables
+        )
+        tail = jax.tree_util.tree_map(lambda v: v[n:], variables)
+        carry, stats = lax.scan(segment, (x, jnp.zeros(x.shape[0])), head)
+        stats = jax.tree_util.tree_map(lambda v: v.reshape((n,) + v.shape[2:]), stats)
+        if n < dim:
+            carry, tail_stats = segment(carry, tail)
+            stats = jax.tree_util.tree_map(
+                lambda a, b: jnp.concatenate((a, b)), stats, tail_stats
+            )
+        if train and not self.is_initializing():
+            self.put_variable("batch_stats", "coupling", stats)
+        return carry
+
+    def inverse(self, x: Array, c: Array = None) -> Array:
+        coupling = self._coupling()
+
+        def step(x, variables):
+            x = jnp.roll(x, -1, axis=1)
+            return coupling.apply(variables, x, c, method="inverse"), None
+
+        x, _ = lax.scan(step, x, self._stacked(), reverse=True)
+        return x
+
+    def inverse_and_log_det(self, x: Array, c: Array = None) -> Tuple[Array, Array]:
+        coupling = self._coupling()
+
+        def step(carry, variables):
+            x, log_det = carry
+            x = jnp.roll(x, -1, axis=1)
+            x, ld = coupling.apply(variables, x, c, method="inverse_and_log_det")
+            return (x, log_det + ld), None
+
+        carry = (x, jnp.zeros(x.shape[0]))
+        carry, _ = lax.scan(step, carry, self._stacked(), reverse=True)
+        return carry
+
+    @nn.nowrap
+    def _stacked(self) -> Dict[str, ArrayPytree]:
+        return {
+            col: self.variables[col]["coupling"] for col in ("params", "batch_stats")
+        }
+
+
+def _index(tree: ArrayPytree, k: int) -> ArrayPytree:
+    # element k of arrays stacked along the leading axis
+    return jax.tree_util.tree_map(lambda v: v[k], tree)
+
+
+def _rolling_indices(dim: int, k: int) -> Tuple[Tuple[int, ...], Tuple[int, ...]]:
+    # dimensions transformed and conditioned on by coupling k of a chain which
+    # alternates couplings with Rolls by one dimension, without the Rolls
+    rolled = [(j - k) % dim for j in range(dim)]
+    split = dim // 2
+    return tuple(rolled[:split]), tuple(rolled[split:])
+
 
 def rolling_spline_coupling(
     dim: int,
@@ -378,13 +882,26 @@ def rolling_spline_coupling(
     margin: Optional[float] = None,
     bounds: Sequence[Tuple[int, Optional[float], Optional[float]]] = (),
     preprocessing: Optional[Sequence[Bijector]] = None,
+    dtype: Optional[Any] = None,
+    remat: Union[bool, int] = False,
+    remat_policy: Optional[Callable[..., bool]] = None,
 ) -> Chain:
     """
     Create a chain of rolling spline couplings.
 
-    The chain starts with ShiftBounds and then alternates between
-    NeuralSplineCoupling and Roll once for each dimension in the input.
-    The input must be at least two-dimensional for this to work.
+    The chain starts with ShiftBounds and then applies a NeuralSplineCoupling once for
+    each dimension in the input. The input must be at least two-dimensional for this to
+    work. Each coupling transforms a different window of half of the dimensions,
+    shifted by one dimension with each coupling, and writes the result in place, which
+    is equivalent to alternating couplings with Roll, but avoids copying the input. A
+    single Roll at the end puts the latent dimensions in the order of the alternating
+    chain.
+
+    Older versions inserted a Roll between couplings. The couplings keep the names they
+    had in such chains and transform the same dimensions, so variables which were
+    trained with older versions can still be used and give the same latent values and
+    samples. Only the intermediate results after each coupling are in a different
+    order.
 
     Parameters
     ----------
@@ -401,6 +918,16 @@ def rolling_spline_coupling(
         ignored, if preprocessing is set.
     preprocessing: sequence of bijectors or None (default is None)
         Specify an alternative preprocessing chain. The default is to use ShiftBounds.
+    dtype : dtype or None (default is None)
+        Compute the networks of the couplings in this dtype. See NeuralSplineCoupling.
+    remat : bool or int (default = False)
+        Recompute intermediate results in the backward pass to save memory. If True,
+        each coupling is recomputed separately, if an integer k, segments of k
+        couplings. The couplings are then replaced by a RollingSplineCoupling, whose
+        variables are stacked and therefore not compatible with those of the chain
+        without remat.
+    remat_policy : callable or None (default is None)
+        Policy passed to jax.checkpoint. See RollingSplineCoupling.
     """
     if dim < 2:
         raise ValueError("dim must be at least 2")
@@ -415,14 +942,80 @@ def rolling_spline_coupling(
         if bounds is not None:
             kwargs["bounds"] = bounds
         bijectors = [ShiftBounds(**kwargs)]
-    for _ in range(dim - 1):
-        bijectors.append(NeuralSplineCoupling(knots=knots, layers=layers))
-        bijectors.append(Roll())
-    bijectors.append(NeuralSplineCoupling(knots=knots, layers=layers))
-    # we can skip last Roll, latent distribution is invariant to Roll
+    offset = len(bijectors)
+    if remat:
+        segment = 1 if remat is True else remat
+        if segment < 1:
+            raise ValueError("remat must be a positive integer or bool")
+        bijectors.append(
+            RollingSplineCoupling(
+                knots=knots,
+                layers=layers,
+                dtype=dtype,
+                segment=segment,
+                remat_policy=remat_policy,
+            )
+        )
+    else:
+        for k in range(dim):
+            transformed, conditioning = _rolling_indices(dim, k)
+            bijectors.append(
+                NeuralSplineCoupling(
+                    knots=knots,
+                    layers=layers,
+                    dtype=dtype,
+                    transformed=transformed,
+                    conditioning=conditioning,
+                    name=f"bijectors_{offset + 2 * k}",
+                )
+            )
+    # the alternating chain ends with its input rolled by dim - 1 dimensions; the name
+    # is not used by the alternating chain and Roll has no variables
+    bijectors.append(Roll(shift=dim - 1, name=f"bijectors_{offset + 2 * dim - 1}"))
     return Chain(bijectors)
 
 
+def elementwise_spline(
+    knots: int = 16,
+    layers: Sequence[int] = (128, 128),
+    margin: Optional[float] = None,
+    bounds: Sequence[Tuple[int, Optional[float], Optional[float]]] = (),
+    dtype: Optional[Any] = None,
+) -> Chain:
+    """
+    Create a chain of ShiftBounds and ElementwiseSpline.
+
+    This is the bijector for one-dimensional distributions, which is used without a
+    dummy dimension. Flow.cdf and Flow.ppf compute the cumulative distribution function
+    and the quantile function of such a flow.
+
+    Parameters
+    ----------
+    knots : int (default = 16)
+        Number of knots used by the spline.
+    layers: sequence of int (default = (128, 128))
+        Sequence of neurons per hidden layer in the feed-forward network which computes
+        the spline parameters from the conditional variables. Not used without
+        conditional variables.
+    margin : float or None (default is None)
+        Safety margin for ShiftBounds. See ShiftBounds for details.
+    bounds : sequence of (int, float or None, float or None) (default = ())
+        Known bounds, see ShiftBounds.
+    dtype : dtype or None (default is None)
+        Compute the network in this dtype. See NeuralSplineCoupling.
+
+    """
+    kwargs: Dict[str, Any] = {"bounds": bounds}
+    if margin is not None:
+        kwargs["margin"] = margin
+    return Chain(
+        [
+            ShiftBounds(**kwargs),
+            ElementwiseSpline(knots=knots, layers=layers, dtype=dtype),
+        ]
+    )
+
+
 def _is_set(x: Optional[float]) -> TypeGuard[float]:
     return x is not None and np.isfinite(x)
 
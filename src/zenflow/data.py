@@ -0,0 +1,253 @@
+"""Data sources for out-of-core training."""
+
+from abc import ABC, abstractmethod
+from typing import Callable, Iterable, Iterator, Optional, Tuple
+import queue
+import threading
+
+import numpy as np
+from numpy.typing import ArrayLike
+
+__all__ = [
+    "DataSource",
+    "ArraySource",
+    "ChunkedSource",
+    "GeneratorSource",
+    "batches",
+    "prefetch",
+]
+
+Chunk = Tuple[np.ndarray, Optional[np.ndarray]]
+Batch = Tuple[np.ndarray, Optional[np.ndarray], np.ndarray]
+
+
+class DataSource(ABC):
+    """
+    DataSource base class.
+
+    A data source provides the training data in chunks, which are read one after
+    another. Only the current chunk is held in memory. Chunks should be large compared
+    to the batch size, since samples are only shuffled within a chunk.
+    """
+
+    @abstractmethod
+    def chunks(self, rng: np.random.Generator) -> Iterator[Chunk]:
+        """
+        Yield chunks of samples and conditional variables.
+
+        Parameters
+        ----------
+        rng : numpy.random.Generator
+            Random number generator which may be used to randomize the chunk order.
+
+        Yields
+        ------
+        x : ndarray of shape (M, D)
+            M samples from a D-dimensional distribution.
+        c : ndarray of shape (M, K) or None
+            M values of the K-dimensional conditional variables or None.
+
+        """
+        raise NotImplementedError
+
+    def peek(self) -> Chunk:
+        """Return the first chunk without consuming the source."""
+        return next(iter(self.chunks(np.random.default_rng(0))))
+
+
+class ArraySource(DataSource):
+    """
+    Data source which reads chunks from arrays, in particular memory-mapped arrays.
+
+    The arrays are read in contiguous slices of chunk_size samples in random order.
+    """
+
+    def __init__(
+        self, x: ArrayLike, c: Optional[ArrayLike] = None, chunk_size: int = 2**16
+    ):
+        if c is not None and len(c) != len(x):
+            raise ValueError("x and c must have the same length")
+        if chunk_size < 1:
+            raise ValueError("chunk_size must be positive")
+        self.x = x
+        self.c = c
+        self.chunk_size = chunk_size
+
+    @classmethod
+    def from_npy(
+        cls, x_path: str, c_path: Optional[str] = None, chunk_size: int = 2**16
+    ) -> "ArraySource":
+        """Create source from memory-mapped .npy files."""
+        x = np.load(x_path, mmap_mode="r")
+        c = None if c_path is None else np.load(c_path, mmap_mode="r")
+        return cls(x, c, chunk_size)
+
+    def __len__(self):
+        """Return number of samples."""
+        return len(self.x)
+
+    def chunks(self, rng: np.random.Generator) -> Iterator[Chunk]:
+        starts = np.arange(0, len(self.x), self.chunk_size)
+        for a in rng.permutation(starts):
+            b = a + self.chunk_size
+            x = np.asarray(self.x[a:b])
+            c = None if self.c is None else np.asarray(self.c[a:b])
+            yield x, c
+
+
+class ChunkedSource(DataSource):
+    """
+    Data source which calls a reader function for each chunk.
+
+    The reader is called with the index of the chunk in the range [0, n_chunks) and
+    must return a tuple (x, c), where c may be None. The chunk order is randomized.
+    """
+
+    def __init__(self, reader: Callable[[int], Chunk], n_chunks: int):
+        self.reader = reader
+        self.n_chunks = n_chunks
+
+    def chunks(self, rng: np.random.Generator) -> Iterator[Chunk]:
+        for i in rng.permutation(self.n_chunks):
+            x, c = self.reader(int(i))
+            yield np.asarray(x), None if c is None else np.asarray(c)
+
+
+class GeneratorSource(DataSource):
+    """
+    Data source which wraps a generator function.
+
+    The factory is called once per epoch without arguments and must return an
+    iterable over tuples (x, c), where c may be None. The chunk order is determined by
+    the iterable.
+    """
+
+    def __init__(self, factory: Callable[[], Iterable[Chunk]]):
+        self.factory = factory
+
+    def chunks(self, rng: np.random.Generator) -> Iterator[Chunk]:
+        for x, c in self.factory():
+            yield np.asarray(x), None if c is None else np.asarray(c)
+
+
+def batches(
+    source: DataSource, batch_size: int, rng: np.random.Generator
+) -> Iterator[Batch]:
+    """
+    Yield shuffled batches of fixed size from a data source.
+
+    Samples are shuffled within each chunk. Samples left over at the end of a chunk are
+    carried over to the next one. The last batch is padded by repeating samples and the
+    returned mask is False for the padded entries.
+
+    Parameters
+    ----------
+    source : DataSource
+        Source of the samples.
+    batch_size : int
+        Number of samples per batch.
+    rng : numpy.random.Generator
+        Random number generator used for shuffling.
+
+    Yields
+    ------
+    x : ndarray of shape (batch_size, D)
+        Samples.
+    c : ndarray of shape (batch_size, K) or None
+        Conditional variables.
+    mask : ndarray of shape (batch_size,)
+        Boolean mask which is False for padded entries.
+
+    """
+    full_mask = np.ones(batch_size, dtype=bool)
+    x_rest: Optional[np.ndarray] = None
+    c_rest: Optional[np.ndarray] = None
+    for x, c in source.chunks(rng):
+        perm = rng.permutation(len(x))
+        x = x[perm]
+        c = None if c is None else c[perm]
+        if x_rest is not None:
+            x = np.concatenate([x_rest, x])
+            c = None if c is None else np.concatenate([c_rest, c])
+        n = (len(x) // batch_size) * batch_size
+        for i in range(0, n, batch_size):
+            yield (
+                x[i : i + batch_size],
+                None if c is None else c[i : i + batch_size],
+                full_mask,
+            )
+        x_rest = x[n:]
+        c_rest = None if c is None else c[n:]
+
+    if x_rest is not None and len(x_rest) > 0:
+        n = len(x_rest)
+        mask = np.arange(batch_size) < n
+        x = np.resize(x_rest, (batch_size,) + x_rest.shape[1:])
+        c = (
+            None
+            if c_rest is None
+            else np.resize(c_rest, (batch_size,) + c_rest.shape[1:])
+        )
+        yield x, c, mask
+
+
+def prefetch(
+    iterable: Iterable, size: int = 2, transfer: Optional[Callable] = None
+) -> Iterator:
+    """
+    Iterate in a background thread and buffer results.
+
+    Parameters
+    ----------
+    iterable : Iterable
+        Source of items.
+    size : int, optional (default = 2)
+        Maximum number of buffered items. The memory used by the buffer is bounded by
+        this number.
+    transfer : callable or None, optional (default = None)
+        Function applied to each item in the background thread, for example
+        jax.device_put to move the item to the device.
+
+    Yields
+    ------
+    Items of the iterable, to which transfer was applied.
+
+    """
+    buffer: queue.Queue = queue.Queue(maxsize=size)
+    done = object()
+    stop = threading.Event()
+
+    def put(item) -> bool:
+        # give up if the consumer has stopped, so that the thread can finish
+        while not stop.is_set():
+            try:
+                buffer.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def worker():
+        try:
+            for item in iterable:
+                if transfer is not None:
+                    item = transfer(item)
+                if not put((item, None)):
+                    return
+            put((done, None))
+        except BaseException as e:
+            put((done, e))
+
+    thread = threading.Thread(target=worker, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item, error = buffer.get()
+            if item is done:
+                if error is not None:
+                    raise error
+                break
+            yield item
+    finally:
+        stop.set()
+        thread.join()
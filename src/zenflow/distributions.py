@@ -1,11 +1,11 @@
 """Base distributions used in conditional normalizing flows."""
 
 from abc import ABC, abstractmethod
-from flax.typing import Array
+from jax import Array
 from typing import Optional
 import jax.numpy as jnp
-from jax import random
-from jax.scipy import stats
+from jax import lax, random
+from jax.scipy import special, stats
 
 
 class Distribution(ABC):
@@ -42,6 +42,43 @@ class Distribution(ABC):
     @abstractmethod
     def sample(self, nsamples: int, rngkey: Array) -> Array: ...
 
+    def cdf(self, x: Array) -> Array:
+        """
+        Compute the cumulative distribution function of each component.
+
+        The components of the distribution are independent and identically
+        distributed, so this is applied elementwise.
+
+        Parameters
+        ----------
+        x : Array
+            Values of the components.
+
+        Returns
+        -------
+        Array of the same shape as x
+            Probabilities that a component is smaller than the values.
+
+        """
+        raise NotImplementedError
+
+    def ppf(self, q: Array) -> Array:
+        """
+        Compute the quantile function of each component, the inverse of cdf.
+
+        Parameters
+        ----------
+        q : Array
+            Probabilities.
+
+        Returns
+        -------
+        Array of the same shape as q
+            Quantiles of the components.
+
+        """
+        raise NotImplementedError
+
     def __repr__(self):
         """Return string representation."""
         return f"""{self.__class__.__name__}()"""
@@ -61,6 +98,12 @@ class Normal(Distribution):
     def sample(self, nsamples: int, rngkey: Array) -> Array:
         return 0.5 + 0.1 * random.normal(rngkey, shape=(nsamples, self.dim))
 
+    def cdf(self, x: Array) -> Array:
+        return special.ndtr((x - 0.5) / 0.1)
+
+    def ppf(self, q: Array) -> Array:
+        return 0.5 + 0.1 * special.ndtri(q)
+
 
 class TruncatedNormal(Distribution):
     """
@@ -77,6 +120,15 @@ class TruncatedNormal(Distribution):
             rngkey, -5, 5, shape=(nsamples, self.dim)
         )
 
+    def cdf(self, x: Array) -> Array:
+        lower = special.ndtr(-5.0)
+        p = (special.ndtr((x - 0.5) / 0.1) - lower) / (1 - 2 * lower)
+        return jnp.clip(p, 0, 1)
+
+    def ppf(self, q: Array) -> Array:
+        lower = special.ndtr(-5.0)
+        return 0.5 + 0.1 * special.ndtri(lower + q * (1 - 2 * lower))
+
 
 class Beta(Distribution):
     """
@@ -111,6 +163,39 @@ class Beta(Distribution):
             shape=(nsamples, self.dim),
         )
 
+    def cdf(self, x: Array) -> Array:
+        return special.betainc(self.peakness, self.peakness, jnp.clip(x, 0, 1))
+
+    def ppf(self, q: Array) -> Array:
+        # the distribution is symmetric, we solve for the lower half with safeguarded
+        # Newton iterations for log(cdf) as a function of log(x), which is nearly
+        # linear in the tail, and fall back to bisection if a step leaves the bracket
+        q = jnp.asarray(q)
+        a = self.peakness
+        upper = q > 0.5
+        p = jnp.where(upper, 1 - q, q)
+        log_p = jnp.log(p)
+        # start from the normal approximation
+        x = jnp.clip(0.5 + special.ndtri(p) / jnp.sqrt(8 * a + 4), 0.01, 0.5)
+        u = jnp.log(x)
+        lower_u = jnp.full_like(p, -jnp.inf)
+        upper_u = jnp.full_like(p, jnp.log(0.5))
+
+        def step(_, state):
+            lower_u, upper_u, u = state
+            x = jnp.exp(u)
+            cdf = special.betainc(a, a, x)
+            g = jnp.log(cdf) - log_p
+            lower_u = jnp.where(g < 0, u, lower_u)
+            upper_u = jnp.where(g < 0, upper_u, u)
+            u_new = u - g * cdf / (x * jnp.exp(stats.beta.logpdf(x, a, a)))
+            ok = (u_new >= lower_u) & (u_new <= upper_u)
+            return lower_u, upper_u, jnp.where(ok, u_new, 0.5 * (lower_u + upper_u))
+
+        u = lax.fori_loop(0, 5, step, (lower_u, upper_u, u))[2]
+        x = jnp.where(p > 0, jnp.exp(u), 0)
+        return jnp.where(upper, 1 - x, x)
+
     def __repr__(self):
         """Return string representation."""
         return f"{self.__class__.__name__}(peakness={self.peakness})"
@@ -124,3 +209,9 @@ class Uniform(Distribution):
 
     def sample(self, nsamples: int, rngkey: Array) -> Array:
         return random.uniform(rngkey, shape=(nsamples, self.dim))
+
+    def cdf(self, x: Array) -> Array:
+        return jnp.clip(x, 0, 1)
+
+    def ppf(self, q: Array) -> Array:
+        return jnp.asarray(q)
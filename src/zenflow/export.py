@@ -0,0 +1,169 @@
+"""Export of trained flows for evaluation with NumPy only."""
+
+from typing import Any, Dict, List, Optional, Union
+import json
+import os
+
+import jax
+import numpy as np
+from flax import linen as nn
+from flax.typing import ArrayPytree
+
+from . import distributions
+from .bijectors import (
+    Bijector,
+    Chain,
+    NeuralSplineCoupling,
+    Roll,
+    RollingSplineCoupling,
+    ShiftBounds,
+    _index,
+    _range_from_stats,
+)
+from .flow import Flow
+from .numpy_flow import FORMAT_VERSION
+from .utils import squareplus
+
+__all__ = ["export"]
+
+_ACTIVATIONS = {
+    nn.swish: "swish",
+    nn.relu: "relu",
+    nn.tanh: "tanh",
+    nn.sigmoid: "sigmoid",
+    nn.softplus: "softplus",
+    nn.elu: "elu",
+    squareplus: "squareplus",
+}
+
+
+def export(
+    flow: Flow,
+    variables: ArrayPytree,
+    path: Union[str, os.PathLike],
+    *,
+    dim: Optional[int] = None,
+) -> None:
+    """
+    Save a trained flow for evaluation with zenflow.numpy_flow.NumpyFlow.
+
+    The file is a .npz archive, which contains the architecture as JSON and the
+    variables as arrays. Supported are chains of ShiftBounds, Roll,
+    NeuralSplineCoupling, and RollingSplineCoupling, and the latent distributions of
+    zenflow.distributions.
+
+    Parameters
+    ----------
+    flow : Flow
+        The flow.
+    variables : variables
+        Trained variables of the flow.
+    path : str or path-like
+        Output file.
+    dim : int or None, optional (default = None)
+        Dimension of the samples. If None, it is taken from the first ShiftBounds or
+        the latent distribution.
+
+    """
+    if flow.context is not None:
+        raise ValueError("flows with a context encoder are not supported")
+    bijectors = _flatten(flow.bijector, variables, "bijector")
+    if dim is None:
+        dim = _infer_dim(bijectors, flow.latent)
+    architecture: Dict[str, Any] = {
+        "format": FORMAT_VERSION,
+        "dim": dim,
+        "latent": _latent_spec(flow.latent),
+        "bijectors": [],
+    }
+    arrays = {}
+    for i, (bijector, params, stats) in enumerate(bijectors):
+        spec, bijector_arrays = _bijector_spec(bijector, params, stats, dim)
+        architecture["bijectors"].append(spec)
+        arrays.update({f"{i}/{k}": np.asarray(v) for k, v in bijector_arrays.items()})
+    np.savez(path, architecture=np.array(json.dumps(architecture)), **arrays)
+
+
+def _flatten(bijector: Bijector, variables: ArrayPytree, name: str) -> List:
+    # return list of (bijector, params, batch_stats) with nested chains resolved
+    params = variables.get("params", {}).get(name, {})
+    stats = variables.get("batch_stats", {}).get(name, {})
+    if isinstance(bijector, Chain):
+        result = []
+        for i, b in enumerate(bijector.bijectors):
+            sub = {"params": params, "batch_stats": stats}
+            # Chain keeps explicit names of bijectors, see rolling_spline_coupling
+            result += _flatten(b, sub, b.name or f"bijectors_{i}")
+        return result
+    if isinstance(bijector, RollingSplineCoupling):
+        # export the stacked couplings as the equivalent couplings in place
+        params, stats = params["coupling"], stats["coupling"]
+        dim = len(jax.tree_util.tree_leaves(params)[0])
+        return [
+            (coupling, _index(params, k), _index(stats, k))
+            for k, coupling in enumerate(bijector.couplings(dim))
+        ]
+    return [(bijector, params, stats)]
+
+
+def _infer_dim(bijectors: List, latent: distributions.Distribution) -> int:
+    for bijector, _, stats in bijectors:
+        if isinstance(bijector, ShiftBounds):
+            xmin, _ = _range_from_stats(stats, None)
+            return max([len(xmin)] + [i + 1 for i, _, _ in bijector.bounds])
+    if latent.dim is not None:
+        return latent.dim
+    raise ValueError("dim cannot be inferred, please pass it")
+
+
+def _latent_spec(latent: distributions.Distribution) -> Dict[str, Any]:
+    for name in ("Beta", "Normal", "TruncatedNormal", "Uniform"):
+        if type(latent) is getattr(distributions, name):
+            spec: Dict[str, Any] = {"type": name}
+            if name == "Beta":
+                spec["peakness"] = float(latent.peakness)
+            return spec
+    raise ValueError(f"unsupported latent distribution {latent!r}")
+
+
+def _bijector_spec(bijector: Bijector, params, stats, dim: int):
+    if isinstance(bijector, ShiftBounds):
+        xmin, xmax = (np.array(v, np.float32) for v in _range_from_stats(stats, dim))
+        # NaN marks dimensions without statistics
+        unknown = ~(np.isfinite(xmin) & np.isfinite(xmax))
+        xmin[unknown] = np.nan
+        xmax[unknown] = np.nan
+        bounds = [[i, _float(a), _float(b)] for i, a, b in bijector.bounds]
+        return {"type": "ShiftBounds", "bounds": bounds}, {"xmin": xmin, "xmax": xmax}
+    if isinstance(bijector, Roll):
+        return {"type": "Roll", "shift": bijector.shift}, {}
+    if isinstance(bijector, NeuralSplineCoupling):
+        act = _ACTIVATIONS.get(bijector.act)
+        if act is None:
+            raise ValueError(f"unsupported activation {bijector.act}")
+        spec = {
+            "type": "NeuralSplineCoupling",
+            "knots": bijector.knots,
+            "layers": list(bijector.layers),
+            "act": act,
+            "epsilon": nn.BatchNorm.epsilon,
+        }
+        if bijector.transformed is not None:
+            transformed, conditioning = bijector._indices(dim)
+            spec["transformed"] = [int(i) for i in transformed]
+            spec["conditioning"] = [int(i) for i in conditioning]
+        arrays = {
+            "norm/mean": stats["BatchNorm_0"]["mean"],
+            "norm/var": stats["BatchNorm_0"]["var"],
+            "norm/scale": params["BatchNorm_0"]["scale"],
+            "norm/bias": params["BatchNorm_0"]["bias"],
+        }
+        for i in range(len(bijector.layers) + 1):
+            arrays[f"dense_{i}/kernel"] = params[f"Dense_{i}"]["kernel"]
+            arrays[f"dense_{i}/bias"] = params[f"Dense_{i}"]["bias"]
+        return spec, arrays
+    raise ValueError(f"unsupported bijector {type(bijector).__name__}")
+
+
+def _float(x: Optional[float]) -> Optional[float]:
+    return None if x is None else float(x)
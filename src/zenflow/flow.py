@@ -1,23 +1,61 @@
 """The Flow class which implements a trainable conditional normalizing flow."""
 
-from typing import Union, Optional
-from flax.typing import Array
+from typing import Union, Optional, Sequence, Any, Tuple, Dict, TYPE_CHECKING
+import dataclasses
+import os
+from flax.typing import Array, ArrayPytree
 
 import jax.numpy as jnp
 import jax
+import numpy as np
 
 from .distributions import Distribution, Beta
-from .bijectors import Bijector, Chain
+from .bijectors import Bijector, Chain, ShiftBounds, _accepts, _mask_kwargs
 from flax import linen as nn
 
-__all__ = ["Flow"]
+if TYPE_CHECKING:
+    from .predictor import Predictor
+
+__all__ = ["Flow", "ensemble_log_prob"]
 
 
 class Flow(nn.Module):
-    """A conditional normalizing flow."""
+    """
+    A conditional normalizing flow.
+
+    If dtype is set, the conditioner networks of all bijectors which support it are
+    computed in this dtype, see NeuralSplineCoupling. The parameters, the spline
+    arithmetic, the log-determinants and the latent log-likelihood are still computed
+    in the input precision, typically float32. Using jnp.bfloat16 reduces the memory
+    bandwidth, with a small loss in accuracy of the log-likelihood.
+
+    If a context encoder is set, the conditional variables are passed through it once
+    and the bijectors receive the embedding instead of the conditional variables. This
+    saves computation if there are many conditional variables, since each coupling
+    normalizes and projects its conditional input separately. The encoder is trained
+    together with the flow. It is called with c, or with the elements of c if c is a
+    tuple, and with the keywords train and mask if its __call__ method accepts them. It
+    must return an array of shape (N, E), where N is the number of rows of the
+    conditions. The conditions can therefore be anything the encoder accepts, for
+    example sets of particles and a matrix which sums over the elements of each set,
+    which a deep set encodes into a fixed-size vector. Such tuples of conditions work
+    with the methods of Flow, but not with train() and compile(), which split and pad
+    the conditions along their first axis. Layers which need random numbers in
+    training mode, like Dropout, use the rng stream "dropout". train() provides it,
+    pass rngs={"dropout": key} to Flow.apply when training in another way.
+    """
 
     bijector: Bijector
     latent: Distribution = Beta()
+    dtype: Optional[Any] = None
+    context: Optional[nn.Module] = None
+
+    def __post_init__(self):
+        """Set the compute dtype of the bijectors if dtype is set."""
+        if self.dtype is not None:
+            # frozen dataclass, bijector is replaced before flax adopts it
+            object.__setattr__(self, "bijector", _with_dtype(self.bijector, self.dtype))
+        super().__post_init__()
 
     def __call__(
         self,
@@ -25,6 +63,7 @@ class Flow(nn.Module):
         c: Optional[Array] = None,
         *,
         train: bool = False,
+        mask: Optional[Array] = None,
     ) -> Array:
         """
         Return log-likelihood of the samples.
@@ -37,12 +76,17 @@ class Flow(nn.Module):
             so might accelerate convergence.
         c : Array of shape (N, K) or None
             N values from a K-dimensional vector of variables which determines the shape
-            of the D-dimensional distribution.
+            of the D-dimensional distribution. If a context encoder is set, this is its
+            input, see Flow.
         train : bool, optional (default = False)
             Whether to run in training mode (update BatchNorm statistics, etc.).
+        mask : Array of shape (N,) or None, optional (default = None)
+            If set, only samples where the mask is True contribute to the statistics
+            which are updated in training mode. This is used to pad batches.
 
         """
-        x, log_det = self.bijector(x, _normalize_c(c), train)
+        c = self._encode(c, train, mask)
+        x, log_det = self.bijector(x, c, train, **_mask_kwargs(self.bijector, mask))
         log_prob = self.latent.log_prob(x) + log_det
         log_prob = jnp.nan_to_num(log_prob, nan=-jnp.inf)
         return log_prob
@@ -71,17 +115,218 @@ class Flow(nn.Module):
             size = conditions_or_size
             c = None
         else:
-            size = conditions_or_size.shape[0]
-            c = _normalize_c(conditions_or_size)
+            c = self._encode(conditions_or_size)
+            size = c.shape[0]
         x = self.latent.sample(size, jax.random.PRNGKey(seed))
         x = self.bijector.inverse(x, c)
         return x
 
+    def sample_per_condition(
+        self,
+        conditions: Array,
+        size: int,
+        *,
+        seed: int = 0,
+    ) -> Array:
+        """
+        Return samples from the learned distribution for each condition.
+
+        This is equivalent to calling sample with each condition repeated size times,
+        but the repeated conditions are not created in memory and the part of the
+        conditioner networks which only depends on the conditions is computed once per
+        condition.
+
+        Parameters
+        ----------
+        conditions: Array of shape (M, K)
+            M vectors of conditional variables.
+        size: int
+            Number of samples to generate for each condition.
+        seed: int (default = 0)
+            Seed to use for generating samples.
+
+        Returns
+        -------
+        Array of shape (M, size, D)
+            Samples, the first axis corresponds to the conditions.
+
+        """
+        c = self._encode(conditions)
+        x = self.latent.sample(c.shape[0] * size, jax.random.PRNGKey(seed))
+        x = self.bijector.inverse(x, c)
+        return x.reshape(c.shape[0], size, -1)
+
+    def sample_and_log_prob(
+        self,
+        conditions_or_size: Union[Array, int],
+        *,
+        seed: int = 0,
+    ) -> Tuple[Array, Array]:
+        """
+        Return samples from the learned distribution and their log-likelihood.
+
+        The samples are the same as those returned by sample. The log-likelihood is
+        computed in the same pass, which is about twice as fast as calling sample and
+        then computing the log-likelihood of the samples.
+
+        Parameters
+        ----------
+        conditions_or_size: Array of shape (N, K) or int
+            Conditional variables or number of samples, see sample.
+        seed: int (default = 0)
+            Seed to use for generating samples.
+
+        Returns
+        -------
+        x : Array of shape (N, D)
+            Samples.
+        log_prob : Array of shape (N,)
+            Log-likelihood of the samples.
+
+        """
+        if isinstance(conditions_or_size, int):
+            size = conditions_or_size
+            c = None
+        else:
+            c = self._encode(conditions_or_size)
+            size = c.shape[0]
+        z = self.latent.sample(size, jax.random.PRNGKey(seed))
+        x, log_det = self.bijector.inverse_and_log_det(z, c)
+        log_prob = self.latent.log_prob(z) + log_det
+        log_prob = jnp.nan_to_num(log_prob, nan=-jnp.inf)
+        return x, log_prob
+
+    def cdf(self, x: Array, c: Optional[Array] = None) -> Array:
+        """
+        Return cumulative distribution function of a one-dimensional flow.
+
+        The transform of a one-dimensional flow is monotonic, so that the cdf is the
+        cdf of the latent distribution at the transformed samples. It is exact up to
+        round-off and computed in a single vectorized pass. Use this with a bijector
+        from elementwise_spline.
+
+        Parameters
+        ----------
+        x : Array of shape (N,) or (N, 1)
+            Samples.
+        c : Array of shape (N, K) or None
+            Conditional variables.
+
+        Returns
+        -------
+        Array of shape (N,)
+            Probabilities to observe a smaller value than the samples.
+
+        """
+        z, _ = self.bijector(_as_column(x), self._encode(c), False)
+        p = self.latent.cdf(z[:, 0])
+        return 1 - p if _is_decreasing(self.bijector) else p
+
+    def ppf(self, q: Array, c: Optional[Array] = None) -> Array:
+        """
+        Return quantile function of a one-dimensional flow, the inverse of cdf.
+
+        Requires a latent distribution which implements ppf, see cdf for details.
+
+        Parameters
+        ----------
+        q : Array of shape (N,) or (N, 1)
+            Probabilities.
+        c : Array of shape (N, K) or None
+            Conditional variables.
+
+        Returns
+        -------
+        Array of shape (N,)
+            Quantiles.
+
+        """
+        q = _as_column(q)
+        if _is_decreasing(self.bijector):
+            q = 1 - q
+        x = self.bijector.inverse(self.latent.ppf(q), self._encode(c))
+        return x[:, 0]
+
+    @nn.nowrap
+    def compile(
+        self,
+        variables: ArrayPytree,
+        *,
+        min_bucket: int = 64,
+        max_bucket: int = 2**16,
+        dtype: Any = jnp.float32,
+    ) -> "Predictor":
+        """
+        Return predictor with compiled log_prob, sample and transform methods.
+
+        Inputs are padded to the next power of two between min_bucket and max_bucket,
+        so that calls with arbitrary batch sizes reuse a small number of compiled
+        programs. See Predictor for details.
+
+        Parameters
+        ----------
+        variables : variables
+            Trained variables of the flow.
+        min_bucket : int, optional (default = 64)
+            Smallest batch size for which a program is compiled.
+        max_bucket : int, optional (default = 2**16)
+            Largest batch size for which a program is compiled. Larger inputs are
+            processed in chunks.
+        dtype : dtype, optional (default = float32)
+            Inputs are converted to this type.
+
+        """
+        from .predictor import Predictor
+
+        return Predictor(
+            self, variables, min_bucket=min_bucket, max_bucket=max_bucket, dtype=dtype
+        )
+
+    @nn.nowrap
+    def export(
+        self,
+        variables: ArrayPytree,
+        path: Union[str, os.PathLike],
+        *,
+        dim: Optional[int] = None,
+    ) -> None:
+        """
+        Save trained flow for evaluation with NumPy only.
+
+        Load the file with zenflow.numpy_flow.NumpyFlow.load, which does not import
+        JAX. See zenflow.export.export for details.
+
+        Parameters
+        ----------
+        variables : variables
+            Trained variables of the flow.
+        path : str or path-like
+            Output file.
+        dim : int or None, optional (default = None)
+            Dimension of the samples. If None, it is inferred.
+
+        """
+        from .export import export
+
+        export(self, variables, path, dim=dim)
+
+    def _encode(
+        self, c: Any, train: bool = False, mask: Optional[Array] = None
+    ) -> Optional[Array]:
+        # return input of the bijectors, the embedding of c if there is an encoder
+        if c is not None and self.context is not None:
+            args = c if isinstance(c, tuple) else (c,)
+            kwargs: Dict[str, Any] = _mask_kwargs(self.context, mask)
+            if _accepts(self.context, "train"):
+                kwargs["train"] = train
+            c = self.context(*args, **kwargs)
+        return _normalize_c(c)
+
     def _steps(self, x, c: Optional[Array] = None, *, inverse: bool = False):
         if not isinstance(self.bijector, Chain):
             raise ValueError("only for Chain bijector")
 
-        c = _normalize_c(c)
+        c = self._encode(c)
 
         results = []
         if inverse:
@@ -95,6 +340,71 @@ class Flow(nn.Module):
         return results
 
 
+def ensemble_log_prob(
+    flow: Flow,
+    variables: Sequence[ArrayPytree],
+    x: Array,
+    c: Optional[Array] = None,
+) -> Array:
+    """
+    Return log-likelihood of the samples under an ensemble of flows.
+
+    The density of the ensemble is the average of the densities of the members. All
+    members are evaluated together in a single vectorized pass.
+
+    Parameters
+    ----------
+    flow : Flow
+        The flow which is shared by all members.
+    variables : sequence of variables
+        Variables of each member, for example the first result of train_ensemble().
+    x : Array of shape (N, D)
+        Samples.
+    c : Array of shape (N, K) or None
+        Conditional variables.
+
+    Returns
+    -------
+    log_prob : Array of shape (N,)
+        Log-likelihood of the samples.
+
+    """
+    stacked = jax.tree_util.tree_map(lambda *v: jnp.stack(v), *variables)
+    log_prob = jax.vmap(lambda v: flow.apply(v, x, c))(stacked)
+    return jax.nn.logsumexp(log_prob, axis=0) - jnp.log(len(variables))
+
+
+def _with_dtype(bijector: Bijector, dtype: Any) -> Bijector:
+    if isinstance(bijector, Chain):
+        return bijector.clone(
+            bijectors=[_with_dtype(b, dtype) for b in bijector.bijectors]
+        )
+    if any(f.name == "dtype" for f in dataclasses.fields(bijector)):
+        return bijector.clone(dtype=dtype)
+    return bijector
+
+
+def _as_column(x: Array) -> Array:
+    x = jnp.asarray(x)
+    if x.ndim == 1:
+        x = x.reshape(-1, 1)
+    if x.ndim != 2 or x.shape[1] != 1:
+        raise ValueError("only one-dimensional flows are supported")
+    return x
+
+
+def _is_decreasing(bijector: Bijector) -> bool:
+    # ShiftBounds reverses the order of values which only have an upper bound, the
+    # other bijectors preserve the order
+    if isinstance(bijector, Chain):
+        return sum(map(_is_decreasing, bijector.bijectors)) % 2 == 1
+    if isinstance(bijector, ShiftBounds):
+        for i, a, b in bijector.bounds:
+            if i == 0 and b is not None and np.isfinite(b):
+                return a is None or not np.isfinite(a)
+    return False
+
+
 def _normalize_c(c: Optional[Array]):
     if c is not None and c.ndim == 1:
         c = c.reshape(-1, 1)
@@ -0,0 +1,389 @@
+"""
+Evaluate exported flows with NumPy only.
+
+This module does not import JAX, flax, or optax. It loads flows which were saved with
+Flow.export, for lightweight consumers that only need to evaluate a trained density.
+"""
+
+from typing import Any, Dict, List, Optional, Tuple, Union
+import json
+import math
+import os
+
+import numpy as np
+from numpy.typing import ArrayLike
+
+__all__ = ["NumpyFlow"]
+
+FORMAT_VERSION = 2
+
+EPS = 1e-5
+
+
+class NumpyFlow:
+    """
+    Trained flow evaluated with NumPy.
+
+    The results agree with those of the Flow up to round-off. Conditioner networks
+    which were trained with a lower compute dtype are evaluated in the precision of
+    the input, which is at least float32. Samples are drawn with a NumPy random
+    generator, so they differ from those of Flow.sample for the same seed.
+
+    Use NumpyFlow.load to load a flow saved with Flow.export.
+    """
+
+    def __init__(self, architecture: Dict[str, Any], arrays: Dict[str, np.ndarray]):
+        # version 2 added index sets to couplings, files of version 1 are still valid
+        if architecture["format"] not in (1, FORMAT_VERSION):
+            raise ValueError(f"unsupported format {architecture['format']}")
+        self.dim: int = architecture["dim"]
+        self.latent = _Latent(architecture["latent"])
+        self.bijectors: List[Any] = []
+        for i, spec in enumerate(architecture["bijectors"]):
+            kind = _BIJECTORS.get(spec["type"])
+            if kind is None:
+                raise ValueError(f"unsupported bijector {spec['type']}")
+            prefix = f"{i}/"
+            params = {
+                k[len(prefix) :]: v for k, v in arrays.items() if k.startswith(prefix)
+            }
+            self.bijectors.append(kind(spec, params))
+
+    @classmethod
+    def load(cls, path: Union[str, os.PathLike]) -> "NumpyFlow":
+        """Load flow saved with Flow.export."""
+        with np.load(path, allow_pickle=False) as f:
+            arrays = {k: f[k] for k in f.files}
+        architecture = json.loads(str(arrays.pop("architecture")))
+        return cls(architecture, arrays)
+
+    def log_prob(self, x: ArrayLike, c: Optional[ArrayLike] = None) -> np.ndarray:
+        """Return log-likelihood of the samples, see Flow.__call__."""
+        z, log_det = self.transform(x, c)
+        with np.errstate(invalid="ignore"):
+            log_prob = self.latent.log_prob(z) + log_det
+        return np.nan_to_num(log_prob, nan=-np.inf, posinf=np.inf, neginf=-np.inf)
+
+    def transform(
+        self, x: ArrayLike, c: Optional[ArrayLike] = None
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Transform samples to the latent space.
+
+        Parameters
+        ----------
+        x : array-like of shape (N, D)
+            Samples.
+        c : array-like of shape (N, K) or None, optional (default is None)
+            Conditional variables.
+
+        Returns
+        -------
+        z : ndarray of shape (N, D)
+            Transformed samples.
+        log_det : ndarray of shape (N,)
+            Logarithm of the determinant of the transformation.
+
+        """
+        x = _as_float(x)
+        c = _normalize_c(c, x.dtype)
+        log_det = np.zeros(len(x), x.dtype)
+        for bijector in self.bijectors:
+            x, ld = bijector.forward(x, c)
+            log_det += ld
+        return x, log_det
+
+    def inverse(self, z: ArrayLike, c: Optional[ArrayLike] = None) -> np.ndarray:
+        """Transform samples from the latent space to the target space."""
+        z = _as_float(z)
+        c = _normalize_c(c, z.dtype)
+        for bijector in self.bijectors[::-1]:
+            z = bijector.inverse(z, c)
+        return z
+
+    def sample(
+        self, conditions_or_size: Union[ArrayLike, int], *, seed: int = 0
+    ) -> np.ndarray:
+        """Return samples from the learned distribution, see Flow.sample."""
+        if isinstance(conditions_or_size, int):
+            size, c = conditions_or_size, None
+        else:
+            c = np.asarray(conditions_or_size)
+            size = len(c)
+        rng = np.random.default_rng(seed)
+        z = self.latent.sample(rng, size, self.dim).astype(np.float32)
+        return self.inverse(z, c)
+
+
+class _ShiftBounds:
+    def __init__(self, spec: Dict[str, Any], params: Dict[str, np.ndarray]):
+        xmin = params["xmin"]
+        xmax = params["xmax"]
+        has_lower = np.zeros(len(xmin), dtype=bool)
+        has_upper = np.zeros(len(xmin), dtype=bool)
+        a = np.zeros_like(xmin)
+        b = np.zeros_like(xmin)
+        for i, ai, bi in spec["bounds"]:
+            if _is_set(ai):
+                has_lower[i] = True
+                a[i] = ai
+            if _is_set(bi):
+                has_upper[i] = True
+                b[i] = bi
+        self.both = has_lower & has_upper
+        self.lower_only = has_lower & ~has_upper
+        self.upper_only = has_upper & ~has_lower
+        self.one_sided = self.lower_only | self.upper_only
+        self.a = a
+        self.b = b
+        # known bounds replace the statistics
+        self.xmin = np.where(self.both, a, xmin)
+        self.xmax = np.where(self.both, b, xmax)
+
+    def forward(self, x: np.ndarray, c) -> Tuple[np.ndarray, np.ndarray]:
+        # values with one bound are log-transformed to make them unbounded
+        t = np.where(
+            self.lower_only, x - self.a, np.where(self.upper_only, self.b - x, x)
+        )
+        t = np.where(self.one_sided, _safe_log(np.where(self.one_sided, t, 1)), t)
+        mul = 1 / (self.xmax - self.xmin)
+        z = (t - self.xmin) * mul
+        z = np.where(self.both, z, np.clip(z, 0, 1))
+        log_det = np.sum(np.log(mul)) - np.sum(np.where(self.one_sided, t, 0), axis=1)
+        return z.astype(x.dtype, copy=False), log_det.astype(x.dtype, copy=False)
+
+    def inverse(self, z: np.ndarray, c) -> np.ndarray:
+        t = z * self.xmax + (1 - z) * self.xmin
+        e = np.exp(np.where(self.one_sided, t, 0))
+        x = np.where(
+            self.lower_only, e + self.a, np.where(self.upper_only, self.b - e, t)
+        )
+        return x.astype(z.dtype, copy=False)
+
+
+class _Roll:
+    def __init__(self, spec: Dict[str, Any], params: Dict[str, np.ndarray]):
+        self.shift = spec["shift"]
+
+    def forward(self, x: np.ndarray, c) -> Tuple[np.ndarray, np.ndarray]:
+        return np.roll(x, self.shift, axis=-1), np.zeros(len(x), x.dtype)
+
+    def inverse(self, z: np.ndarray, c) -> np.ndarray:
+        return np.roll(z, -self.shift, axis=-1)
+
+
+class _NeuralSplineCoupling:
+    def __init__(self, spec: Dict[str, Any], params: Dict[str, np.ndarray]):
+        self.knots = spec["knots"]
+        self.act = _ACTIVATIONS[spec["act"]]
+        self.epsilon = spec["epsilon"]
+        self.transformed = spec.get("transformed")
+        self.conditioning = spec.get("conditioning")
+        self.norm = [params[f"norm/{k}"] for k in ("mean", "var", "scale", "bias")]
+        self.dense = [
+            (params[f"dense_{i}/kernel"], params[f"dense_{i}/bias"])
+            for i in range(len(spec["layers"]) + 1)
+        ]
+
+    def _spline_params(self, x: np.ndarray, c: Optional[np.ndarray]):
+        if self.transformed is None:
+            split = x.shape[1] // 2
+            xt, xc = x[:, :split], x[:, split:]
+        else:
+            xt, xc = x[:, self.transformed], x[:, self.conditioning]
+        if c is None:
+            h = xc
+        else:
+            # see Bijector for conditions with fewer rows than samples
+            c = np.repeat(c, len(xc) // len(c), axis=0)
+            h = np.hstack((xc, c))
+        mean, var, scale, bias = self.norm
+        h = (h - mean) * (scale / np.sqrt(var + self.epsilon)) + bias
+        for i, (kernel, bias) in enumerate(self.dense):
+            if i > 0:
+                h = self.act(h)
+            h = h @ kernel + bias
+        h = h.reshape(len(xt), xt.shape[1], -1).astype(xt.dtype)
+        k = self.knots
+        return (
+            xt,
+            xc,
+            *_normalize_spline_params(h[..., :k], h[..., k : 2 * k], h[..., 2 * k :]),
+        )
+
+    def forward(self, x: np.ndarray, c) -> Tuple[np.ndarray, np.ndarray]:
+        xt, xc, dx, dy, sl = self._spline_params(x, c)
+        yt, log_det = _spline_forward(xt, dx, dy, sl)
+        return self._merge(x, yt, xc), log_det
+
+    def inverse(self, y: np.ndarray, c) -> np.ndarray:
+        yt, yc, dx, dy, sl = self._spline_params(y, c)
+        return self._merge(y, _spline_inverse(yt, dx, dy, sl), yc)
+
+    def _merge(self, x: np.ndarray, yt: np.ndarray, xc: np.ndarray) -> np.ndarray:
+        if self.transformed is None:
+            return np.hstack((yt, xc))
+        y = x.copy()
+        y[:, self.transformed] = yt
+        return y
+
+
+_BIJECTORS = {
+    "ShiftBounds": _ShiftBounds,
+    "Roll": _Roll,
+    "NeuralSplineCoupling": _NeuralSplineCoupling,
+}
+
+
+def _sigmoid(x: np.ndarray) -> np.ndarray:
+    return 0.5 * (1 + np.tanh(0.5 * x))
+
+
+def _squareplus(x: np.ndarray, b: float = 4) -> np.ndarray:
+    return 0.5 * (x + np.sqrt(np.square(x) + b))
+
+
+_ACTIVATIONS = {
+    "swish": lambda x: x * _sigmoid(x),
+    "relu": lambda x: np.maximum(x, 0),
+    "tanh": np.tanh,
+    "sigmoid": _sigmoid,
+    "softplus": lambda x: np.logaddexp(x, 0),
+    "elu": lambda x: np.where(x > 0, x, np.expm1(np.minimum(x, 0))),
+    "squareplus": _squareplus,
+}
+
+
+class _Latent:
+    # latent distributions of zenflow.distributions
+
+    def __init__(self, spec: Dict[str, Any]):
+        self.type = spec["type"]
+        if self.type not in ("Beta", "Normal", "TruncatedNormal", "Uniform"):
+            raise ValueError(f"unsupported latent distribution {self.type}")
+        self.peakness = spec.get("peakness")
+
+    def log_prob(self, z: np.ndarray) -> np.ndarray:
+        inside = (z >= 0) & (z <= 1)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            if self.type == "Beta":
+                p = self.peakness
+                lp = -(2 * math.lgamma(p) - math.lgamma(2 * p))
+                if p != 1:
+                    lp = lp + (p - 1) * (np.log(z) + np.log1p(-z))
+                lp = np.where(inside, lp, -np.inf)
+            elif self.type == "Uniform":
+                lp = np.where(inside, 0.0, -np.inf)
+            else:
+                t = (z - 0.5) / 0.1
+                lp = -0.5 * t**2 - math.log(0.1 * math.sqrt(2 * math.pi))
+                if self.type == "TruncatedNormal":
+                    lp = np.where(
+                        inside, lp - math.log(math.erf(5 / math.sqrt(2))), -np.inf
+                    )
+        return np.sum(lp, axis=-1).astype(z.dtype)
+
+    def sample(self, rng: np.random.Generator, size: int, dim: int) -> np.ndarray:
+        shape = (size, dim)
+        if self.type == "Beta":
+            return rng.beta(self.peakness, self.peakness, size=shape)
+        if self.type == "Uniform":
+            return rng.uniform(size=shape)
+        z = rng.normal(0.5, 0.1, size=shape)
+        if self.type == "TruncatedNormal":
+            while True:
+                outside = (z < 0) | (z > 1)
+                n = np.count_nonzero(outside)
+                if n == 0:
+                    break
+                z[outside] = rng.normal(0.5, 0.1, size=n)
+        return z
+
+
+def _normalize_spline_params(dx: np.ndarray, dy: np.ndarray, sl: np.ndarray):
+    # see zenflow.utils.normalize_spline_params
+    def softmax_with_threshold(x, threshold):
+        x = _squareplus(x)
+        n = x.shape[-1]
+        c = threshold / (1 - n * threshold)
+        return (x / np.sum(x, axis=-1)[..., None] + c) / (1 + c * n)
+
+    return (
+        softmax_with_threshold(dx, EPS),
+        softmax_with_threshold(dy, EPS),
+        _squareplus(sl),
+    )
+
+
+def _spline_forward(x, dx, dy, slope):
+    # see zenflow.utils.rational_quadratic_spline_forward
+    xk, yk, dxk, dyk, dk, dkp1, sk, out_of_bounds = _spline_bins(x, dx, dy, slope, True)
+    z = np.clip((x - xk) / dxk, EPS, 1 - EPS)
+    az = 1 - z
+    num = dyk * z * (sk * z + dk * az)
+    den = sk + (dkp1 + dk - 2 * sk) * z * az
+    y = np.where(out_of_bounds, x, yk + num / (den + EPS))
+    num = z * (dkp1 * z + 2 * sk * az) + dk * az**2
+    log_det = 2 * np.log(sk + EPS) + np.log(num + EPS) - 2 * np.log(den + EPS)
+    return y, np.where(out_of_bounds, 0, log_det).sum(axis=1)
+
+
+def _spline_inverse(y, dx, dy, slope):
+    # see zenflow.utils.rational_quadratic_spline_inverse
+    xk, yk, dxk, dyk, dk, dkp1, sk, out_of_bounds = _spline_bins(
+        y, dx, dy, slope, False
+    )
+    a = dyk * (sk - dk) + (y - yk) * (dkp1 + dk - 2 * sk)
+    b = dyk * dk - (y - yk) * (dkp1 + dk - 2 * sk)
+    c = -sk * (y - yk)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        z = 2 * c / (-b - np.sqrt(b**2 - 4 * a * c))
+    return np.where(out_of_bounds, y, z * dxk + xk)
+
+
+def _spline_bins(x, dx, dy, slope, forward):
+    # spline parameters of the bin of each input
+    pad = [(0, 0)] * (dx.ndim - 1)
+    xk = np.pad(np.cumsum(dx, axis=-1), pad + [(1, 0)])
+    yk = np.pad(np.cumsum(dy, axis=-1), pad + [(1, 0)])
+    dk = np.pad(slope, pad + [(1, 1)], constant_values=1)
+    sk = dy / dx
+    knots = xk if forward else yk
+    out_of_bounds = (x < 0) | (x >= 1)
+    idx = np.sum(knots <= x[..., None], axis=-1)[..., None] - 1
+    idx = np.clip(idx, 0, knots.shape[-1] - 1)
+
+    def take(a, i):
+        return np.take_along_axis(a, i, -1)[..., 0]
+
+    return (
+        take(xk, idx),
+        take(yk, idx),
+        take(dx, idx),
+        take(dy, idx),
+        take(dk, idx),
+        take(dk, idx + 1),
+        take(sk, idx),
+        out_of_bounds,
+    )
+
+
+def _as_float(x: ArrayLike) -> np.ndarray:
+    x = np.asarray(x)
+    return x.astype(np.result_type(x.dtype, np.float32))
+
+
+def _normalize_c(c: Optional[ArrayLike], dtype) -> Optional[np.ndarray]:
+    if c is None:
+        return None
+    c = np.asarray(c, dtype=dtype)
+    return c.reshape(-1, 1) if c.ndim == 1 else c
+
+
+def _is_set(x: Optional[float]) -> bool:
+    return x is not None and math.isfinite(x)
+
+
+def _safe_log(x: np.ndarray) -> np.ndarray:
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.log(x + np.finfo(x.dtype).smallest_normal)
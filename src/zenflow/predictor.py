@@ -0,0 +1,263 @@
+"""Compiled inference for trained flows with shape buckets."""
+
+from typing import Any, Callable, Iterator, List, Optional, Union
+import os
+import jax
+import jax.numpy as jnp
+import numpy as np
+from flax import linen as nn
+from flax.typing import Array, ArrayPytree
+
+__all__ = ["Predictor"]
+
+
+class Predictor:
+    """
+    Trained flow with compiled log_prob, sample and transform.
+
+    The variables are bound once and moved to the device. Inputs are padded to the next
+    power of two between min_bucket and max_bucket, so that requests of arbitrary size
+    reuse a few compiled programs, one per bucket. Requests larger than max_bucket are
+    processed in chunks of max_bucket. Padded entries are removed from the results.
+    Conditions must be arrays with one row per sample, tuples of arrays for a context
+    encoder are not supported, since they cannot be padded.
+
+    Create instances with Flow.compile.
+    """
+
+    def __init__(
+        self,
+        flow: nn.Module,
+        variables: ArrayPytree,
+        *,
+        min_bucket: int = 64,
+        max_bucket: int = 2**16,
+        dtype: Any = jnp.float32,
+    ):
+        if min_bucket < 1 or max_bucket < min_bucket:
+            raise ValueError("buckets must satisfy 1 <= min_bucket <= max_bucket")
+        self.flow = flow
+        self.variables = jax.device_put(variables)
+        self.min_bucket = _next_power_of_two(min_bucket)
+        self.max_bucket = _next_power_of_two(max_bucket)
+        self.dtype = dtype
+
+        def log_prob(variables, x, c):
+            return flow.apply(variables, x, c)
+
+        def transform(variables, x, c):
+            return flow.apply(variables, x, c, method=_transform)
+
+        def sample(variables, c, size, seed, offset):
+            return flow.apply(variables, c, size, seed, offset, method=_sample)
+
+        self._log_prob = jax.jit(log_prob)
+        self._transform = jax.jit(transform)
+        self._sample = jax.jit(sample, static_argnums=2)
+
+    def log_prob(self, x: Array, c: Optional[Array] = None) -> Array:
+        """Return log-likelihood of the samples, see Flow.__call__."""
+        return self._map(self._log_prob, x, c)
+
+    def transform(self, x: Array, c: Optional[Array] = None) -> Array:
+        """
+        Transform samples to the latent space.
+
+        Parameters
+        ----------
+        x : Array of shape (N, D)
+            Samples.
+        c : Array of shape (N, K) or None, optional (default is None)
+            Conditional variables.
+
+        Returns
+        -------
+        Array of shape (N, D)
+            Transformed samples.
+
+        """
+        return self._map(self._transform, x, c)
+
+    def sample(
+        self, conditions_or_size: Union[Array, int], *, seed: int = 0, offset: int = 0
+    ) -> Array:
+        """
+        Return samples from the learned distribution, see Flow.sample.
+
+        The random numbers of the i-th sample are generated from a key derived from
+        the seed and offset + i. The samples are therefore reproducible for a given
+        seed and do not depend on the bucket, the chunking, or the block size of
+        sample_blocks, but they are not identical to those of Flow.sample. Calls with
+        the same seed and non-overlapping ranges of offset + i draw independent
+        samples.
+        """
+        c, n_total = _conditions_or_size(conditions_or_size, offset)
+        results = []
+        for a in range(0, max(n_total, 1), self.max_bucket):
+            n = min(self.max_bucket, n_total - a)
+            block = self._sample_block(c, a, n, self._bucket(n), seed, offset)
+            results.append(block[:n])
+        return _concatenate(results)
+
+    def sample_blocks(
+        self,
+        conditions_or_size: Union[Array, int],
+        *,
+        block_size: int = 2**16,
+        seed: int = 0,
+    ) -> Iterator[np.ndarray]:
+        """
+        Yield samples from the learned distribution in blocks.
+
+        This allows one to draw more samples than fit into memory. The next block is
+        computed on the device while the current block is processed by the caller. The
+        concatenated blocks are equal to the result of sample for the same seed,
+        independent of the block size, up to round-off.
+
+        Parameters
+        ----------
+        conditions_or_size: Array of shape (N, K) or int
+            Conditional variables, one vector per sample, or the number of samples for
+            unconditional flows. The conditional variables may be a memory-mapped
+            array, only one block is read at a time.
+        block_size : int, optional (default = 2**16)
+            Number of samples per block. The last block may be shorter.
+        seed : int, optional (default = 0)
+            Seed to use for generating samples.
+
+        Yields
+        ------
+        ndarray of shape (M, D)
+            Block of M samples, where M is at most block_size.
+
+        """
+        if block_size < 1:
+            raise ValueError("block_size must be positive")
+        c, n_total = _conditions_or_size(conditions_or_size)
+        # one program for all blocks, smaller if there is only one block
+        size = min(block_size, _next_power_of_two(n_total))
+        pending = None
+        for a in range(0, n_total, block_size):
+            n = min(block_size, n_total - a)
+            block = self._sample_block(c, a, n, size, seed)
+            # start the transfer to the host, it runs when the block is ready
+            block.copy_to_host_async()
+            if pending is not None:
+                yield np.asarray(pending[0])[: pending[1]]
+            pending = block, n
+        if pending is not None:
+            yield np.asarray(pending[0])[: pending[1]]
+
+    def sample_to_file(
+        self,
+        path: Union[str, os.PathLike],
+        conditions_or_size: Union[Array, int],
+        *,
+        block_size: int = 2**16,
+        seed: int = 0,
+    ) -> np.ndarray:
+        """
+        Write samples to a .npy file block by block and return it memory-mapped.
+
+        The samples are the same as those of sample_blocks. See sample_blocks for the
+        parameters. The memory needed is bounded by the block size.
+        """
+        blocks = self.sample_blocks(
+            conditions_or_size, block_size=block_size, seed=seed
+        )
+        first = next(blocks, None)
+        if first is None:
+            raise ValueError("number of samples must be positive")
+        _, n_total = _conditions_or_size(conditions_or_size)
+        out = np.lib.format.open_memmap(
+            path, mode="w+", dtype=first.dtype, shape=(n_total,) + first.shape[1:]
+        )
+        out[: len(first)] = first
+        a = len(first)
+        for block in blocks:
+            out[a : a + len(block)] = block
+            a += len(block)
+        out.flush()
+        del out
+        return np.load(path, mmap_mode="r")
+
+    def _sample_block(
+        self, c: Optional[Array], a: int, n: int, size: int, seed: int, offset: int = 0
+    ) -> Array:
+        # samples a to a + n, padded to size
+        ci = None if c is None else _pad(c[a : a + n], size, self.dtype)
+        return self._sample(
+            self.variables, ci, size, np.uint32(seed), np.uint32(offset + a)
+        )
+
+    def _map(self, fn: Callable, x: Array, c: Optional[Array]) -> Array:
+        # apply fn to chunks of at most max_bucket samples padded to their bucket
+        _check_conditions(c)
+        results = []
+        for a in range(0, max(len(x), 1), self.max_bucket):
+            xi = x[a : a + self.max_bucket]
+            n = len(xi)
+            size = self._bucket(n)
+            xi = _pad(xi, size, self.dtype)
+            ci = (
+                None
+                if c is None
+                else _pad(c[a : a + self.max_bucket], size, self.dtype)
+            )
+            results.append(fn(self.variables, xi, ci)[:n])
+        return _concatenate(results)
+
+    def _bucket(self, n: int) -> int:
+        return min(max(_next_power_of_two(n), self.min_bucket), self.max_bucket)
+
+
+def _transform(flow, x, c):
+    return flow.bijector(x, flow._encode(c), False)[0]
+
+
+def _sample(flow, c, size, seed, offset):
+    # each sample has its own key which depends on its index, so that samples do not
+    # depend on how a request is split into blocks
+    key = jax.random.PRNGKey(seed)
+    rows = offset + jnp.arange(size, dtype=jnp.uint32)
+    keys = jax.vmap(jax.random.fold_in, in_axes=(None, 0))(key, rows)
+    x = jax.vmap(lambda k: flow.latent.sample(1, k)[0])(keys)
+    return flow.bijector.inverse(x, flow._encode(c))
+
+
+def _conditions_or_size(conditions_or_size: Union[Array, int], offset: int = 0):
+    if isinstance(conditions_or_size, int):
+        c, n = None, conditions_or_size
+    else:
+        _check_conditions(conditions_or_size)
+        c, n = conditions_or_size, len(conditions_or_size)
+    if offset < 0 or offset + n >= 2**32:
+        raise ValueError("offset + number of samples must be in [0, 2**32)")
+    return c, n
+
+
+def _check_conditions(c: Any) -> None:
+    # conditions are padded and split along their first axis, which is not possible
+    # for tuples like the elements of sets and the matrix which sums over them
+    if isinstance(c, tuple):
+        msg = "Predictor does not support tuples as conditions, use Flow.apply"
+        raise ValueError(msg)
+
+
+def _next_power_of_two(n: int) -> int:
+    return 1 << max(n - 1, 0).bit_length()
+
+
+def _pad(a: Array, size: int, dtype: Any) -> Array:
+    # pad first axis by repeating the last entry, to keep padded entries finite
+    xp = jnp if isinstance(a, jax.Array) else np
+    a = xp.asarray(a, dtype=dtype)
+    if len(a) == size:
+        return a
+    if len(a) == 0:
+        return xp.zeros((size,) + a.shape[1:], dtype)
+    return xp.pad(a, [(0, size - len(a))] + [(0, 0)] * (a.ndim - 1), mode="edge")
+
+
+def _concatenate(results: List[Array]) -> Array:
+    return results[0] if len(results) == 1 else jnp.concatenate(results)
@@ -0,0 +1,341 @@
+"""Inference service which batches concurrent requests to a trained flow."""
+
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional, Tuple, Union
+import json
+import numbers
+import queue
+import threading
+import time
+
+import numpy as np
+from numpy.typing import ArrayLike
+
+from .predictor import Predictor
+
+__all__ = ["InferenceServer", "serve_http"]
+
+
+class _Request:
+    # one call of log_prob or sample, waiting to be batched
+
+    def __init__(self, kind: str, x: Optional[np.ndarray], c: Optional[np.ndarray]):
+        self.kind = kind
+        self.x = x
+        self.c = c
+        self.future: Future = Future()
+        # computed here, so that the worker thread does not fail on bad input
+        if kind == "log_prob":
+            self.rows = len(x)
+        else:
+            # for unconditional samples, x is the number of samples
+            self.rows = int(x) if c is None else len(c)
+
+    @property
+    def key(self) -> Tuple:
+        # requests with the same key can be concatenated
+        shape = None if self.kind == "sample" else self.x.shape[1:]
+        return self.kind, shape, None if self.c is None else self.c.shape[1:]
+
+
+class InferenceServer:
+    """
+    Service which coalesces concurrent requests into batches.
+
+    Many small requests from different threads each pay the overhead of dispatching a
+    compiled program. The server collects requests in a queue and a worker thread
+    concatenates them into batches, which are computed with a Predictor, and passes
+    the results back to the callers. A batch is started when it contains at least
+    max_batch_size samples or when max_delay seconds have passed since the first
+    request of the batch arrived. Larger requests are not split, they form a batch of
+    their own.
+
+    The methods log_prob and sample are thread-safe and block until the result is
+    ready. The methods submit_log_prob and submit_sample return a
+    concurrent.futures.Future instead, use asyncio.wrap_future to await it in a
+    coroutine. Results are numpy arrays. Malformed requests raise ValueError when they
+    are submitted, other errors are raised by the result of the affected requests and
+    the server keeps running. Use serve_http to make the server available to other
+    processes.
+
+    Use as a context manager or call close() at the end.
+
+    Parameters
+    ----------
+    predictor : Predictor
+        Compiled flow, see Flow.compile. Batches are padded to its buckets.
+    max_batch_size : int, optional (default = 4096)
+        Number of samples after which a batch is started without waiting.
+    max_delay : float, optional (default = 0.002)
+        Maximum time in seconds that a request waits for other requests.
+    seed : int, optional (default = 0)
+        Seed for sample. Each call draws new samples, see sample. After 2**32 samples,
+        the server continues with a seed derived from this seed.
+
+    """
+
+    def __init__(
+        self,
+        predictor: Predictor,
+        *,
+        max_batch_size: int = 4096,
+        max_delay: float = 0.002,
+        seed: int = 0,
+    ):
+        if max_batch_size < 1:
+            raise ValueError("max_batch_size must be positive")
+        if max_delay < 0:
+            raise ValueError("max_delay must not be negative")
+        self.predictor = predictor
+        self.max_batch_size = max_batch_size
+        self.max_delay = max_delay
+        self.seed = seed
+        self.batches = 0
+        self._samples_drawn = 0
+        self._generation = 0
+        self._closed = False
+        self._lock = threading.Lock()
+        self._queue: queue.Queue = queue.Queue()
+        self._held: Optional[_Request] = None
+        self._thread = threading.Thread(target=self._worker, daemon=True)
+        self._thread.start()
+
+    def submit_log_prob(self, x: ArrayLike, c: Optional[ArrayLike] = None) -> Future:
+        """Queue log_prob request and return future of the result."""
+        x = np.asarray(x, dtype=self.predictor.dtype)
+        if x.ndim != 2:
+            raise ValueError("x must be two-dimensional")
+        if c is not None:
+            c = np.asarray(c, dtype=self.predictor.dtype)
+            if c.ndim < 1:
+                raise ValueError("c must be at least one-dimensional")
+            if len(c) != len(x):
+                raise ValueError("x and c must have the same length")
+        return self._submit(_Request("log_prob", x, c))
+
+    def submit_sample(self, conditions_or_size: Union[ArrayLike, int]) -> Future:
+        """Queue sample request and return future of the result."""
+        if isinstance(conditions_or_size, numbers.Integral):
+            if conditions_or_size < 0:
+                raise ValueError("number of samples must not be negative")
+            request = _Request("sample", np.asarray(int(conditions_or_size)), None)
+        else:
+            c = np.asarray(conditions_or_size, dtype=self.predictor.dtype)
+            if c.ndim < 1:
+                msg = "conditions must be at least one-dimensional or size an integer"
+                raise ValueError(msg)
+            request = _Request("sample", None, c)
+        return self._submit(request)
+
+    def log_prob(self, x: ArrayLike, c: Optional[ArrayLike] = None) -> np.ndarray:
+        """Return log-likelihood of the samples, see Flow.__call__."""
+        return self.submit_log_prob(x, c).result()
+
+    def sample(self, conditions_or_size: Union[ArrayLike, int]) -> np.ndarray:
+        """
+        Return samples from the learned distribution, see Flow.sample.
+
+        Every call returns new samples. The samples of all calls together are those of
+        Predictor.sample with the seed of the server and consecutive offsets, in the
+        order in which the requests were batched. When the offsets of a seed are
+        exhausted, the server continues with offset zero and a new seed, which is
+        derived from the seed of the server and the number of such rollovers.
+        """
+        return self.submit_sample(conditions_or_size).result()
+
+    def close(self):
+        """Finish queued requests and stop the worker thread."""
+        with self._lock:
+            if not self._closed:
+                self._closed = True
+                self._queue.put(None)
+        self._thread.join()
+
+    def __enter__(self):
+        """Return self."""
+        return self
+
+    def __exit__(self, *args):
+        """Close server."""
+        self.close()
+
+    def _submit(self, request: _Request) -> Future:
+        # the lock ensures that no request is queued after the stop signal of close
+        with self._lock:
+            if self._closed:
+                raise RuntimeError("server is closed")
+            self._queue.put(request)
+        return request.future
+
+    def _worker(self):
+        stop = False
+        while not stop:
+            batch: List[_Request] = []
+            try:
+                stop = self._collect(batch)
+                if batch:
+                    self._process(batch)
+            except Exception as e:
+                # the worker must keep running, the error is passed to the requests
+                # of the batch which are not finished
+                for request in batch:
+                    if not request.future.done():
+                        request.future.set_exception(e)
+
+    def _collect(self, batch: List[_Request]) -> bool:
+        # fill batch with requests and return whether the server was closed
+        if self._held is not None:
+            first, self._held = self._held, None
+        else:
+            first = self._queue.get()
+            if first is None:
+                return True
+        batch.append(first)
+        rows = first.rows
+        deadline = time.monotonic() + self.max_delay
+        while rows < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            try:
+                request = self._queue.get(timeout=max(timeout, 0))
+            except queue.Empty:
+                break
+            if request is None:
+                return True
+            if rows + request.rows > self.max_batch_size:
+                # keep request for the next batch
+                self._held = request
+                break
+            batch.append(request)
+            rows += request.rows
+        return False
+
+    def _process(self, batch: List[_Request]):
+        groups: Dict[Tuple, List[_Request]] = {}
+        for request in batch:
+            groups.setdefault(request.key, []).append(request)
+        for requests in groups.values():
+            try:
+                results = self._compute(requests)
+            except Exception as e:
+                for request in requests:
+                    request.future.set_exception(e)
+            else:
+                for request, result in zip(requests, results):
+                    request.future.set_result(result)
+        self.batches += 1
+
+    def _compute(self, requests: List[_Request]) -> List[np.ndarray]:
+        first = requests[0]
+        c = (
+            None
+            if first.c is None
+            else np.concatenate([request.c for request in requests])
+        )
+        if first.kind == "log_prob":
+            x = np.concatenate([request.x for request in requests])
+            result = np.asarray(self.predictor.log_prob(x, c))
+        else:
+            n = sum(request.rows for request in requests)
+            if self._samples_drawn + n >= 2**32:
+                # offsets of the current seed are exhausted
+                self._generation += 1
+                self._samples_drawn = 0
+            result = np.asarray(
+                self.predictor.sample(
+                    n if c is None else c,
+                    seed=_derived_seed(self.seed, self._generation),
+                    offset=self._samples_drawn,
+                )
+            )
+            self._samples_drawn += n
+        splits = np.cumsum([request.rows for request in requests])[:-1]
+        return np.split(result, splits)
+
+
+def serve_http(
+    server: InferenceServer, host: str = "127.0.0.1", port: int = 0
+) -> ThreadingHTTPServer:
+    """
+    Serve requests over HTTP in a background thread.
+
+    The HTTP server accepts POST requests with a JSON body. The path /log_prob expects
+    the keys "x" and optionally "c" and returns {"log_prob": [...]}. The path /sample
+    expects either the key "conditions" or the key "size" and returns {"x": [...]}.
+    Non-finite values in the results are returned as null, since JSON has no
+    representation for them. Errors are returned with status 400 and
+    {"error": message}. Each connection is
+    handled in its own thread, so that concurrent requests are batched by the
+    InferenceServer.
+
+    Parameters
+    ----------
+    server : InferenceServer
+        Server which computes the results.
+    host : str, optional (default = "127.0.0.1")
+        Address to bind to.
+    port : int, optional (default = 0)
+        Port to bind to. If 0, a free port is chosen, see server_address of the
+        result.
+
+    Returns
+    -------
+    ThreadingHTTPServer
+        Running HTTP server. Call its shutdown method to stop it.
+
+    """
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            try:
+                length = int(self.headers.get("Content-Length", 0))
+                body = json.loads(self.rfile.read(length))
+                result = _handle(server, self.path, body)
+                status = 200
+            except Exception as e:
+                result = {"error": str(e)}
+                status = 400
+            data = json.dumps(result, allow_nan=False).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, *args):
+            pass
+
+    class Server(ThreadingHTTPServer):
+        # the default backlog of 5 connections is too small for concurrent clients
+        request_queue_size = 128
+        daemon_threads = True
+
+    httpd = Server((host, port), Handler)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    return httpd
+
+
+def _handle(server: InferenceServer, path: str, body: Dict[str, Any]):
+    if path == "/log_prob":
+        log_prob = server.log_prob(body["x"], body.get("c"))
+        return {"log_prob": _to_json(log_prob)}
+    if path == "/sample":
+        if "size" in body:
+            x = server.sample(body["size"])
+        else:
+            x = server.sample(np.asarray(body["conditions"]))
+        return {"x": _to_json(x)}
+    raise ValueError(f"unknown path {path}")
+
+
+def _to_json(a: np.ndarray) -> List[Any]:
+    # nested lists where non-finite values are replaced by None
+    a = np.asarray(a).astype(object)
+    a[~np.isfinite(a.astype(float))] = None
+    return a.tolist()
+
+
+def _derived_seed(seed: int, generation: int) -> int:
+    if generation == 0:
+        return seed
+    return int(np.random.SeedSequence([seed, generation]).generate_state(1)[0])
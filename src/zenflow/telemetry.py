@@ -0,0 +1,273 @@
+"""Callbacks which report where the time and memory goes during training."""
+
+from typing import Any, Callable, Dict, IO, Iterable, Iterator, Optional, Sequence
+from typing import Union
+import json
+import math
+import sys
+import time
+
+import jax
+
+__all__ = ["Callback", "JsonLinesLogger", "memory_usage"]
+
+Event = Dict[str, Any]
+
+# durations of these events add up to the time spent in compiling a function
+_COMPILE_EVENTS = (
+    "/jax/core/compile/jaxpr_trace_duration",
+    "/jax/core/compile/jaxpr_to_mlir_module_duration",
+    "/jax/core/compile/backend_compile_duration",
+)
+
+
+class Callback:
+    """
+    Callback base class.
+
+    train() calls each callback with an event, a dict with the key "event", which is
+    the type of the event, and further keys which depend on the type. This class
+    dispatches an event to the method on_<type>, override the methods of interest. Any
+    other callable which accepts an event can be used as a callback, too.
+
+    Types of events and their keys:
+
+    compile
+        A function was compiled. Keys: name, seconds. The names are "step" or
+        "epoch_step", "metric", and "test_metric".
+    transfer
+        Data was moved to the device before the training. Keys: name, bytes, seconds.
+    epoch
+        An epoch has finished. Keys: epoch, seconds, samples, samples_per_second,
+        transfer_seconds, loss_train, loss_test, and the keys returned by
+        memory_usage. The seconds are the wall time from the start of the epoch until
+        the device has finished its updates and losses, without the time spent in
+        compiling functions on their first call, which is reported in the compile
+        events. The transfer_seconds are spent in moving batches to the device in a
+        background thread when the training data is a DataSource and zero otherwise.
+    end
+        The training has finished. Keys: seconds, epochs, best_epoch.
+    """
+
+    def __call__(self, event: Event) -> None:
+        """Dispatch event to the method on_<type>."""
+        method = getattr(self, f"on_{event['event']}", None)
+        if method is not None:
+            method(event)
+
+    def on_compile(self, event: Event) -> None:
+        pass
+
+    def on_transfer(self, event: Event) -> None:
+        pass
+
+    def on_epoch(self, event: Event) -> None:
+        pass
+
+    def on_end(self, event: Event) -> None:
+        pass
+
+
+class JsonLinesLogger(Callback):
+    """
+    Callback which writes each event as one line of JSON to a file.
+
+    The file is flushed after each event, so that it can be followed while the
+    training is running. Non-finite numbers, like the test loss of epochs without
+    evaluation, are written as null, since JSON has no representation for them. Use
+    as a context manager or call close() at the end.
+    """
+
+    def __init__(self, file: Union[str, IO[str]], mode: str = "a"):
+        if isinstance(file, str):
+            self._file = open(file, mode)
+            self._owned = True
+        else:
+            self._file = file
+            self._owned = False
+
+    def __call__(self, event: Event) -> None:
+        """Write event."""
+        event = {key: _finite_or_none(value) for key, value in event.items()}
+        self._file.write(json.dumps(event, allow_nan=False) + "\n")
+        self._file.flush()
+
+    def close(self):
+        """Close the file if it was opened by the logger."""
+        if self._owned:
+            self._file.close()
+
+    def __enter__(self):
+        """Return self."""
+        return self
+
+    def __exit__(self, *args):
+        """Close file."""
+        self.close()
+
+
+def memory_usage(devices: Optional[Sequence[jax.Device]] = None) -> Dict[str, Any]:
+    """
+    Return the high-water marks of the memory usage.
+
+    Parameters
+    ----------
+    devices : sequence of jax.Device or None, optional (default = None)
+        Devices to query. If None, the default device is used.
+
+    Returns
+    -------
+    dict
+        device_peak_bytes is the largest peak of the memory in use on any of the
+        devices, or None if the backend does not report it, which is the case on the
+        CPU. host_peak_bytes is the peak resident memory of the process, or None if it
+        is not available on the platform.
+
+    """
+    if devices is None:
+        devices = jax.devices()[:1]
+    peaks = []
+    for device in devices:
+        stats = device.memory_stats()
+        if stats and "peak_bytes_in_use" in stats:
+            peaks.append(stats["peak_bytes_in_use"])
+    return {
+        "device_peak_bytes": max(peaks) if peaks else None,
+        "host_peak_bytes": _host_peak_bytes(),
+    }
+
+
+def _finite_or_none(value: Any) -> Any:
+    if isinstance(value, float) and not math.isfinite(value):
+        return None
+    return value
+
+
+def _host_peak_bytes() -> Optional[int]:
+    try:
+        import resource
+    except ImportError:  # not available on Windows
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+class _Telemetry:
+    # collects timings in train() and passes events to the callbacks
+
+    def __init__(
+        self,
+        callbacks: Sequence[Callable[[Event], None]],
+        devices: Optional[Sequence[jax.Device]],
+    ):
+        self.callbacks = callbacks
+        self.devices = devices
+        self.start = self.epoch_start = time.perf_counter()
+        self.compile_seconds = 0.0
+        self._listening = False
+        self.transfer_seconds = 0.0
+        self.samples = 0
+
+    def emit(self, event: Event):
+        for callback in self.callbacks:
+            callback(event)
+
+    def compiled(self, fn, name: str):
+        # lower and compile on first call to measure the compile time
+        compiled = None
+
+        def call(*args):
+            nonlocal compiled
+            if compiled is None:
+                t = time.perf_counter()
+                compiled = fn.lower(*args).compile()
+                seconds = time.perf_counter() - t
+                if not self._listening:
+                    self.compile_seconds += seconds
+                self.emit({"event": "compile", "name": name, "seconds": seconds})
+            return compiled(*args)
+
+        return call
+
+    def device_put(self, name: str, x, device=None):
+        t = time.perf_counter()
+        x = jax.block_until_ready(jax.device_put(x, device))
+        seconds = time.perf_counter() - t
+        nbytes = sum(a.nbytes for a in jax.tree_util.tree_leaves(x))
+        self.emit(
+            {"event": "transfer", "name": name, "bytes": nbytes, "seconds": seconds}
+        )
+        return x
+
+    def transfer(self, device) -> Callable:
+        # transfer function for prefetch, runs in the background thread
+        def transfer(batch):
+            t = time.perf_counter()
+            batch = jax.block_until_ready(jax.device_put(batch, device))
+            self.transfer_seconds += time.perf_counter() - t
+            return batch
+
+        return transfer
+
+    def count(self, batches: Iterable) -> Iterator:
+        # count unmasked samples of batches (x, c, mask) before they are transferred
+        for batch in batches:
+            self.samples += int(batch[2].sum())
+            yield batch
+
+    def begin_epoch(self):
+        # Compile times are subtracted from the wall time of the epoch. All
+        # compilations are captured with a listener if it can be removed again,
+        # otherwise only those of the functions passed to compiled().
+        self.compile_seconds = 0.0
+        if hasattr(jax.monitoring, "unregister_event_duration_listener"):
+            jax.monitoring.register_event_duration_secs_listener(self._on_duration)
+            self._listening = True
+        self.epoch_start = time.perf_counter()
+
+    def _on_duration(self, event: str, seconds: float, **kwargs):
+        if event in _COMPILE_EVENTS:
+            self.compile_seconds += seconds
+
+    def end_of_epoch(self, samples: Optional[int], outputs: Any) -> Dict[str, Any]:
+        # called after the epoch was queued, waits for its outputs and returns its
+        # statistics; samples is None if they were counted by count()
+        jax.block_until_ready(outputs)
+        seconds = time.perf_counter() - self.epoch_start - self.compile_seconds
+        if self._listening:
+            jax.monitoring.unregister_event_duration_listener(self._on_duration)
+            self._listening = False
+        samples = self.samples if samples is None else samples
+        info = {
+            "seconds": seconds,
+            "samples": samples,
+            "samples_per_second": samples / seconds,
+            "transfer_seconds": self.transfer_seconds,
+        }
+        self.samples = 0
+        self.transfer_seconds = 0.0
+        return info
+
+    def epoch(self, epoch: int, info: Dict[str, Any], loss_train, loss_test):
+        # called when the losses of the epoch have been fetched from the device
+        self.emit(
+            {
+                "event": "epoch",
+                "epoch": epoch,
+                **info,
+                "loss_train": loss_train,
+                "loss_test": loss_test,
+                **memory_usage(self.devices),
+            }
+        )
+
+    def end(self, epochs: int, best_epoch: int):
+        self.emit(
+            {
+                "event": "end",
+                "seconds": time.perf_counter() - self.start,
+                "epochs": epochs,
+                "best_epoch": best_epoch,
+            }
+        )
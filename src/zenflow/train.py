@@ -1,138 +1,794 @@
 """Train flow."""
 
 from .flow import Flow
+from .bijectors import migrate_variables
+from .data import DataSource, batches, prefetch
+from .telemetry import _Telemetry
 from flax.typing import ArrayPytree, Array
 import jax.numpy as jnp
-from typing import Tuple, List, Optional
+from typing import Tuple, List, Optional, Union, Sequence, Callable, Dict, Any
+from typing import TYPE_CHECKING
 import numpy as np
 import jax
-import optax
 import warnings
+from functools import partial
 
-if hasattr(optax, "nadamw"):
-    DEFAULT_OPTIMIZER = optax.nadamw
-else:
-    DEFAULT_OPTIMIZER = optax.adamw
+if TYPE_CHECKING:
+    import optax
+
+
+def __getattr__(name: str) -> Any:
+    # optax is imported on first use, DEFAULT_OPTIMIZER is optax.nadamw or
+    # optax.adamw for older versions of optax
+    if name == "DEFAULT_OPTIMIZER":
+        return _default_optimizer()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
 def train(
     flow: Flow,
-    X_train: Array,
+    X_train: Union[Array, DataSource],
     X_test: Array,
     C_train: Optional[Array] = None,
     C_test: Optional[Array] = None,
     *,
     epochs: int = 1000,
     batch_size: int = 1024,
-    optimizer: optax.GradientTransformation = DEFAULT_OPTIMIZER(learning_rate=1e-3),
+    optimizer: Optional["optax.GradientTransformation"] = None,
     patience: float = 0.05,
     warmup: float = 0.2,
     seed: int = 0,
     progress: bool = True,
     initial_variables: Optional[ArrayPytree] = None,
+    fused_epoch: bool = False,
+    prefetch_size: int = 2,
+    devices: Optional[Sequence[jax.Device]] = None,
+    eval_batch_size: int = 2**14,
+    compute_dtype: Optional[jnp.dtype] = None,
+    accumulate_steps: int = 1,
+    callbacks: Sequence[Callable[[Dict[str, Any]], None]] = (),
+    eval_every: int = 1,
+    eval_size: Optional[int] = None,
+    eval_adaptive: bool = False,
 ) -> Tuple[ArrayPytree, int, List[float], List[float]]:
-    """Trains the normalizing flow on the provided inputs."""
-    if warmup < 1:
-        warmup = warmup * epochs
-    warmup = int(warmup)
+    """
+    Trains the normalizing flow on the provided inputs.
 
-    if patience < 1:
-        patience = patience * epochs
-    patience = int(patience)
+    If optimizer is None, DEFAULT_OPTIMIZER with a learning rate of 1e-3 is used.
 
-    X_train = jax.device_put(X_train)
-    X_test = jax.device_put(X_test)
-    if C_train is not None:
-        C_train = jax.device_put(C_train)
+    Training can be resumed by passing the variables of a previous run as
+    initial_variables. Variables of older versions are converted with
+    zenflow.bijectors.migrate_variables.
+
+    If fused_epoch is True, the loop over the mini-batches of an epoch is compiled
+    into a single program, which removes the Python dispatch overhead per batch.
+    Parameters and optimizer state are donated to this program and updated in place.
+    This is faster for small models trained with many batches per epoch, but the
+    first epoch takes longer to compile.
+
+    If the number of training samples is not a multiple of the batch size, the last
+    batch of each epoch is padded with samples from the start of the epoch. The padded
+    samples are masked and do not contribute to the loss or to the statistics of the
+    bijectors, so that all batches have the same shape and the training step is
+    compiled only once.
+
+    X_train may be a DataSource (see zenflow.data) for data sets which do not fit into
+    memory. C_train must be None in this case, the conditional variables are provided by
+    the source. Batches are then assembled from the chunks of the source and moved to
+    the device in a background thread, while the current step is running. At most
+    prefetch_size batches are buffered, so that the memory usage is bounded by the size
+    of a chunk and the prefetch buffer. Samples are only shuffled within chunks. The
+    source must yield samples in every epoch. This mode cannot be combined with
+    fused_epoch.
+
+    If a sequence of devices is passed, for example jax.devices(), the training is
+    data-parallel. Each batch is split into equal shards, one per device, and the
+    parameters and optimizer state are replicated. Gradients, the running bounds of
+    ShiftBounds and the BatchNorm statistics are reduced over all shards by the
+    compiler, so that the result is the same as on a single device. The batch size
+    must be a multiple of the number of devices. In-memory training data is replicated
+    on each device, use a DataSource to avoid that. To use several CPU cores, set the
+    environment variable XLA_FLAGS=--xla_force_host_platform_device_count=<cores>
+    before importing jax.
+
+    The loss on the test sample is computed in chunks of eval_batch_size samples inside
+    a single compiled reduction, so that the memory needed for the evaluation does not
+    depend on the size of the test sample.
+
+    If compute_dtype is set, for example to jnp.bfloat16, the flow is trained with
+    mixed precision: the conditioner networks are computed in compute_dtype, while the
+    parameters, the optimizer state, the spline arithmetic and the loss are kept in
+    float32. See Flow for details.
+
+    If accumulate_steps is larger than one, each batch is split into this many
+    micro-batches, which are processed one after another inside the compiled step.
+    Their gradients are accumulated and the optimizer is applied once per batch, so
+    that large batch sizes can be used with the memory needed for a micro-batch. The
+    accumulated gradient is the gradient of the mean loss over the whole batch.
+    BatchNorm layers normalize each micro-batch with its own statistics, and the running
+    statistics of the bijectors are updated once per micro-batch, as if the
+    micro-batches were batches. Micro-batches which contain only padding are skipped.
+    The batch size must be a multiple of accumulate_steps, and with several devices, the
+    size of a micro-batch must be a multiple of the number of devices.
+
+    Callbacks are called with events which report the compile times, the transfer of
+    the data to the device, and the wall time, throughput and peak memory of each
+    epoch. See zenflow.telemetry for the events and for a logger which writes them to
+    a JSON-lines file. Any callable which accepts a dict can be used as a callback. The
+    compile times are measured by compiling the functions explicitly on first use.
+    To measure the wall time of an epoch, the host waits until the device has
+    finished it, so that the next epoch is not queued in advance. Nothing is measured
+    if no callbacks are passed.
+
+    The loss on the test sample, which decides about early stopping and the best
+    epoch, can be evaluated less often to save time. It is evaluated every eval_every
+    epochs and in the last epoch. If eval_adaptive is True, it is additionally
+    evaluated in every epoch as long as the last evaluation did not improve on the best
+    loss so far, so that the evaluation is dense when the training is about to stop. This
+    decision is taken on the device, so that the host does not wait for the last
+    evaluation. The entries of loss_test for epochs without evaluation are NaN, and only evaluated
+    epochs can become the best epoch. The patience windows are unchanged, epochs
+    without evaluation are ignored, so eval_every must not exceed the patience. If
+    eval_size is set, the test loss is computed on a fixed random subsample of X_test
+    of this size. The loss on the training sample is computed in every epoch.
+    """
+    if optimizer is None:
+        optimizer = _default_optimizer()(learning_rate=1e-3)
+    if compute_dtype is not None:
+        flow = flow.clone(dtype=compute_dtype)
+
+    warmup = _fraction_of_epochs(warmup, epochs)
+    patience = _fraction_of_epochs(patience, epochs)
+    if eval_every < 1:
+        raise ValueError("eval_every must be positive")
+    if eval_every > 1 and eval_every > patience:
+        raise ValueError("eval_every must not exceed patience")
+
+    if accumulate_steps < 1:
+        raise ValueError("accumulate_steps must be positive")
+    if batch_size % accumulate_steps != 0:
+        raise ValueError("batch_size must be a multiple of accumulate_steps")
+
+    if devices is None:
+        shard_batch = replicate = None
+        constrain = _identity
+    else:
+        if (batch_size // accumulate_steps) % len(devices) != 0:
+            msg = (
+                "batch_size / accumulate_steps must be a multiple of the number of "
+                f"devices {len(devices)}"
+            )
+            raise ValueError(msg)
+        mesh = jax.sharding.Mesh(np.asarray(devices), ("batch",))
+        P = jax.sharding.PartitionSpec
+        shard_batch = jax.sharding.NamedSharding(mesh, P("batch"))
+        replicate = jax.sharding.NamedSharding(mesh, P())
+        constrain = partial(jax.lax.with_sharding_constraint, shardings=shard_batch)
+
+    telemetry = _Telemetry(callbacks, devices) if callbacks else None
+
+    def device_put(x, name):
+        if telemetry is None:
+            return jax.device_put(x, replicate)
+        return telemetry.device_put(name, x, replicate)
+
+    streaming = isinstance(X_train, DataSource)
+    if streaming:
+        if C_train is not None:
+            raise ValueError("C_train must be None if X_train is a DataSource")
+        if fused_epoch:
+            raise ValueError("fused_epoch cannot be used if X_train is a DataSource")
+        X_init, C_init = X_train.peek()
+    else:
+        X_train = device_put(X_train, "X_train")
+        if C_train is not None:
+            C_train = device_put(C_train, "C_train")
+        X_init, C_init = X_train, C_train
+    if eval_size is not None and eval_size < X_test.shape[0]:
+        # fixed subsample, drawn independently of the training
+        idx = np.random.default_rng([seed, 1]).choice(
+            X_test.shape[0], eval_size, replace=False
+        )
+        X_test = X_test[idx]
+        C_test = None if C_test is None else C_test[idx]
+    n_test = X_test.shape[0]
+    eval_batch_size = min(eval_batch_size, n_test)
+    if devices is not None:
+        eval_batch_size = -(-eval_batch_size // len(devices)) * len(devices)
+    X_test = device_put(_chunk(X_test, eval_batch_size), "X_test")
     if C_test is not None:
-        C_test = jax.device_put(C_test)
+        C_test = device_put(_chunk(C_test, eval_batch_size), "C_test")
+    mask_test = _chunk(jnp.ones(n_test, dtype=bool), eval_batch_size, fill=False)
 
     root_key = jax.random.PRNGKey(seed)
     init_key, iter_key = jax.random.split(root_key)
+    dropout_key = _dropout_key(root_key)
 
     if initial_variables is None:
         variables = flow.init(
-            init_key, X_train[:1], None if C_train is None else C_train[:1]
+            init_key,
+            jnp.asarray(X_init[:1]),
+            None if C_init is None else jnp.asarray(C_init[:1]),
         )
     else:
-        variables = initial_variables
+        # statistics of older versions are converted once, so that the structure of
+        # the variables does not change while training
+        template = jax.eval_shape(
+            flow.init,
+            init_key,
+            jnp.asarray(X_init[:1]),
+            None if C_init is None else jnp.asarray(C_init[:1]),
+        )
+        variables = migrate_variables(initial_variables, template)
     params = variables["params"]
     batch_stats = variables["batch_stats"]
+    if fused_epoch:
+        # buffers are donated to epoch_step, so we must not alias the input
+        params, batch_stats = jax.tree_util.tree_map(jnp.copy, (params, batch_stats))
 
     opt_state = optimizer.init(params)
+    if devices is not None:
+        params, batch_stats, opt_state = jax.device_put(
+            (params, batch_stats, opt_state), replicate
+        )
+
+    metric_fn = jax.jit(partial(_metric, flow))
+    test_metric_fn = jax.jit(partial(_evaluate, flow, constrain=constrain))
 
     @jax.jit
-    def loss_fn(params, batch_stats, x, c):
-        lp, updates = flow.apply(
-            {"params": params, "batch_stats": batch_stats},
+    def step(params, batch_stats, opt_state, x, c, mask, key):
+        if accumulate_steps == 1:
+            x, c, mask = constrain((x, c, mask))
+        return _update(
+            flow,
+            optimizer,
+            params,
+            batch_stats,
+            opt_state,
             x,
             c,
-            train=True,
-            mutable=["batch_stats"],
+            mask,
+            key,
+            accumulate_steps=accumulate_steps,
+            constrain=constrain,
         )
-        return -jnp.mean(lp), updates
 
-    @jax.jit
-    def metric_fn(variables, x, c):
-        lp = flow.apply(variables, x, c)
-        return -jnp.mean(lp)
+    @partial(jax.jit, donate_argnums=(0, 1, 2))
+    def epoch_step(params, batch_stats, opt_state, x, c, batch_indices, masks, keys):
+        def body(carry, args):
+            idx, mask, key = args
+            c_batch = None if c is None else c[idx]
+            return step(*carry, x[idx], c_batch, mask, key), None
 
-    @jax.jit
-    def step(params, batch_stats, opt_state, x, c):
-        gradients, updates = jax.grad(loss_fn, has_aux=True)(params, batch_stats, x, c)
-        batch_stats = updates["batch_stats"]
-        updates, opt_state = optimizer.update(gradients, opt_state, params)
-        params = optax.apply_updates(params, updates)
-        return params, batch_stats, opt_state
+        carry, _ = jax.lax.scan(
+            body, (params, batch_stats, opt_state), (batch_indices, masks, keys)
+        )
+        return carry
+
+    if telemetry is None:
+        train_step = step
+    else:
+        # compile explicitly on first use to measure the compile times
+        train_step = telemetry.compiled(step, "step")
+        epoch_step = telemetry.compiled(epoch_step, "epoch_step")
+        metric_fn = telemetry.compiled(metric_fn, "metric")
+        test_metric_fn = telemetry.compiled(test_metric_fn, "test_metric")
+
+    if not streaming:
+        n_train = X_train.shape[0]
+        batch_size = min(batch_size, n_train)
+        # round up to a multiple of the size of a step, rest is padded
+        granule = accumulate_steps * (1 if devices is None else len(devices))
+        batch_size = -(-batch_size // granule) * granule
+        n_batches = -(-n_train // batch_size)
+        masks = (jnp.arange(n_batches * batch_size) < n_train).reshape(n_batches, -1)
 
     loss_train = []
     loss_test = []
 
-    if progress:
-        try:
-            from tqdm.notebook import tqdm as track
-        except ModuleNotFoundError:
-            from rich.progress import track
+    loop = _progress(range(epochs), progress)
 
-        loop = track(range(epochs))
-    else:
-        loop = range(epochs)
+    def resolve(loss, epoch, info) -> bool:
+        # fetch losses of an epoch from the device and decide whether to stop
+        loss_train.append(loss[0].item())
+        loss_test.append(np.nan if loss[1] is None else loss[1].item())
+        if telemetry is not None:
+            telemetry.epoch(epoch, info, loss_train[-1], loss_test[-1])
+        return _should_stop(loss_train, loss_test, warmup, patience)
 
-    best_epoch = 0
-    best_variables = variables
+    # Losses, the best state and whether the last evaluation improved on the best loss
+    # are kept on the device. The host fetches the losses of the previous epoch after
+    # the next epoch was queued, so that it does not wait for the device to finish.
+    # strongly typed like the result of test_metric_fn, so that it is compiled only once
+    best = (
+        jnp.array(jnp.inf, dtype=jnp.result_type(float)),
+        jnp.array(0, dtype=jnp.int32),
+        variables,
+    )
+    improving = jnp.array(True)
+    result = best
+    pending = []
+    stop = False
     for epoch in loop:
-        permute_key = jax.random.fold_in(iter_key, epoch)
-        perm = jax.random.permutation(permute_key, X_train.shape[0])
-        X_perm = X_train[perm]
-        if C_train is not None:
-            C_perm = C_train[perm]
+        if telemetry is not None:
+            telemetry.begin_epoch()
+        # keys for dropout layers, for example in the context encoder
+        epoch_key = jax.random.fold_in(dropout_key, epoch)
+        if streaming:
+            rng = np.random.default_rng([seed, epoch])
+            source_batches = batches(X_train, batch_size, rng)
+            transfer = partial(jax.device_put, device=shard_batch)
+            if telemetry is not None:
+                source_batches = telemetry.count(source_batches)
+                transfer = telemetry.transfer(shard_batch)
+            # the last batch of the epoch is used for the training loss
+            X = None
+            for i, (X, C, mask) in enumerate(
+                prefetch(source_batches, prefetch_size, transfer)
+            ):
+                key = jax.random.fold_in(epoch_key, i)
+                params, batch_stats, opt_state = train_step(
+                    params, batch_stats, opt_state, X, C, mask, key
+                )
+            if X is None:
+                raise ValueError(f"X_train yielded no samples in epoch {epoch}")
+        else:
+            permute_key = jax.random.fold_in(iter_key, epoch)
+            perm = jax.random.permutation(permute_key, n_train)
+            # last batch is padded by wrapping around, padded entries are masked
+            batches_idx = jnp.resize(perm, masks.shape)
+            keys = jax.random.split(epoch_key, n_batches)
 
-        # loop through batches and step optimizer
-        for batch_idx in range(0, len(X_perm), batch_size):
-            X = X_perm[batch_idx : batch_idx + batch_size]
-            if C_train is not None:
-                C = C_perm[batch_idx : batch_idx + batch_size]
+            if fused_epoch:
+                params, batch_stats, opt_state = epoch_step(
+                    params,
+                    batch_stats,
+                    opt_state,
+                    X_train,
+                    C_train,
+                    batches_idx,
+                    masks,
+                    keys,
+                )
             else:
-                C = None
-            params, batch_stats, opt_state = step(params, batch_stats, opt_state, X, C)
+                # loop through batches and step optimizer
+                for idx, mask, key in zip(batches_idx, masks, keys):
+                    X = X_train[idx]
+                    C = None if C_train is None else C_train[idx]
+                    params, batch_stats, opt_state = train_step(
+                        params, batch_stats, opt_state, X, C, mask, key
+                    )
+
+            X = X_train[batches_idx[-1]]
+            C = None if C_train is None else C_train[batches_idx[-1]]
+            mask = masks[-1]
 
         variables = {"params": params, "batch_stats": batch_stats}
-        loss_train.append(metric_fn(variables, X, C).item())
-        loss_test.append(metric_fn(variables, X_test, C_test).item())
+        evaluate = epoch % eval_every == 0 or epoch == epochs - 1
+        loss = (metric_fn(variables, X, C, mask), None)
+        if evaluate or eval_adaptive:
+            # with eval_adaptive, the device also evaluates if the last evaluation did
+            # not improve, otherwise loss_test is NaN
+            test_loss, best, improving = test_metric_fn(
+                best,
+                improving,
+                variables,
+                loss[0],
+                X_test,
+                C_test,
+                mask_test,
+                epoch,
+                evaluate,
+            )
+            loss = (loss[0], test_loss)
+        info = (
+            None
+            if telemetry is None
+            else telemetry.end_of_epoch(
+                None if streaming else n_train, (params, batch_stats, loss, best)
+            )
+        )
+        pending.append((loss, best, epoch, info))
 
-        if not np.isfinite(loss_train[-1]):
-            msg = f"epoch {epoch}: loss[train] not finite, abort training"
-            warnings.warn(msg, RuntimeWarning)
+        while len(pending) > 1 and not stop:
+            loss, result, *args = pending.pop(0)
+            stop = resolve(loss, *args)
+        if stop:
             break
 
-        if loss_test[-1] <= loss_test[best_epoch]:
-            best_epoch = epoch
-            best_variables = variables
+    while pending and not stop:
+        loss, result, *args = pending.pop(0)
+        stop = resolve(loss, *args)
 
-        if epoch >= warmup and epoch >= 2 * patience and epoch % patience == 0:
-            if not np.min(loss_test[-patience:]) < np.min(
-                loss_test[-2 * patience : -patience]
-            ):
-                break
+    _, best_epoch, best_variables = result
+    best_epoch = int(best_epoch)
+
+    if telemetry is not None:
+        telemetry.end(len(loss_train), best_epoch)
+
+    if devices is not None:
+        best_variables = jax.device_put(best_variables, devices[0])
 
     return best_variables, best_epoch, loss_train, loss_test
+
+
+def train_ensemble(
+    flow: Flow,
+    X_train: Array,
+    X_test: Array,
+    C_train: Optional[Array] = None,
+    C_test: Optional[Array] = None,
+    *,
+    seeds: Sequence[int] = (0, 1, 2, 3),
+    learning_rates: Optional[Sequence[float]] = None,
+    optimizer: Optional[Callable[..., "optax.GradientTransformation"]] = None,
+    epochs: int = 1000,
+    batch_size: int = 1024,
+    patience: float = 0.05,
+    warmup: float = 0.2,
+    progress: bool = True,
+    eval_batch_size: int = 2**14,
+) -> Tuple[List[ArrayPytree], List[int], List[List[float]], List[List[float]]]:
+    """
+    Trains an ensemble of normalizing flows with the same architecture together.
+
+    The members of the ensemble differ in the seed and/or the learning rate. Their
+    parameters and optimizer states are stacked and all members are updated in one
+    vectorized compiled step. Each member sees the same batches and is initialized in
+    the same way as with train() and the corresponding seed. Early stopping is applied
+    to each member separately, stopped members are frozen while the others continue.
+
+    Parameters
+    ----------
+    seeds : sequence of int, optional (default = (0, 1, 2, 3))
+        Seeds of the members. A single seed is used for all members if several learning
+        rates are given.
+    learning_rates : sequence of float or None, optional (default = None)
+        Learning rates of the members. The default is 1e-3 for every member.
+    optimizer : callable or None, optional (default = None)
+        Factory for the optimizer, which is called with the keyword learning_rate. If
+        None, DEFAULT_OPTIMIZER is used.
+
+    The other parameters are the same as for train().
+
+    Returns
+    -------
+    best_variables : list of variables
+        Best variables of each member.
+    best_epoch : list of int
+        Best epoch of each member.
+    loss_train : list of list of float
+        Training loss of each member per epoch, until the member was stopped.
+    loss_test : list of list of float
+        Test loss of each member per epoch, until the member was stopped.
+
+    """
+    seeds = list(seeds)
+    if learning_rates is None:
+        learning_rates = [1e-3] * len(seeds)
+    learning_rates = list(learning_rates)
+    if len(seeds) == 1:
+        seeds *= len(learning_rates)
+    if len(seeds) != len(learning_rates):
+        raise ValueError("seeds and learning_rates must have the same length")
+    n_members = len(seeds)
+
+    warmup = _fraction_of_epochs(warmup, epochs)
+    patience = _fraction_of_epochs(patience, epochs)
+
+    X_train = jax.device_put(X_train)
+    if C_train is not None:
+        C_train = jax.device_put(C_train)
+    n_test = X_test.shape[0]
+    eval_batch_size = min(eval_batch_size, n_test)
+    X_test = _chunk(X_test, eval_batch_size)
+    if C_test is not None:
+        C_test = _chunk(C_test, eval_batch_size)
+    mask_test = _chunk(jnp.ones(n_test, dtype=bool), eval_batch_size, fill=False)
+
+    import optax
+
+    if optimizer is None:
+        optimizer = _default_optimizer()
+    # learning rate is part of the optimizer state with inject_hyperparams,
+    # so that the update function is the same for all members
+    opt = optax.inject_hyperparams(optimizer)(learning_rate=learning_rates[0])
+    states = []
+    iter_keys = []
+    dropout_keys = []
+    for seed, learning_rate in zip(seeds, learning_rates):
+        root_key = jax.random.PRNGKey(seed)
+        init_key, iter_key = jax.random.split(root_key)
+        variables = flow.init(
+            init_key, X_train[:1], None if C_train is None else C_train[:1]
+        )
+        opt_state = optax.inject_hyperparams(optimizer)(
+            learning_rate=learning_rate
+        ).init(variables["params"])
+        states.append((variables["params"], variables["batch_stats"], opt_state))
+        iter_keys.append(iter_key)
+        dropout_keys.append(_dropout_key(root_key))
+    state = jax.tree_util.tree_map(lambda *x: jnp.stack(x), *states)
+    iter_keys = jnp.stack(iter_keys)
+    dropout_keys = jnp.stack(dropout_keys)
+
+    n_train = X_train.shape[0]
+    batch_size = min(batch_size, n_train)
+    n_batches = -(-n_train // batch_size)
+    masks = (jnp.arange(n_batches * batch_size) < n_train).reshape(n_batches, -1)
+
+    update = jax.vmap(partial(_update, flow, opt), in_axes=(0, 0, 0, 0, 0, None, 0))
+    metric = jax.vmap(partial(_metric, flow), in_axes=(0, 0, 0, None))
+    test_metric = jax.vmap(
+        partial(_test_metric, flow, constrain=_identity), in_axes=(0, None, None, None)
+    )
+    track_best = jax.vmap(_track_best, in_axes=(0, 0, 0, None))
+
+    @partial(jax.jit, donate_argnums=(0, 1))
+    def epoch_step(state, best, active, epoch, x, c):
+        def select(a, b):
+            return jnp.where(active.reshape((-1,) + (1,) * (a.ndim - 1)), a, b)
+
+        def body(state, args):
+            idx, mask, keys = args
+            c_batch = None if c is None else c[idx]
+            new_state = update(*state, x[idx], c_batch, mask, keys)
+            return jax.tree_util.tree_map(select, new_state, state), None
+
+        n = x.shape[0]
+        perm = jax.vmap(
+            lambda key: jax.random.permutation(jax.random.fold_in(key, epoch), n)
+        )(iter_keys)
+        # shape (n_batches, n_members, batch_size)
+        batch_indices = jnp.take(perm, jnp.arange(masks.size) % n, axis=1)
+        batch_indices = batch_indices.reshape(n_members, n_batches, -1).swapaxes(0, 1)
+        # shape (n_batches, n_members, ...), the same keys as in train()
+        keys = jax.vmap(
+            lambda key: jax.random.split(jax.random.fold_in(key, epoch), n_batches)
+        )(dropout_keys).swapaxes(0, 1)
+        state, _ = jax.lax.scan(body, state, (batch_indices, masks, keys))
+
+        params, batch_stats, _ = state
+        variables = {"params": params, "batch_stats": batch_stats}
+        idx = batch_indices[-1]
+        loss = (
+            metric(variables, x[idx], None if c is None else c[idx], masks[-1]),
+            test_metric(variables, X_test, C_test, mask_test),
+        )
+        best = jax.tree_util.tree_map(
+            select, track_best(best, variables, loss, epoch), best
+        )
+        return state, best, loss
+
+    loss_train: List[List[float]] = [[] for _ in range(n_members)]
+    loss_test: List[List[float]] = [[] for _ in range(n_members)]
+    active = np.ones(n_members, dtype=bool)
+
+    params, batch_stats, _ = state
+    best = (
+        jnp.full(n_members, jnp.inf),
+        jnp.zeros(n_members, dtype=int),
+        jax.tree_util.tree_map(
+            jnp.copy, {"params": params, "batch_stats": batch_stats}
+        ),
+    )
+
+    for epoch in _progress(range(epochs), progress):
+        state, best, loss = epoch_step(
+            state, best, jnp.asarray(active), epoch, X_train, C_train
+        )
+        lt_train, lt_test = np.asarray(loss[0]), np.asarray(loss[1])
+        for i in np.flatnonzero(active):
+            loss_train[i].append(lt_train[i].item())
+            loss_test[i].append(lt_test[i].item())
+            if _should_stop(loss_train[i], loss_test[i], warmup, patience):
+                active[i] = False
+        if not np.any(active):
+            break
+
+    _, best_epoch, best_variables = best
+    return (
+        [
+            jax.tree_util.tree_map(lambda x: x[i], best_variables)
+            for i in range(n_members)
+        ],
+        [int(x) for x in best_epoch],
+        loss_train,
+        loss_test,
+    )
+
+
+def _should_stop(
+    loss_train: List[float], loss_test: List[float], warmup: int, patience: int
+) -> bool:
+    epoch = len(loss_train) - 1
+    if not np.isfinite(loss_train[-1]):
+        msg = f"epoch {epoch}: loss[train] not finite, abort training"
+        warnings.warn(msg, RuntimeWarning)
+        return True
+
+    if epoch >= warmup and epoch >= 2 * patience and epoch % patience == 0:
+        # epochs without evaluation of the test loss are nan and ignored
+        if not np.nanmin(loss_test[-patience:]) < np.nanmin(
+            loss_test[-2 * patience : -patience]
+        ):
+            return True
+
+    return False
+
+
+def _fraction_of_epochs(value: float, epochs: int) -> int:
+    if value < 1:
+        value = value * epochs
+    return int(value)
+
+
+def _progress(iterable, progress: bool):
+    if not progress:
+        return iterable
+    try:
+        from tqdm.notebook import tqdm as track
+    except ModuleNotFoundError:
+        from rich.progress import track
+    return track(iterable)
+
+
+def _default_optimizer() -> Callable[..., "optax.GradientTransformation"]:
+    import optax
+
+    return optax.nadamw if hasattr(optax, "nadamw") else optax.adamw
+
+
+def _identity(x):
+    return x
+
+
+def _dropout_key(root_key: Array) -> Array:
+    # key for dropout layers in training mode, independent of the keys for the
+    # initialization and the permutations, which are split from the same root key
+    return jax.random.fold_in(root_key, 1)
+
+
+def _loss(flow, params, batch_stats, x, c, mask, key=None):
+    lp, updates = flow.apply(
+        {"params": params, "batch_stats": batch_stats},
+        x,
+        c,
+        train=True,
+        mutable=["batch_stats"],
+        mask=mask,
+        rngs=None if key is None else {"dropout": key},
+    )
+    return -_masked_mean(lp, mask), updates
+
+
+def _update(
+    flow,
+    optimizer,
+    params,
+    batch_stats,
+    opt_state,
+    x,
+    c,
+    mask,
+    key=None,
+    accumulate_steps=1,
+    constrain=_identity,
+):
+    if accumulate_steps == 1:
+        gradients, updates = jax.grad(partial(_loss, flow), has_aux=True)(
+            params, batch_stats, x, c, mask, key
+        )
+        batch_stats = updates["batch_stats"]
+    else:
+        gradients, batch_stats = _accumulate_gradients(
+            flow, params, batch_stats, x, c, mask, key, accumulate_steps, constrain
+        )
+    import optax
+
+    updates, opt_state = optimizer.update(gradients, opt_state, params)
+    params = optax.apply_updates(params, updates)
+    return params, batch_stats, opt_state
+
+
+def _accumulate_gradients(flow, params, batch_stats, x, c, mask, key, steps, constrain):
+    # Split the batch into micro-batches, which are processed sequentially. The
+    # gradient of the mean of micro-batch j is weighted with n_j / n, so that the sum
+    # is the gradient of the mean over the whole batch.
+    def split(a):
+        return None if a is None else a.reshape((steps, -1) + a.shape[1:])
+
+    n = jnp.sum(mask)
+
+    def body(carry, args):
+        gradients, batch_stats = carry
+        key, args = args
+        x, c, mask = constrain(args)
+        g, updates = jax.grad(partial(_loss, flow), has_aux=True)(
+            params, batch_stats, x, c, mask, key
+        )
+        n_micro = jnp.sum(mask)
+        # skip micro-batches which contain only padding, their loss is nan
+        keep = n_micro > 0
+        gradients = jax.tree_util.tree_map(
+            lambda a, b: a + jnp.where(keep, b * (n_micro / n), 0), gradients, g
+        )
+        batch_stats = jax.tree_util.tree_map(
+            lambda a, b: jnp.where(keep, a, b), updates["batch_stats"], batch_stats
+        )
+        return (gradients, batch_stats), None
+
+    gradients = jax.tree_util.tree_map(jnp.zeros_like, params)
+    (gradients, batch_stats), _ = jax.lax.scan(
+        body,
+        (gradients, batch_stats),
+        (
+            None if key is None else jax.random.split(key, steps),
+            (split(x), split(c), split(mask)),
+        ),
+    )
+    return gradients, batch_stats
+
+
+def _metric(flow, variables, x, c, mask=None):
+    lp = flow.apply(variables, x, c)
+    return -_masked_mean(lp, mask)
+
+
+def _test_metric(flow, variables, x, c, mask, constrain):
+    # x, c, mask are split into chunks along the first axis, see _chunk
+    def body(total, args):
+        x, c, mask = constrain(args)
+        lp = flow.apply(variables, x, c)
+        return total + jnp.sum(jnp.where(mask, lp, 0)), None
+
+    total, _ = jax.lax.scan(body, jnp.zeros(()), (x, c, mask))
+    return -total / jnp.sum(mask)
+
+
+def _evaluate(
+    flow, best, improving, variables, loss_train, x, c, mask, epoch, force, constrain
+):
+    # evaluate the test loss if forced or if the last evaluation did not improve on the
+    # best loss, and track the best state; the decision is taken on the device, so that
+    # the host does not wait for the last evaluation before it queues the next epoch
+    def evaluate():
+        loss_test = _test_metric(flow, variables, x, c, mask, constrain)
+        loss_test = loss_test.astype(best[0].dtype)
+        return (
+            loss_test,
+            _track_best(best, variables, (loss_train, loss_test), epoch),
+            loss_test <= best[0],
+        )
+
+    def skip():
+        return jnp.full_like(best[0], jnp.nan), best, improving
+
+    return jax.lax.cond(force | ~improving, evaluate, skip)
+
+
+def _track_best(best, variables, loss, epoch):
+    loss_train, loss_test = loss
+    better = (loss_test <= best[0]) & jnp.isfinite(loss_train)
+    return jax.tree_util.tree_map(
+        lambda a, b: jnp.where(better, a, b), (loss_test, epoch, variables), best
+    )
+
+
+def _masked_mean(x: Array, mask: Optional[Array]) -> Array:
+    if mask is None:
+        return jnp.mean(x)
+    return jnp.sum(jnp.where(mask, x, 0)) / jnp.sum(mask)
+
+
+def _chunk(x: Array, size: int, fill=None) -> Array:
+    # split first axis into chunks of equal size, the last chunk is padded with fill
+    # or by repeating the values if fill is None
+    n = -(-x.shape[0] // size) * size
+    if fill is None:
+        x = jnp.resize(x, (n,) + x.shape[1:])
+    else:
+        x = jnp.pad(
+            x, [(0, n - x.shape[0])] + [(0, 0)] * (x.ndim - 1), constant_values=fill
+        )
+    return x.reshape((-1, size) + x.shape[1:])
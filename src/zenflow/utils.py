@@ -1,7 +1,7 @@
 """Utility functions used in other modules."""
 
-from typing import Tuple
-from flax.typing import Array
+from typing import Optional, Tuple
+from jax import Array
 import jax.numpy as jnp
 
 __all__ = [
@@ -9,6 +9,7 @@ __all__ = [
     "normalize_spline_params",
     "rational_quadratic_spline_forward",
     "rational_quadratic_spline_inverse",
+    "rational_quadratic_spline_inverse_and_log_det",
 ]
 
 
@@ -129,14 +130,7 @@ def rational_quadratic_spline_forward(
     # replace out-of-bounds values with original values
     y = jnp.where(out_of_bounds, x, y)
 
-    # [1] Appendix A.2, Eq. 22
-    num = z * (dkp1 * z + 2 * sk * az) + dk * az**2
-    den = sk + (dkp1 + dk - 2 * sk) * z * az
-    log_det = 2 * jnp.log(sk + EPS) + jnp.log(num + EPS) - 2 * jnp.log(den + EPS)
-
-    # set log_det for out-of-bounds values to 0
-    log_det = jnp.where(out_of_bounds, 0, log_det)
-    log_det = log_det.sum(axis=1)
+    log_det = _log_det(z, dk, dkp1, sk, out_of_bounds)
 
     return y, log_det
 
@@ -147,7 +141,8 @@ def rational_quadratic_spline_inverse(
     """
     Apply the inverse rational quadratic spline mapping.
 
-    See rational_quadratic_spline_forward for implementation details.
+    See rational_quadratic_spline_forward for implementation details and
+    rational_quadratic_spline_inverse_and_log_det to also get the log-determinant.
 
     Parameters
     ----------
@@ -177,6 +172,46 @@ def rational_quadratic_spline_inverse(
         http://arxiv.org/abs/2002.02428
 
     """
+    return _inverse(y, dx, dy, slope, False)[0]
+
+
+def rational_quadratic_spline_inverse_and_log_det(
+    y: Array, dx: Array, dy: Array, slope: Array
+) -> Tuple[Array, Array]:
+    """
+    Apply the inverse rational quadratic spline mapping and return log-determinant.
+
+    The log-determinant is that of the forward mapping at the result x, so that it is
+    equal to the log-determinant returned by rational_quadratic_spline_forward(x, ...).
+    It is computed from intermediate results of the inverse at little extra cost.
+
+    Parameters
+    ----------
+    y : Array of shape (M, N)
+        The inputs to be transformed. The inputs are transformed in the interval [0, 1].
+        Values outside of the interval are returned unchanged.
+    dx : Array of shape (M, N, K)
+        The widths of the spline bins. The values must be positive and sum to unity.
+    dy : Array of shape (M, N, K)
+        The heights of the spline bins. The values must be positive and sum to unity.
+    slope : Array of shape (M, N, K - 1)
+        The derivatives at the inner spline knots. The values must be in the interval
+        [0, oo].
+
+    Returns
+    -------
+    x : Array of shape (M, N)
+        The result of applying the inverse splines to the inputs.
+    log_det : Array of shape (M,)
+        The log determinant of the Jacobian of the forward mapping at x.
+
+    """
+    return _inverse(y, dx, dy, slope, True)
+
+
+def _inverse(
+    y: Array, dx: Array, dy: Array, slope: Array, log_det: bool
+) -> Tuple[Array, Optional[Array]]:
     (
         xk,
         yk,
@@ -199,7 +234,25 @@ def rational_quadratic_spline_inverse(
 
     # replace out-of-bounds values with original values
     x = jnp.where(out_of_bounds, y, x)
-    return x
+    if not log_det:
+        return x, None
+    # z is the relative position of x in its bin, as in the forward mapping
+    z = jnp.clip(z, EPS, 1 - EPS)
+    return x, _log_det(z, dk, dkp1, sk, out_of_bounds)
+
+
+def _log_det(
+    z: Array, dk: Array, dkp1: Array, sk: Array, out_of_bounds: Array
+) -> Array:
+    # [1] Appendix A.2, Eq. 22
+    az = 1 - z
+    num = z * (dkp1 * z + 2 * sk * az) + dk * az**2
+    den = sk + (dkp1 + dk - 2 * sk) * z * az
+    log_det = 2 * jnp.log(sk + EPS) + jnp.log(num + EPS) - 2 * jnp.log(den + EPS)
+
+    # set log_det for out-of-bounds values to 0
+    log_det = jnp.where(out_of_bounds, 0, log_det)
+    return log_det.sum(axis=1)
 
 
 def _compute_rqs_input(
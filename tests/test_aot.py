@@ -0,0 +1,52 @@
+from zenflow import Flow
+from zenflow.aot import AotFlow, enable_compilation_cache
+from zenflow.bijectors import rolling_spline_coupling
+import jax
+import numpy as np
+from numpy.testing import assert_allclose
+import pytest
+
+
+@pytest.fixture
+def trained():
+    x = np.random.default_rng(1).normal(size=(10, 2)).astype(np.float32)
+    c = np.arange(10, dtype=np.float32)
+    flow = Flow(rolling_spline_coupling(2, layers=(8,)))
+    variables = flow.init(jax.random.PRNGKey(0), x, c)
+    _, updates = flow.apply(variables, x, c, train=True, mutable=["batch_stats"])
+    variables = {"params": variables["params"], **updates}
+    return flow, variables, x, c
+
+
+def test_AotFlow(trained, tmp_path):
+    flow, variables, x, c = trained
+    aot = AotFlow.compile(flow, variables, x.shape, c.shape)
+    lp_ref = flow.apply(variables, x, c)
+    assert_allclose(aot.log_prob(x, c), lp_ref, atol=1e-4)
+    x_ref = flow.apply(variables, c, seed=1, method="sample")
+    assert_allclose(aot.sample(c, seed=1), x_ref, atol=1e-5)
+
+    aot.save(tmp_path / "flow.aot")
+    aot2 = AotFlow.load(tmp_path / "flow.aot")
+    assert aot2.shapes == aot.shapes
+    assert_allclose(aot2.log_prob(x, c), lp_ref, atol=1e-4)
+    assert_allclose(aot2.sample(c, seed=1), x_ref, atol=1e-5)
+
+
+def test_AotFlow_unconditional(trained):
+    flow, _, x, _ = trained
+    variables = flow.init(jax.random.PRNGKey(0), x)
+    aot = AotFlow.compile(flow, variables, sample_size=5)
+    assert aot.sample(seed=1).shape == (5, 2)
+    with pytest.raises(ValueError):
+        aot.log_prob(x)
+
+
+def test_enable_compilation_cache(tmp_path, monkeypatch):
+    calls = {}
+    monkeypatch.setattr(jax.config, "update", lambda k, v: calls.update({k: v}))
+    monkeypatch.setenv("ZENFLOW_CACHE_DIR", str(tmp_path / "foo"))
+    path = enable_compilation_cache()
+    assert path == str(tmp_path / "foo")
+    assert (tmp_path / "foo").exists()
+    assert calls["jax_compilation_cache_dir"] == path
@@ -1,10 +1,13 @@
 from zenflow import bijectors as bi
+from zenflow import Flow
+from zenflow.distributions import Beta
 import jax
 from jax import numpy as jnp
 import numpy as np
 from numpy.testing import assert_allclose
 import pytest
 from typing import Tuple
+import warnings
 from flax.typing import Array
 
 KEY = jax.random.PRNGKey(0)
@@ -40,15 +43,15 @@ def test_ShiftBounds_1():
         variables, x, None, train=True, mutable=["batch_stats"]
     )
     bs = updates["batch_stats"]
-    assert_allclose(bs["xmin_0"], 0.975)
-    assert_allclose(bs["xmax_0"], 6.025)
-    assert_allclose(bs["xmin_1"], 1.985)
-    assert_allclose(bs["xmax_1"], 5.015)
+    assert_allclose(bs["xmin"][0], 0.975)
+    assert_allclose(bs["xmax"][0], 6.025)
+    assert_allclose(bs["xmin"][1], 1.985)
+    assert_allclose(bs["xmax"][1], 5.015)
 
     y_ref = np.column_stack(
         [
-            (x[:, 0] - bs["xmin_0"]) / (bs["xmax_0"] - bs["xmin_0"]),
-            (x[:, 1] - bs["xmin_1"]) / (bs["xmax_1"] - bs["xmin_1"]),
+            (x[:, 0] - bs["xmin"][0]) / (bs["xmax"][0] - bs["xmin"][0]),
+            (x[:, 1] - bs["xmin"][1]) / (bs["xmax"][1] - bs["xmin"][1]),
         ]
     )
 
@@ -57,6 +60,9 @@ def test_ShiftBounds_1():
     x2 = sb.apply(updates, y, None, method="inverse")
     assert_allclose(x2, x, atol=1e-6)
 
+    with pytest.raises(ValueError):
+        sb.apply(updates, x[:, :1])
+
 
 def test_ShiftBounds_2():
     x = jnp.column_stack(
@@ -237,11 +243,38 @@ def test_NeuralSplineCoupling_1():
 
 def test_NeuralSplineCoupling_2():
     x = jnp.array([[1.5, 2, 3.3], [1, 3.5, 4.5], [3.5, 4, 5.5]])
-    xt, xc = bi.NeuralSplineCoupling._split(x)
+    xt, xc = bi.NeuralSplineCoupling()._split(x)
     assert xt.shape[1] == 1
     assert xc.shape[1] == 2
 
 
+def test_NeuralSplineCoupling_indices():
+    x = jnp.array([[0.1, 0.2, 0.3, 0.4], [0.5, 0.6, 0.7, 0.8], [0.9, 0.1, 0.2, 0.3]])
+    nsc = bi.NeuralSplineCoupling(layers=(8,), transformed=(3, 0), conditioning=(2, 1))
+    xt, xc = nsc._split(x)
+    assert_allclose(xt, x[:, [3, 0]])
+    assert_allclose(xc, x[:, [2, 1]])
+
+    variables = nsc.init(KEY, x)
+    y, _ = nsc.apply(variables, x)
+    # conditioning dimensions keep their values and positions
+    assert_allclose(y[:, 1:3], x[:, 1:3])
+    assert np.all(y[:, [0, 3]] != x[:, [0, 3]])
+    assert_allclose(nsc.apply(variables, y, method="inverse"), x, atol=1e-5)
+
+    # default for conditioning are the remaining dimensions in ascending order
+    xt, xc = bi.NeuralSplineCoupling(transformed=(1,))._split(x)
+    assert_allclose(xc, x[:, [0, 2, 3]])
+
+    for kwargs in (
+        {"transformed": (0, 1), "conditioning": (1, 2, 3)},
+        {"transformed": (0,), "conditioning": (1, 2)},
+        {"conditioning": (0, 1)},
+    ):
+        with pytest.raises(ValueError):
+            bi.NeuralSplineCoupling(layers=(8,), **kwargs).init(KEY, x)
+
+
 def test_rolling_spline_coupling():
     x = jnp.array([[1.5, 2], [1, 3.5], [3.5, 4]])
     c = jnp.array([[1.0], [2.0], [3.0]])
@@ -256,6 +289,42 @@ def test_rolling_spline_coupling():
     assert_allclose(x2, x, atol=1e-4)
 
 
+@pytest.mark.parametrize("dim", [2, 3, 5])
+def test_rolling_spline_coupling_old_variables(dim):
+    # older versions alternated couplings with Roll
+    rolled = [bi.ShiftBounds()]
+    for _ in range(dim - 1):
+        rolled += [bi.NeuralSplineCoupling(layers=(8,)), bi.Roll()]
+    rolled = bi.Chain(rolled + [bi.NeuralSplineCoupling(layers=(8,))])
+    rsc = bi.rolling_spline_coupling(dim, layers=(8,))
+    assert sum(isinstance(b, bi.Roll) for b in rsc) == 1
+
+    rng = np.random.default_rng(1)
+    x = rng.normal(size=(20, dim)).astype(np.float32)
+    c = rng.normal(size=(20, 1)).astype(np.float32)
+    variables = rolled.init(KEY, x, c)
+    _, updates = rolled.apply(variables, x, c, train=True, mutable=["batch_stats"])
+    variables = {**variables, **updates}
+    assert jax.tree_util.tree_structure(
+        rsc.init(KEY, x, c)
+    ) == jax.tree_util.tree_structure(variables)
+
+    z, log_det = rsc.apply(variables, x, c)
+    z_ref, log_det_ref = rolled.apply(variables, x, c)
+    assert_allclose(z, z_ref, atol=1e-6)
+    assert_allclose(log_det, log_det_ref, rtol=1e-5)
+
+    # samples of a checkpoint trained with an older version are reproduced
+    variables = {col: {"bijector": v} for col, v in variables.items()}
+    samples = []
+    for bijector in (rsc, rolled):
+        flow = Flow(bijector, Beta())
+        flow.apply(variables, x, c)  # sets the dimension of the latent distribution
+        samples.append(flow.apply(variables, c, method="sample", seed=2))
+    samples, samples_ref = samples
+    assert_allclose(samples, samples_ref, rtol=1e-4, atol=1e-5)
+
+
 def test_rolling_spline_coupling_bad_input():
 
     with pytest.raises(ValueError):
@@ -263,3 +332,230 @@ def test_rolling_spline_coupling_bad_input():
 
     with pytest.raises(ValueError):
         bi.rolling_spline_coupling(1)
+
+
+def test_ShiftBounds_mask():
+    x = jnp.array([[1.0, 5.0], [3.0, 4.0], [6.0, 2.0], [100.0, -100.0]])
+    mask = jnp.array([True, True, True, False])
+    sb = bi.ShiftBounds(margin=0.0)
+    variables = sb.init(KEY, x, None)
+    _, updates = sb.apply(
+        variables, x, None, train=True, mask=mask, mutable=["batch_stats"]
+    )
+    bs = updates["batch_stats"]
+    assert_allclose(bs["xmin"][0], 1)
+    assert_allclose(bs["xmax"][0], 6)
+    assert_allclose(bs["xmin"][1], 2)
+    assert_allclose(bs["xmax"][1], 5)
+
+
+def test_ShiftBounds_float64_input():
+    x = np.array([[1.5, 2, 0.5], [1, 3.5, 1.5], [3.5, 4, 2.0]])
+    sb = bi.ShiftBounds(bounds=[(0, 0, 4), (1, 0, None)])
+    with warnings.catch_warnings():
+        # no warning about float64 being truncated to float32 without jax_enable_x64
+        warnings.simplefilter("error")
+        variables = sb.init(KEY, x)
+        _, variables = sb.apply(variables, x, train=True, mutable=["batch_stats"])
+        z, log_det = sb.apply(variables, x)
+        x2, log_det2 = sb.apply(variables, np.asarray(z), method="inverse_and_log_det")
+    assert z.dtype == jnp.result_type(float)
+    assert_allclose(x2, x, rtol=1e-5)
+    assert_allclose(log_det2, log_det, rtol=1e-5)
+
+
+def test_ShiftBounds_legacy_batch_stats():
+    x = jnp.array([[1.5, 2, 0.5, 4], [1, 3.5, 1.5, 5], [3.5, 4, 2.0, 6]])
+    sb = bi.ShiftBounds(bounds=[(0, 0.0, 10.0), (1, -1.0, None), (2, None, 6.0)])
+    variables = sb.init(KEY, x)
+    _, variables = sb.apply(variables, x, train=True, mutable=["batch_stats"])
+    bs = variables["batch_stats"]
+
+    # older versions stored one variable per column, except for fully bounded ones
+    legacy = {"batch_stats": {}}
+    for i in (1, 2, 3):
+        legacy["batch_stats"][f"xmin_{i}"] = bs["xmin"][i : i + 1]
+        legacy["batch_stats"][f"xmax_{i}"] = bs["xmax"][i : i + 1]
+
+    y, log_det = sb.apply(variables, x)
+    y2, log_det2 = sb.apply(legacy, x)
+    assert_allclose(y2, y)
+    assert_allclose(log_det2, log_det)
+    assert_allclose(sb.apply(legacy, y, method="inverse"), x, rtol=1e-5)
+    for a, b in zip(
+        sb.apply(legacy, method="domain"), sb.apply(variables, method="domain")
+    ):
+        assert_allclose(a, b)
+
+    # training with old variables stores the new ones
+    _, updates = sb.apply(legacy, x, train=True, mutable=["batch_stats"])
+    assert_allclose(updates["batch_stats"]["xmin"][1:], bs["xmin"][1:])
+    assert_allclose(updates["batch_stats"]["xmax"][1:], bs["xmax"][1:])
+
+
+def test_Chain_mask():
+    x = jnp.array([[1.5, 2], [1, 3.5], [3.5, 4], [1e3, -1e3]])
+    mask = jnp.array([True, True, True, False])
+    chain = bi.rolling_spline_coupling(2, layers=(8,))
+    variables = chain.init(KEY, x, None)
+    _, updates = chain.apply(
+        variables, x, None, train=True, mask=mask, mutable=["batch_stats"]
+    )
+    _, ref = chain.apply(variables, x[:3], None, train=True, mutable=["batch_stats"])
+    for a, b in zip(jax.tree_util.tree_leaves(updates), jax.tree_util.tree_leaves(ref)):
+        assert_allclose(a, b, rtol=1e-5)
+
+
+def test_NeuralSplineCoupling_dtype():
+    x = jnp.array([[1.5, 2], [1, 3.5], [3.5, 4]])
+    c = jnp.array([[1.0], [2.0], [3.0]])
+    nsc = bi.NeuralSplineCoupling(layers=(16,))
+    variables = nsc.init(KEY, x, c)
+    y, log_det = nsc.apply(variables, x, c)
+    nsc16 = bi.NeuralSplineCoupling(layers=(16,), dtype=jnp.bfloat16)
+    variables16 = nsc16.init(KEY, x, c)
+    for a, b in zip(
+        jax.tree_util.tree_leaves(variables), jax.tree_util.tree_leaves(variables16)
+    ):
+        assert a.dtype == b.dtype
+    y16, log_det16 = nsc16.apply(variables, x, c)
+    assert y16.dtype == x.dtype
+    assert log_det16.dtype == x.dtype
+    assert_allclose(y16, y, atol=1e-2)
+    assert_allclose(log_det16, log_det, atol=1e-2)
+    x2 = nsc16.apply(variables, y16, c, method="inverse")
+    assert_allclose(x2, x, atol=1e-5)
+
+
+def _stack_couplings(variables, dim, offset=1):
+    # convert variables of rolling_spline_coupling to those with remat
+    names = [f"bijectors_{offset + 2 * k}" for k in range(dim)]
+    result = {}
+    for col, v in variables.items():
+        v = dict(v)
+        couplings = [v.pop(name) for name in names]
+        v[f"bijectors_{offset}"] = {
+            "coupling": jax.tree_util.tree_map(lambda *a: jnp.stack(a), *couplings)
+        }
+        result[col] = v
+    return result
+
+
+@pytest.mark.parametrize(
+    "remat, policy",
+    [(True, None), (2, None), (3, jax.checkpoint_policies.dots_saveable)],
+)
+def test_RollingSplineCoupling(remat, policy):
+    x = jnp.array([[1.5, 2, 0.5], [1, 3.5, 1.5], [3.5, 4, 2.0], [1e3, -1e3, 0.0]])
+    c = jnp.array([[0.1], [0.2], [0.3], [0.4]])
+    mask = jnp.array([True, True, True, False])
+    ref = bi.rolling_spline_coupling(3, layers=(8,))
+    chain = bi.rolling_spline_coupling(3, layers=(8,), remat=remat, remat_policy=policy)
+    assert isinstance(chain[1], bi.RollingSplineCoupling)
+    variables = ref.init(KEY, x, c)
+    stacked = _stack_couplings(variables, 3)
+    assert jax.tree_util.tree_map(jnp.shape, chain.init(KEY, x, c)) == (
+        jax.tree_util.tree_map(jnp.shape, stacked)
+    )
+
+    def loss(bijector, variables, params):
+        (z, log_det), updates = bijector.apply(
+            {"params": params, "batch_stats": variables["batch_stats"]},
+            x,
+            c,
+            train=True,
+            mask=mask,
+            mutable=["batch_stats"],
+        )
+        return jnp.sum(jnp.where(mask, log_det, 0)), (z, updates["batch_stats"])
+
+    expected, (z_ref, stats_ref) = jax.grad(
+        lambda p: loss(ref, variables, p), has_aux=True
+    )(variables["params"])
+    got, (z, stats) = jax.grad(lambda p: loss(chain, stacked, p), has_aux=True)(
+        stacked["params"]
+    )
+    assert_allclose(z, z_ref, rtol=1e-6)
+    expected = _stack_couplings({"params": expected, "batch_stats": stats_ref}, 3)
+    for a, b in zip(
+        jax.tree_util.tree_leaves({"params": got, "batch_stats": stats}),
+        jax.tree_util.tree_leaves(expected),
+    ):
+        assert_allclose(a, b, rtol=1e-4, atol=1e-6)
+
+    stacked = {"params": stacked["params"], "batch_stats": stats}
+    z, log_det = chain.apply(stacked, x[:3], c[:3])
+    x2, log_det2 = chain.apply(stacked, z, c[:3], method="inverse_and_log_det")
+    assert_allclose(x2, x[:3], rtol=1e-5)
+    assert_allclose(log_det2, log_det, rtol=1e-5)
+    assert_allclose(chain.apply(stacked, z, c[:3], method="inverse"), x2)
+
+    with pytest.raises(ValueError):
+        bi.rolling_spline_coupling(3, remat=-1)
+
+
+@pytest.mark.parametrize(
+    "bijector",
+    [
+        bi.ShiftBounds(),
+        bi.ShiftBounds(bounds=[(0, 0.0, 10.0), (1, -1.0, None), (2, None, 6.0)]),
+        bi.Roll(),
+        bi.NeuralSplineCoupling(layers=(8,)),
+        bi.NeuralSplineCoupling(layers=(8,), transformed=(2, 0)),
+        bi.rolling_spline_coupling(3, layers=(8,)),
+        bi.elementwise_spline(),
+        bi.elementwise_spline(layers=(8,), bounds=[(1, -1.0, None)]),
+    ],
+)
+def test_inverse_and_log_det(bijector):
+    x = jnp.array([[1.5, 2, 0.5], [1, 3.5, 1.5], [3.5, 4, 2.0], [2.5, 0.5, 3.0]])
+    c = jnp.array([[1.0], [2.0], [3.0], [4.0]])
+    variables = bijector.init(KEY, x, c)
+    _, updates = bijector.apply(variables, x, c, train=True, mutable=["batch_stats"])
+    variables = {**variables, **updates}
+    y, _ = bijector.apply(variables, x, c)
+    x2, log_det = bijector.apply(variables, y, c, method="inverse_and_log_det")
+    assert_allclose(x2, bijector.apply(variables, y, c, method="inverse"))
+    assert_allclose(x2, x, rtol=1e-4)
+    _, log_det_ref = bijector.apply(variables, x2, c)
+    assert_allclose(log_det, log_det_ref, rtol=1e-4, atol=1e-4)
+
+
+def test_inverse_and_log_det_default():
+    class Scale(bi.Bijector):
+        def __call__(self, x, c=None, train=False):
+            return 2 * x, jnp.full(x.shape[0], x.shape[1] * np.log(2))
+
+        def inverse(self, x, c=None):
+            return x / 2
+
+    x = jnp.array([[1.0, 2.0], [3.0, 4.0]])
+    y, log_det = Scale().apply({}, x, method="inverse_and_log_det")
+    assert_allclose(y, x / 2)
+    assert_allclose(log_det, 2 * np.log(2))
+
+
+def test_ElementwiseSpline():
+    x = jnp.array([[0.1, 0.5], [0.2, 0.7], [0.6, 0.3], [0.9, 0.4]])
+    c = jnp.array([[1.0], [2.0]])
+
+    # without c, the initial transform is the identity
+    b = bi.ElementwiseSpline()
+    variables = b.init(KEY, x)
+    y, log_det = b.apply(variables, x)
+    assert_allclose(y, x, atol=1e-6)
+    assert_allclose(log_det, 0, atol=1e-4)
+
+    # with c, rows of c may apply to several consecutive samples
+    b = bi.ElementwiseSpline(layers=(8,))
+    variables = b.init(KEY, x, c)
+    _, updates = b.apply(variables, x, c, train=True, mutable=["batch_stats"])
+    variables = {**variables, **updates}
+    y, log_det = b.apply(variables, x, c)
+    y2, log_det2 = b.apply(variables, x, jnp.repeat(c, 2, axis=0))
+    assert_allclose(y, y2)
+    assert_allclose(log_det, log_det2)
+    assert_allclose(b.apply(variables, y, c, method="inverse"), x, atol=1e-5)
+
+    with pytest.raises(ValueError):
+        b.apply(variables, x, jnp.ones((3, 1)))
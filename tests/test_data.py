@@ -0,0 +1,108 @@
+from zenflow import data, Flow, train
+from zenflow.bijectors import rolling_spline_coupling
+import numpy as np
+from numpy.testing import assert_equal
+import pytest
+
+
+def test_ArraySource_from_npy(tmp_path):
+    x = np.arange(20.0).reshape(10, 2)
+    c = np.arange(10.0)
+    np.save(tmp_path / "x.npy", x)
+    np.save(tmp_path / "c.npy", c)
+    source = data.ArraySource.from_npy(
+        tmp_path / "x.npy", tmp_path / "c.npy", chunk_size=4
+    )
+    assert len(source) == 10
+    chunks = list(source.chunks(np.random.default_rng(1)))
+    assert sorted(len(x) for x, _ in chunks) == [2, 4, 4]
+    x2 = np.concatenate([x for x, _ in chunks])
+    c2 = np.concatenate([c for _, c in chunks])
+    assert_equal(np.sort(x2[:, 0]), x[:, 0])
+    assert_equal(x2[:, 0] / 2, c2)
+
+    with pytest.raises(ValueError):
+        data.ArraySource(x, c[:5])
+
+
+@pytest.mark.parametrize("batch_size", (3, 4, 20))
+def test_batches(batch_size):
+    x = np.arange(10.0).reshape(10, 1)
+    source = data.ChunkedSource(lambda i: (x[i * 3 : (i + 1) * 3], None), 4)
+    result = list(data.batches(source, batch_size, np.random.default_rng(1)))
+    for xi, ci, mi in result:
+        assert xi.shape == (batch_size, 1)
+        assert ci is None
+        assert mi.shape == (batch_size,)
+    x2 = np.concatenate([xi[mi] for xi, _, mi in result])
+    assert_equal(np.sort(x2[:, 0]), x[:, 0])
+
+
+def test_GeneratorSource():
+    def generate():
+        for i in range(3):
+            x = np.full((5, 2), i)
+            yield x, x[:, 0]
+
+    source = data.GeneratorSource(generate)
+    x, c = source.peek()
+    assert x.shape == (5, 2)
+    result = list(data.batches(source, 4, np.random.default_rng(1)))
+    assert len(result) == 4
+    for xi, ci, mi in result:
+        assert_equal(xi[:, 0], ci)
+    assert np.sum(result[-1][2]) == 3
+
+
+def test_prefetch():
+    assert list(data.prefetch(range(10), 2, lambda x: 2 * x)) == list(range(0, 20, 2))
+
+    def bad():
+        yield 1
+        raise RuntimeError("foo")
+
+    with pytest.raises(RuntimeError, match="foo"):
+        list(data.prefetch(bad()))
+
+    # stopping early must not block the background thread
+    for i in data.prefetch(range(100), 1):
+        if i == 3:
+            break
+
+
+def test_train_with_source():
+    rng = np.random.default_rng(1)
+    x = rng.normal(size=(100, 2))
+    source = data.ArraySource(x, chunk_size=40)
+    flow = Flow(rolling_spline_coupling(2, layers=(8,)))
+    variables, best_epoch, loss_train, loss_test = train(
+        flow, source, x, epochs=2, batch_size=32, patience=2, progress=False
+    )
+    assert len(loss_train) == 2
+    assert np.all(np.isfinite(loss_test))
+
+    with pytest.raises(ValueError):
+        train(flow, source, x, x, progress=False)
+
+
+def test_train_with_empty_epoch():
+    rng = np.random.default_rng(1)
+    x = rng.normal(size=(100, 2))
+    calls = []
+
+    def generate():
+        # data for peek and the first epoch, then the source is exhausted
+        calls.append(1)
+        return [(x, None)] if len(calls) <= 2 else []
+
+    flow = Flow(rolling_spline_coupling(2, layers=(8,)))
+    with pytest.raises(ValueError, match="no samples in epoch 1"):
+        train(
+            flow,
+            data.GeneratorSource(generate),
+            x,
+            epochs=2,
+            batch_size=32,
+            patience=2,
+            progress=False,
+        )
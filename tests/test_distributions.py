@@ -3,7 +3,7 @@ import jax.numpy as jnp
 import numpy as np
 from numpy.testing import assert_allclose, assert_array_compare
 from operator import gt, lt
-from jax.scipy.stats import multivariate_normal, beta
+from jax.scipy.stats import multivariate_normal, beta, norm, truncnorm
 import jax
 import pytest
 
@@ -84,3 +84,21 @@ def test_Beta():
 
     with pytest.raises(ValueError):
         dist.Beta(-1)
+
+
+@pytest.mark.parametrize(
+    "d,cdf",
+    [
+        (dist.Uniform(), lambda x: x),
+        (dist.Normal(), lambda x: norm.cdf(x, 0.5, 0.1)),
+        (dist.TruncatedNormal(), lambda x: truncnorm.cdf(x, -5, 5, 0.5, 0.1)),
+        (dist.Beta(), lambda x: beta.cdf(x, 12, 12)),
+        (dist.Beta(1.5), lambda x: beta.cdf(x, 1.5, 1.5)),
+        (dist.Beta(1), lambda x: x),
+    ],
+)
+def test_cdf_and_ppf(d, cdf):
+    x = jnp.linspace(0.1, 0.9, 17).reshape(-1, 1)
+    assert_allclose(d.cdf(x), cdf(x), atol=1e-6)
+    q = jnp.linspace(0.001, 0.999, 11)
+    assert_allclose(d.cdf(d.ppf(q)), q, atol=1e-6)
@@ -1,7 +1,14 @@
-from zenflow import Flow
-from zenflow.bijectors import ShiftBounds
+from typing import Callable
+from zenflow import Flow, ensemble_log_prob
+from zenflow.bijectors import ShiftBounds, elementwise_spline, rolling_spline_coupling
+from zenflow.distributions import Beta
+from flax import linen as nn
+from jax.experimental import sparse
 import jax
 import jax.numpy as jnp
+import numpy as np
+from numpy.testing import assert_allclose
+import pytest
 
 
 def test_Flow_1():
@@ -27,3 +34,217 @@ def test_Flow_2():
     )
     x2 = flow.apply(variables, c, method="sample")
     assert x2.shape == (3, 2)
+
+
+def test_ensemble_log_prob():
+    flow = Flow(rolling_spline_coupling(2, layers=(8,)))
+    x = jnp.array([[3.0, 2.0], [1.0, 4.0], [5.0, 6.0]])
+    variables = []
+    for seed in (0, 1):
+        v = flow.init(jax.random.PRNGKey(seed), x)
+        _, updates = flow.apply(v, x, train=True, mutable=["batch_stats"])
+        variables.append({"params": v["params"], **updates})
+    v1, v2 = variables
+    lp1 = flow.apply(v1, x)
+    lp2 = flow.apply(v2, x)
+    lp = ensemble_log_prob(flow, [v1, v2], x)
+    assert_allclose(lp, np.log(0.5 * (np.exp(lp1) + np.exp(lp2))), rtol=1e-5)
+
+
+@pytest.mark.parametrize("dtype", [jnp.bfloat16, jnp.float16])
+def test_Flow_dtype(dtype):
+    x = np.random.default_rng(1).normal(size=(1000, 3)).astype(np.float32)
+    flow = Flow(rolling_spline_coupling(3, layers=(32, 32)))
+    v = flow.init(jax.random.PRNGKey(0), x)
+    _, updates = flow.apply(v, x, train=True, mutable=["batch_stats"])
+    v = {"params": v["params"], **updates}
+    lp = flow.apply(v, x)
+    flow16 = flow.clone(dtype=dtype)
+    lp16 = flow16.apply(v, x)
+    assert lp16.dtype == jnp.float32
+    assert_allclose(lp16, lp, atol=0.1)
+    assert abs(np.mean(lp16 - lp)) < 1e-2
+    assert_allclose(Flow(flow.bijector, dtype=dtype).apply(v, x), lp16)
+
+
+def test_Flow_sample_and_log_prob():
+    x = np.random.default_rng(1).normal(size=(100, 3)).astype(np.float32)
+    c = np.linspace(0, 1, 100, dtype=np.float32)
+    for c_init, args in ((c, (c,)), (None, (100,))):
+        flow = Flow(rolling_spline_coupling(3, layers=(8,)), Beta())
+        v = flow.init(jax.random.PRNGKey(0), x, c_init)
+        _, updates = flow.apply(v, x, c_init, train=True, mutable=["batch_stats"])
+        v = {"params": v["params"], **updates}
+        x2, lp = flow.apply(v, *args, seed=1, method="sample_and_log_prob")
+        assert_allclose(x2, flow.apply(v, *args, seed=1, method="sample"))
+        assert_allclose(lp, flow.apply(v, x2, c_init), rtol=1e-3, atol=1e-3)
+
+
+@pytest.mark.parametrize("dtype", [None, jnp.bfloat16])
+def test_Flow_sample_per_condition(dtype):
+    rng = np.random.default_rng(1)
+    x = rng.normal(size=(100, 3)).astype(np.float32)
+    c = rng.normal(size=(100, 2)).astype(np.float32)
+    flow = Flow(rolling_spline_coupling(3, layers=(8,)), Beta(), dtype=dtype)
+    v = flow.init(jax.random.PRNGKey(0), x, c)
+    _, updates = flow.apply(v, x, c, train=True, mutable=["batch_stats"])
+    v = {"params": v["params"], **updates}
+
+    x2 = flow.apply(v, c[:4], 25, seed=1, method="sample_per_condition")
+    assert x2.shape == (4, 25, 3)
+    ref = flow.apply(v, np.repeat(c[:4], 25, axis=0), seed=1, method="sample")
+    tol = 1e-5 if dtype is None else 1e-2
+    assert_allclose(x2.reshape(100, 3), ref, rtol=tol, atol=tol)
+
+    # log-likelihood with one condition for groups of samples
+    lp = flow.apply(v, x, c[:4])
+    assert_allclose(lp, flow.apply(v, x, np.repeat(c[:4], 25, axis=0)), rtol=tol)
+
+    with pytest.raises(ValueError):
+        flow.apply(v, x, c[:3])
+
+
+@pytest.mark.parametrize("bounds", [(), [(0, 0.0, None)], [(0, None, 0.0)]])
+def test_Flow_cdf_and_ppf(bounds):
+    rng = np.random.default_rng(1)
+    x = rng.exponential(size=(1000, 1)).astype(np.float32)
+    if bounds and bounds[0][1] is None:
+        x = -x
+    flow = Flow(elementwise_spline(knots=8, bounds=bounds))
+    variables = flow.init(jax.random.PRNGKey(0), x)
+    _, updates = flow.apply(variables, x, train=True, mutable=["batch_stats"])
+    variables = {**variables, **updates}
+
+    # cdf is the integral of the density
+    t = np.linspace(x.min(), x.max(), 10001)
+    p = np.exp(flow.apply(variables, t[:, None]))
+    integral = np.cumsum(np.append(0, 0.5 * (p[1:] + p[:-1]) * np.diff(t)))
+    cdf = flow.apply(variables, t, method="cdf")
+    assert cdf.shape == (10001,)
+    assert np.all(np.diff(cdf) >= 0)
+    assert_allclose(cdf, integral, atol=1e-4)
+
+    q = np.linspace(0.01, 0.99, 9)
+    assert_allclose(
+        flow.apply(variables, flow.apply(variables, q, method="ppf"), method="cdf"),
+        q,
+        atol=1e-5,
+    )
+
+    with pytest.raises(ValueError):
+        flow.apply(variables, np.zeros((3, 2)), method="cdf")
+
+
+def test_Flow_cdf_and_ppf_conditional():
+    rng = np.random.default_rng(1)
+    c = rng.normal(size=(1000, 2)).astype(np.float32)
+    x = rng.normal(c[:, 0], np.exp(0.3 * c[:, 1]))[:, None].astype(np.float32)
+    flow = Flow(elementwise_spline(knots=8, layers=(16,)))
+    variables = flow.init(jax.random.PRNGKey(0), x, c)
+    _, updates = flow.apply(variables, x, c, train=True, mutable=["batch_stats"])
+    variables = {**variables, **updates}
+
+    q = rng.uniform(size=1000)
+    xq = flow.apply(variables, q, c, method="ppf")
+    assert xq.shape == (1000,)
+    assert_allclose(flow.apply(variables, xq, c, method="cdf"), q, atol=1e-5)
+
+
+def test_Flow_context(tmp_path):
+    rng = np.random.default_rng(1)
+    x = rng.normal(size=(50, 2)).astype(np.float32)
+    c = rng.normal(size=(50, 20)).astype(np.float32)
+    flow = Flow(rolling_spline_coupling(2, layers=(8,)), Beta(), context=nn.Dense(3))
+    variables = flow.init(jax.random.PRNGKey(0), x, c)
+    _, updates = flow.apply(variables, x, c, train=True, mutable=["batch_stats"])
+    variables = {**variables, **updates}
+
+    # the bijectors receive the embedding
+    h = nn.Dense(3).apply({"params": variables["params"]["context"]}, c)
+    ref = Flow(rolling_spline_coupling(2, layers=(8,)), Beta())
+    ref_variables = {
+        "params": {"bijector": variables["params"]["bijector"]},
+        "batch_stats": variables["batch_stats"],
+    }
+    assert_allclose(
+        flow.apply(variables, x, c), ref.apply(ref_variables, x, h), rtol=1e-5
+    )
+    assert_allclose(
+        flow.apply(variables, c, method="sample"),
+        ref.apply(ref_variables, h, method="sample"),
+        rtol=1e-5,
+    )
+    assert_allclose(
+        flow.compile(variables).log_prob(x, c), flow.apply(variables, x, c), rtol=1e-5
+    )
+
+    with pytest.raises(ValueError):
+        flow.export(variables, tmp_path / "flow.npz")
+
+
+def test_Flow_context_deep_set():
+    # Phi network of examples/deep_set.ipynb
+    class NNBlock(nn.Module):
+        out_dim: int
+        depth: int
+        width: int
+        act: Callable = nn.swish
+
+        @nn.compact
+        def __call__(self, x):
+            for _ in range(self.depth):
+                x = nn.Dense(self.width)(x)
+                x = self.act(x)
+            return nn.Dense(self.out_dim)(x)
+
+    class Phi(nn.Module):
+        @nn.compact
+        def __call__(self, x, sum_matrix, train: bool = False):
+            x = nn.BatchNorm(use_running_average=not train)(x)
+            x = NNBlock(8, 3, 128)(x)
+            x = nn.Dropout(rate=0.3, deterministic=not train)(x)
+            x = sum_matrix @ x
+            return x
+
+    # sets of sizes 3, 1, 4, 2 with elements of dimension 2
+    rng = np.random.default_rng(1)
+    sizes = np.array([3, 1, 4, 2])
+    elements = rng.normal(size=(sizes.sum(), 2)).astype(np.float32)
+    rows = np.repeat(np.arange(len(sizes)), sizes)
+    indices = np.column_stack([rows, np.arange(len(rows))])
+    sum_matrix = sparse.BCOO(
+        (np.ones(len(rows), dtype=np.float32), indices), shape=(4, len(rows))
+    )
+    c = (elements, sum_matrix)
+    y = rng.normal(size=(4, 2)).astype(np.float32)
+
+    flow = Flow(rolling_spline_coupling(2, layers=(8,)), Beta(), context=Phi())
+    variables = flow.init(jax.random.PRNGKey(0), y, c)
+    lp, updates = flow.apply(
+        variables,
+        y,
+        c,
+        train=True,
+        mutable=["batch_stats"],
+        rngs={"dropout": jax.random.PRNGKey(1)},
+    )
+    assert lp.shape == (4,)
+    assert "context" in updates["batch_stats"]
+    variables = {**variables, **updates}
+
+    assert flow.apply(variables, c, method="sample").shape == (4, 2)
+    x = flow.apply(variables, c, 5, method="sample_per_condition")
+    assert x.shape == (4, 5, 2)
+    # a permutation of the elements of a set does not change the result
+    perm = np.arange(len(rows))
+    perm[:3] = perm[:3][::-1]
+    lp = flow.apply(variables, y, c)
+    lp2 = flow.apply(variables, y, (elements[perm], sum_matrix))
+    assert_allclose(lp2, lp, rtol=1e-5)
+
+    # tuples cannot be padded to the buckets of the predictor
+    predictor = flow.compile(variables)
+    with pytest.raises(ValueError, match="tuples"):
+        predictor.log_prob(y, c)
+    with pytest.raises(ValueError, match="tuples"):
+        predictor.sample(c)
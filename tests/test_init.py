@@ -0,0 +1,26 @@
+import subprocess
+import sys
+
+
+def _run(code):
+    subprocess.run([sys.executable, "-c", code], check=True)
+
+
+def test_lazy_imports():
+    _run(
+        "import sys, zenflow, zenflow.utils, zenflow.distributions; "
+        "assert not {'flax', 'optax'} & set(sys.modules)"
+    )
+    _run(
+        "import sys, zenflow; zenflow.Flow; "
+        "assert 'flax' in sys.modules and 'optax' not in sys.modules"
+    )
+
+
+def test_train_function_not_shadowed_by_module():
+    _run(
+        "import sys, zenflow.train, zenflow; "
+        "from zenflow.train import DEFAULT_OPTIMIZER; "
+        "assert zenflow.train is sys.modules['zenflow.train'].train; "
+        "assert 'train' in dir(zenflow)"
+    )
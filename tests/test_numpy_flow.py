@@ -0,0 +1,112 @@
+from zenflow import Flow
+from zenflow.bijectors import (
+    Chain,
+    NeuralSplineCoupling,
+    Roll,
+    ShiftBounds,
+    rolling_spline_coupling,
+)
+from zenflow.distributions import Beta, Normal, TruncatedNormal, Uniform
+from zenflow.numpy_flow import NumpyFlow
+import jax
+import numpy as np
+from numpy.testing import assert_allclose
+import pytest
+import subprocess
+import sys
+
+
+def _trained(flow, x, c=None):
+    variables = flow.init(jax.random.PRNGKey(0), x, c)
+    _, updates = flow.apply(variables, x, c, train=True, mutable=["batch_stats"])
+    return {"params": variables["params"], **updates}
+
+
+@pytest.mark.parametrize("conditional", [False, True])
+@pytest.mark.parametrize("latent", [Beta, Beta(1.5), Normal, TruncatedNormal, Uniform])
+def test_NumpyFlow_log_prob(tmp_path, conditional, latent):
+    rng = np.random.default_rng(1)
+    x = rng.normal(size=(200, 3)).astype(np.float32)
+    x[:, 1] = np.exp(x[:, 1])
+    x[:, 2] = rng.uniform(-1, 2, size=200)
+    c = rng.normal(size=(200, 2)).astype(np.float32) if conditional else None
+    bijector = rolling_spline_coupling(
+        3, layers=(8, 8), bounds=[(1, 0, None), (2, -1, 2)]
+    )
+    flow = Flow(bijector, latent() if isinstance(latent, type) else latent)
+    variables = _trained(flow, x, c)
+    flow.export(variables, tmp_path / "flow.npz")
+    nflow = NumpyFlow.load(tmp_path / "flow.npz")
+    assert nflow.dim == 3
+
+    # shift training data slightly, so that not all values are at the bounds
+    x2 = x * 0.9
+    x2[:, 2] = x[:, 2]
+    assert_allclose(
+        nflow.log_prob(x2, c), flow.apply(variables, x2, c), rtol=1e-4, atol=1e-4
+    )
+
+    z = flow.latent.sample(200, jax.random.PRNGKey(1))
+    ref = flow.apply(variables, z, c, method=lambda m, z, c: m.bijector.inverse(z, c))
+    assert_allclose(nflow.inverse(np.asarray(z), c), ref, rtol=1e-4, atol=1e-4)
+
+    s = nflow.sample(c if conditional else 200, seed=1)
+    assert s.shape == (200, 3)
+    assert np.all(np.isfinite(nflow.log_prob(s, c)))
+
+
+def test_NumpyFlow_ShiftBounds(tmp_path):
+    rng = np.random.default_rng(1)
+    x = rng.uniform(0.1, 0.9, size=(100, 4)).astype(np.float32)
+    # one column of each kind: unbounded, lower, upper, and both bounds
+    bounds = [(1, 0, None), (2, None, 1), (3, 0, 1)]
+    bijector = Chain([ShiftBounds(bounds=bounds), NeuralSplineCoupling(layers=())])
+    flow = Flow(bijector, Beta())
+    variables = _trained(flow, x)
+    flow.export(variables, tmp_path / "flow.npz")
+    nflow = NumpyFlow.load(tmp_path / "flow.npz")
+    assert_allclose(nflow.log_prob(x), flow.apply(variables, x), rtol=1e-4, atol=1e-4)
+    z = np.asarray(flow.apply(variables, x, method=lambda m, x: m.bijector(x)[0]))
+    assert_allclose(nflow.inverse(z), x, rtol=1e-4, atol=1e-4)
+
+
+def test_NumpyFlow_nested_chain_and_activation(tmp_path):
+    rng = np.random.default_rng(1)
+    x = rng.normal(size=(100, 4)).astype(np.float32)
+    bijector = Chain(
+        [
+            ShiftBounds(),
+            Chain([NeuralSplineCoupling(layers=(), knots=5), Roll(shift=2)]),
+            NeuralSplineCoupling(layers=(4,), act=jax.nn.relu),
+        ]
+    )
+    flow = Flow(bijector, Beta())
+    variables = _trained(flow, x)
+    flow.export(variables, tmp_path / "flow.npz")
+    nflow = NumpyFlow.load(tmp_path / "flow.npz")
+    assert_allclose(nflow.log_prob(x), flow.apply(variables, x), rtol=1e-4, atol=1e-4)
+
+
+def test_NumpyFlow_RollingSplineCoupling(tmp_path):
+    rng = np.random.default_rng(1)
+    x = rng.normal(size=(100, 3)).astype(np.float32)
+    flow = Flow(rolling_spline_coupling(3, layers=(8,), remat=2), Beta())
+    variables = _trained(flow, x)
+    flow.export(variables, tmp_path / "flow.npz")
+    nflow = NumpyFlow.load(tmp_path / "flow.npz")
+    assert_allclose(nflow.log_prob(x), flow.apply(variables, x), rtol=1e-4, atol=1e-4)
+
+
+def test_export_unsupported(tmp_path):
+    x = np.zeros((10, 2), dtype=np.float32)
+    flow = Flow(NeuralSplineCoupling(act=lambda x: x), Beta())
+    with pytest.raises(ValueError, match="activation"):
+        flow.export(_trained(flow, x), tmp_path / "flow.npz")
+
+
+def test_NumpyFlow_import_without_jax():
+    code = (
+        "import sys, zenflow.numpy_flow; "
+        "assert 'jax' not in sys.modules and 'flax' not in sys.modules"
+    )
+    subprocess.run([sys.executable, "-c", code], check=True)
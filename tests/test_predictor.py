@@ -0,0 +1,103 @@
+from zenflow import Flow
+from zenflow.bijectors import rolling_spline_coupling
+import jax
+import numpy as np
+from numpy.testing import assert_allclose, assert_equal
+import pytest
+
+
+@pytest.fixture
+def trained():
+    rng = np.random.default_rng(1)
+    x = rng.normal(size=(300, 2)).astype(np.float32)
+    c = rng.normal(size=300).astype(np.float32)
+    flow = Flow(rolling_spline_coupling(2, layers=(8,)))
+    variables = flow.init(jax.random.PRNGKey(0), x, c)
+    _, updates = flow.apply(variables, x, c, train=True, mutable=["batch_stats"])
+    variables = {"params": variables["params"], **updates}
+    return flow, variables, x, c
+
+
+def test_Predictor_log_prob(trained):
+    flow, variables, x, c = trained
+    predictor = flow.compile(variables, min_bucket=4, max_bucket=128)
+    assert predictor.min_bucket == 4
+    assert predictor.max_bucket == 128
+    lp_ref = flow.apply(variables, x, c)
+    for n in (0, 1, 3, 5, 100, 128, 129, 300):
+        lp = predictor.log_prob(x[:n], c[:n])
+        assert lp.shape == (n,)
+        assert_allclose(lp, lp_ref[:n], rtol=1e-5, atol=1e-5)
+    # buckets 4, 8, 128, and 64 for the rest of 300
+    assert predictor._log_prob._cache_size() == 4
+
+    lp = predictor.log_prob(jax.numpy.asarray(x[:10]), jax.numpy.asarray(c[:10]))
+    assert_allclose(lp, lp_ref[:10], rtol=1e-5, atol=1e-5)
+
+
+def test_Predictor_transform(trained):
+    flow, variables, x, c = trained
+    predictor = flow.compile(variables)
+    y = predictor.transform(x[:10], c[:10])
+    y_ref = flow.apply(
+        variables, x[:10], c[:10, None], method=lambda m, x, c: m.bijector(x, c)[0]
+    )
+    assert_allclose(y, y_ref, rtol=1e-5, atol=1e-6)
+
+
+def test_Predictor_sample(trained):
+    flow, variables, x, c = trained
+    predictor = flow.compile(variables, max_bucket=128)
+    for n in (0, 1, 100, 300):
+        s = predictor.sample(c[:n], seed=1)
+        assert s.shape == (n, 2)
+        assert_equal(np.asarray(s), np.asarray(predictor.sample(c[:n], seed=1)))
+    s = predictor.sample(c, seed=1)
+    assert np.all(s[:128] != s[128:256])
+    assert np.all(predictor.sample(c, seed=2) != s)
+    s2 = predictor.sample(c[100:], seed=1, offset=100)
+    assert_allclose(s2, s[100:], rtol=1e-5, atol=1e-5)
+
+    flow2 = Flow(rolling_spline_coupling(2, layers=(8,)))
+    variables2 = flow2.init(jax.random.PRNGKey(0), x)
+    predictor2 = flow2.compile(variables2)
+    assert predictor2.sample(10).shape == (10, 2)
+
+
+def test_Predictor_bad_buckets(trained):
+    flow, variables, _, _ = trained
+    with pytest.raises(ValueError):
+        flow.compile(variables, min_bucket=0)
+    with pytest.raises(ValueError):
+        flow.compile(variables, min_bucket=4, max_bucket=2)
+
+
+def test_Predictor_sample_blocks(trained, tmp_path):
+    flow, variables, x, c = trained
+    predictor = flow.compile(variables, max_bucket=128)
+    ref = predictor.sample(c, seed=1)
+    for block_size in (7, 128, 1000):
+        blocks = list(predictor.sample_blocks(c, block_size=block_size, seed=1))
+        assert all(isinstance(b, np.ndarray) for b in blocks)
+        assert len(blocks) == -(-len(c) // block_size)
+        assert_allclose(np.concatenate(blocks), ref, rtol=1e-5, atol=1e-5)
+
+    np.save(tmp_path / "c.npy", c)
+    c_mmap = np.load(tmp_path / "c.npy", mmap_mode="r")
+    out = predictor.sample_to_file(tmp_path / "x.npy", c_mmap, block_size=50, seed=1)
+    assert isinstance(out, np.memmap)
+    assert out.shape == (300, 2)
+    assert_allclose(out, ref, rtol=1e-5, atol=1e-5)
+
+    flow2 = Flow(rolling_spline_coupling(2, layers=(8,)))
+    variables2 = flow2.init(jax.random.PRNGKey(0), x)
+    predictor2 = flow2.compile(variables2)
+    blocks = list(predictor2.sample_blocks(10, block_size=4, seed=1))
+    assert [len(b) for b in blocks] == [4, 4, 2]
+    assert_allclose(np.concatenate(blocks), predictor2.sample(10, seed=1), atol=1e-6)
+    assert list(predictor2.sample_blocks(0)) == []
+
+    with pytest.raises(ValueError):
+        next(predictor2.sample_blocks(10, block_size=0))
+    with pytest.raises(ValueError):
+        predictor2.sample(2**32)
@@ -0,0 +1,154 @@
+from zenflow import Flow
+from zenflow.bijectors import rolling_spline_coupling
+from zenflow.server import InferenceServer, serve_http, _derived_seed, _handle
+from concurrent.futures import ThreadPoolExecutor
+import json
+import time
+import urllib.request
+import urllib.error
+import jax
+import numpy as np
+from numpy.testing import assert_allclose
+import pytest
+
+
+@pytest.fixture(scope="module")
+def predictor():
+    rng = np.random.default_rng(1)
+    x = rng.normal(size=(300, 2)).astype(np.float32)
+    c = rng.normal(size=300).astype(np.float32)
+    flow = Flow(rolling_spline_coupling(2, layers=(8,)))
+    variables = flow.init(jax.random.PRNGKey(0), x, c)
+    _, updates = flow.apply(variables, x, c, train=True, mutable=["batch_stats"])
+    variables = {"params": variables["params"], **updates}
+    return flow.compile(variables, min_bucket=16, max_bucket=256), x, c
+
+
+def test_InferenceServer_log_prob(predictor):
+    predictor, x, c = predictor
+    ref = predictor.log_prob(x, c)
+    chunks = [(a, a + n) for a, n in zip(range(0, 300, 10), [1, 3, 7, 10] * 8)]
+    with InferenceServer(predictor, max_batch_size=64, max_delay=0.05) as server:
+        with ThreadPoolExecutor(8) as pool:
+            results = list(
+                pool.map(
+                    lambda ab: server.log_prob(x[slice(*ab)], c[slice(*ab)]), chunks
+                )
+            )
+        for (a, b), lp in zip(chunks, results):
+            assert isinstance(lp, np.ndarray)
+            assert_allclose(lp, ref[a:b], rtol=1e-5, atol=1e-5)
+        # requests were coalesced
+        assert server.batches < len(chunks)
+
+        # a failing request does not affect the server
+        with pytest.raises(Exception):
+            server.log_prob(x[:2, :1], c[:2])
+        assert_allclose(server.log_prob(x[:5], c[:5]), ref[:5], rtol=1e-5, atol=1e-5)
+
+    with pytest.raises(RuntimeError):
+        server.log_prob(x, c)
+
+
+def test_InferenceServer_sample(predictor):
+    predictor, x, c = predictor
+    with InferenceServer(predictor, seed=1) as server:
+        a = server.sample(c[:10])
+        b = server.sample(c[:10])
+    assert a.shape == (10, 2)
+    assert np.all(a != b)
+    ref = predictor.sample(np.concatenate([c[:10], c[:10]]), seed=1)
+    assert_allclose(np.concatenate([a, b]), ref, rtol=1e-5, atol=1e-5)
+
+
+def test_InferenceServer_bad_request(predictor):
+    predictor, x, c = predictor
+    ref = predictor.sample(c[:3], seed=1)
+    with InferenceServer(predictor, seed=1) as server:
+        with pytest.raises(ValueError):
+            server.sample(5.0)
+        with pytest.raises(ValueError):
+            server.log_prob(x[0], c[0])
+        # the flow is conditional, so sampling without conditions fails in the worker
+        with pytest.raises(Exception):
+            server.sample(np.int64(10))
+        assert_allclose(server.sample(c[:3]), ref, rtol=1e-5, atol=1e-5)
+
+
+def test_InferenceServer_seed_rollover(predictor):
+    predictor, x, c = predictor
+    with InferenceServer(predictor, seed=1) as server:
+        # offsets of the seed are nearly exhausted
+        server._samples_drawn = 2**32 - 2
+        a = server.sample(c[:3])
+        b = server.sample(c[:3])
+    seed = _derived_seed(1, 1)
+    assert seed != 1
+    assert_allclose(a, predictor.sample(c[:3], seed=seed), rtol=1e-5, atol=1e-5)
+    assert_allclose(
+        b, predictor.sample(c[:3], seed=seed, offset=3), rtol=1e-5, atol=1e-5
+    )
+
+
+def test_InferenceServer_close_while_submitting(predictor):
+    predictor, x, c = predictor
+    server = InferenceServer(predictor)
+    futures = []
+
+    def submit():
+        for i in range(50):
+            try:
+                futures.append(server.submit_log_prob(x[i : i + 1], c[i : i + 1]))
+            except RuntimeError:
+                break
+
+    with ThreadPoolExecutor(4) as pool:
+        for _ in range(4):
+            pool.submit(submit)
+        while not futures:
+            time.sleep(0.001)
+        server.close()
+    # requests which were accepted before the server was closed are finished
+    assert all(future.done() for future in futures)
+
+
+def test_handle_non_finite():
+    class Server:
+        def log_prob(self, x, c=None):
+            return np.array([-np.inf, 0.5, np.nan])
+
+    result = _handle(Server(), "/log_prob", {"x": [[0, 0]] * 3})
+    data = json.dumps(result, allow_nan=False)
+    assert json.loads(data) == {"log_prob": [None, 0.5, None]}
+
+
+def test_serve_http(predictor):
+    predictor, x, c = predictor
+
+    def post(path, body):
+        request = urllib.request.Request(
+            url + path,
+            data=json.dumps(body).encode(),
+            headers={"Content-Type": "application/json"},
+        )
+        with urllib.request.urlopen(request) as response:
+            return json.loads(response.read())
+
+    with InferenceServer(predictor) as server:
+        httpd = serve_http(server)
+        try:
+            url = "http://%s:%d" % httpd.server_address
+            result = post("/log_prob", {"x": x[:5].tolist(), "c": c[:5].tolist()})
+            assert_allclose(
+                result["log_prob"], predictor.log_prob(x[:5], c[:5]), rtol=1e-5
+            )
+            result = post("/sample", {"conditions": c[:3].tolist()})
+            assert np.shape(result["x"]) == (3, 2)
+            with pytest.raises(urllib.error.HTTPError):
+                post("/foo", {})
+            with pytest.raises(urllib.error.HTTPError):
+                post("/sample", {"conditions": 5})
+            result = post("/sample", {"conditions": c[:3].tolist()})
+            assert np.shape(result["x"]) == (3, 2)
+        finally:
+            httpd.shutdown()
@@ -0,0 +1,98 @@
+from zenflow import Flow
+from zenflow.bijectors import ShiftBounds, rolling_spline_coupling
+from zenflow.distributions import Beta
+from zenflow.table import ConditionalDensityTable, DensityTable, _tabulate
+import jax
+import numpy as np
+from numpy.testing import assert_allclose
+import pytest
+
+
+def _trained(flow, x, c=None):
+    variables = flow.init(jax.random.PRNGKey(0), x, c)
+    _, updates = flow.apply(variables, x, c, train=True, mutable=["batch_stats"])
+    return {**variables, **updates}
+
+
+def test_DensityTable_1d():
+    x = np.random.default_rng(1).normal(size=(100, 1)).astype(np.float32)
+    flow = Flow(ShiftBounds(), Beta())
+    variables = _trained(flow, x)
+    table = DensityTable.from_flow(flow, variables, tol=1e-4)
+    assert table.dim == 1
+    assert table.error_estimate <= 1e-4
+    lower, upper = table.nodes[0][[0, -1]]
+
+    xs = np.linspace(lower - 1, upper + 1, 1000)
+    ref = np.exp(flow.apply(variables, xs[:, None].astype(np.float32)))
+    assert_allclose(table.prob(xs), ref, atol=2e-4 * ref.max())
+    assert table.prob([lower - 1])[0] == 0
+    assert table.log_prob([lower - 1])[0] == -np.inf
+
+    cdf = table.cdf(xs)
+    assert cdf[0] == 0 and cdf[-1] == 1
+    assert np.all(np.diff(cdf) >= 0)
+    # symmetric beta distribution
+    assert_allclose(table.cdf([0.5 * (lower + upper)]), 0.5, atol=1e-4)
+
+    with pytest.raises(ValueError):
+        table.prob(np.zeros((3, 2)))
+
+
+def test_DensityTable_2d():
+    rng = np.random.default_rng(1)
+    x = rng.normal(size=(200, 2)).astype(np.float32)
+    flow = Flow(rolling_spline_coupling(2, layers=(8,)), Beta())
+    variables = _trained(flow, x)
+    table = DensityTable.from_flow(flow, variables, size=9, tol=1e-2)
+    assert table.error_estimate <= 1e-2
+    assert all(len(n) > 9 for n in table.nodes)
+
+    xs = rng.normal(size=(1000, 2))
+    ref = np.exp(flow.apply(variables, xs.astype(np.float32)))
+    assert_allclose(table.prob(xs), ref, atol=2e-2 * ref.max())
+    with pytest.raises(ValueError):
+        table.cdf(xs)
+
+    lower, upper = [n[0] for n in table.nodes], [n[-1] for n in table.nodes]
+    xs = rng.uniform(lower, upper, size=(10000, 2))
+    ref = np.exp(flow.apply(variables, xs.astype(np.float32)))
+    deviation = np.abs(table.prob(xs) - ref) / table.density.max()
+    assert np.max(deviation) <= table.error_estimate
+
+    small = DensityTable.from_flow(flow, variables, size=9, tol=1e-6, max_points=200)
+    assert small.error_estimate > 1e-6
+    assert np.prod([len(n) for n in small.nodes]) <= 200
+
+
+def test_ConditionalDensityTable():
+    rng = np.random.default_rng(1)
+    x = rng.normal(size=(200, 2)).astype(np.float32)
+    c = rng.normal(size=200).astype(np.float32)
+    flow = Flow(rolling_spline_coupling(2, layers=(8,)), Beta())
+    variables = _trained(flow, x, c)
+    tables = ConditionalDensityTable(flow, variables, maxsize=2, size=9, tol=1e-2)
+
+    xs = rng.normal(size=(30, 2))
+    cs = np.repeat([0.0, 1.0, 2.0], 10)
+    p = tables.prob(xs, cs[:, None])
+    assert len(tables._cache) == 2
+    for ci in (0.0, 1.0, 2.0):
+        mask = cs == ci
+        assert_allclose(p[mask], tables.table(ci).prob(xs[mask]))
+        ref = np.exp(flow.apply(variables, xs[mask].astype(np.float32), cs[mask]))
+        assert_allclose(p[mask], ref, atol=2e-2 * ref.max())
+    table = tables.table(2.0)
+    assert tables.table(np.array([2.0])) is table
+    assert_allclose(tables.log_prob(xs, 2.0), table.log_prob(xs))
+
+
+def test_DensityTable_random_points():
+    # a narrow peak between the nodes and midpoints of the initial grid, where the
+    # density is otherwise constant, is only found at random points
+    def log_prob(x, c):
+        return np.log1p(np.exp(-0.5 * ((x[:, 0] - 0.375) / 0.01) ** 2))
+
+    table = _tabulate(log_prob, None, np.zeros(1), np.ones(1), size=3, tol=1e-2)
+    assert table.error_estimate <= 1e-2
+    assert_allclose(table.prob([0.375]), 2, rtol=1e-2)
@@ -0,0 +1,105 @@
+from zenflow import Flow, train
+from zenflow.bijectors import rolling_spline_coupling
+from zenflow.data import ArraySource
+from zenflow.telemetry import Callback, JsonLinesLogger, memory_usage
+import json
+import numpy as np
+from numpy.testing import assert_equal
+import pytest
+
+
+@pytest.mark.parametrize("fused_epoch", [False, True])
+def test_JsonLinesLogger(tmp_path, fused_epoch):
+    rng = np.random.default_rng(1)
+    x = rng.normal(size=(100, 2))
+    flow = Flow(rolling_spline_coupling(2, layers=(8,)))
+    kwargs = dict(
+        epochs=3, batch_size=32, patience=3, progress=False, fused_epoch=fused_epoch
+    )
+    path = tmp_path / "log.jsonl"
+    with JsonLinesLogger(str(path)) as logger:
+        _, best_epoch, loss_train, loss_test = train(
+            flow, x, x, callbacks=[logger], **kwargs
+        )
+    events = [json.loads(line) for line in open(path)]
+
+    compiled = {e["name"] for e in events if e["event"] == "compile"}
+    step = "epoch_step" if fused_epoch else "step"
+    assert compiled == {step, "metric", "test_metric"}
+    assert {e["name"] for e in events if e["event"] == "transfer"} == {
+        "X_train",
+        "X_test",
+    }
+
+    epochs = [e for e in events if e["event"] == "epoch"]
+    assert_equal([e["epoch"] for e in epochs], [0, 1, 2])
+    assert_equal([e["loss_train"] for e in epochs], loss_train)
+    assert_equal([e["loss_test"] for e in epochs], loss_test)
+    for e in epochs:
+        assert e["samples"] == 100
+        assert e["seconds"] > 0
+        assert e["samples_per_second"] == pytest.approx(100 / e["seconds"])
+        assert e["transfer_seconds"] == 0
+        assert "device_peak_bytes" in e
+        assert e["host_peak_bytes"] is None or e["host_peak_bytes"] > 0
+
+    assert events[-1]["event"] == "end"
+    assert events[-1]["epochs"] == 3
+    assert events[-1]["best_epoch"] == best_epoch
+    # epochs exclude the compile times, which are reported separately
+    compile_seconds = sum(e["seconds"] for e in events if e["event"] == "compile")
+    epoch_seconds = sum(e["seconds"] for e in epochs)
+    assert compile_seconds + epoch_seconds <= events[-1]["seconds"]
+
+    # results do not depend on the telemetry
+    ref = train(flow, x, x, **kwargs)
+    assert_equal(ref[2], loss_train)
+    assert_equal(ref[3], loss_test)
+
+
+def test_JsonLinesLogger_non_finite(tmp_path):
+    path = tmp_path / "log.jsonl"
+    with JsonLinesLogger(str(path)) as logger:
+        logger({"event": "epoch", "loss_train": float("inf"), "loss_test": np.nan})
+
+    def reject(constant):
+        raise ValueError(f"invalid JSON constant {constant}")
+
+    (event,) = [json.loads(line, parse_constant=reject) for line in open(path)]
+    assert event == {"event": "epoch", "loss_train": None, "loss_test": None}
+
+
+def test_Callback_with_source():
+    class Recorder(Callback):
+        def __init__(self):
+            self.epochs = []
+
+        def on_epoch(self, event):
+            self.epochs.append(event)
+
+    rng = np.random.default_rng(1)
+    x = rng.normal(size=(100, 2))
+    source = ArraySource(x, chunk_size=40)
+    flow = Flow(rolling_spline_coupling(2, layers=(8,)))
+    recorder = Recorder()
+    events = []
+    train(
+        flow,
+        source,
+        x,
+        epochs=2,
+        batch_size=32,
+        patience=2,
+        progress=False,
+        callbacks=[recorder, events.append],
+    )
+    assert len(recorder.epochs) == 2
+    for e in recorder.epochs:
+        assert e["samples"] == 100
+        assert e["transfer_seconds"] > 0
+    assert len(events) == len([e for e in events if e["event"] != "epoch"]) + 2
+
+
+def test_memory_usage():
+    m = memory_usage()
+    assert set(m) == {"device_peak_bytes", "host_peak_bytes"}
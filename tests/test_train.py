@@ -1,6 +1,14 @@
+import os
+import subprocess
+import sys
 import numpy as np
-from zenflow import Flow, train
-from zenflow.bijectors import rolling_spline_coupling
+import jax
+import jax.numpy as jnp
+import optax
+from numpy.testing import assert_allclose, assert_equal
+from zenflow import Flow, train, train_ensemble
+from zenflow.train import DEFAULT_OPTIMIZER
+from zenflow.bijectors import rolling_spline_coupling, migrate_variables
 import pytest
 
 
@@ -13,3 +21,311 @@ def test_bad_input_distribution():
     # this should not raise RuntimeWarning
     loss_train = train(flow, X, X)[1]
     assert np.all(np.isfinite(loss_train))
+
+
+def test_fused_epoch():
+    rng = np.random.default_rng(1)
+    X = rng.normal(size=(100, 2))
+    flow = Flow(rolling_spline_coupling(2, layers=(8,)))
+    kwargs = dict(epochs=3, batch_size=32, patience=3, progress=False)
+    ref = train(flow, X, X, **kwargs)
+    res = train(flow, X, X, fused_epoch=True, **kwargs)
+    assert res[1] == ref[1]
+    assert_allclose(res[2], ref[2], rtol=1e-5)
+    assert_allclose(res[3], ref[3], rtol=1e-5)
+
+
+def test_custom_bijector_without_mask():
+    from zenflow.bijectors import Bijector, Chain, ShiftBounds, NeuralSplineCoupling
+
+    class Scale(Bijector):
+        def __call__(self, x, c=None, train=False):
+            return x * 2, jnp.full(x.shape[0], x.shape[1] * jnp.log(2))
+
+        def inverse(self, x, c=None):
+            return x / 2
+
+    rng = np.random.default_rng(1)
+    X = rng.normal(size=(100, 2))
+    flow = Flow(Chain([Scale(), ShiftBounds(), NeuralSplineCoupling(layers=(8,))]))
+    kwargs = dict(epochs=2, batch_size=32, patience=2, progress=False)
+    for fused_epoch in (False, True):
+        loss_train = train(flow, X, X, fused_epoch=fused_epoch, **kwargs)[2]
+        assert np.all(np.isfinite(loss_train))
+
+
+def test_context_dropout():
+    import flax.linen as nn
+
+    class Encoder(nn.Module):
+        @nn.compact
+        def __call__(self, c, train: bool = False):
+            c = nn.Dense(4)(c)
+            return nn.Dropout(rate=0.3, deterministic=not train)(c)
+
+    rng = np.random.default_rng(1)
+    X = rng.normal(size=(100, 2))
+    C = rng.normal(size=(100, 3))
+    flow = Flow(rolling_spline_coupling(2, layers=(8,)), context=Encoder())
+    kwargs = dict(epochs=2, batch_size=32, patience=2, progress=False)
+    ref = train(flow, X, X, C, C, **kwargs)
+    assert np.all(np.isfinite(ref[2]))
+    res = train(flow, X, X, C, C, fused_epoch=True, **kwargs)
+    assert_allclose(res[2], ref[2], rtol=1e-5)
+    res = train_ensemble(flow, X, X, C, C, seeds=(0,), **kwargs)
+    assert_allclose(res[2][0], ref[2], rtol=1e-5)
+
+
+@pytest.mark.parametrize("fused_epoch", (False, True))
+def test_legacy_variables(fused_epoch):
+    rng = np.random.default_rng(1)
+    X = rng.uniform(size=(100, 3))
+    bounds = [(0, None, 2.0), (2, 0.0, 1.0)]
+    flow = Flow(rolling_spline_coupling(3, layers=(8,), bounds=bounds))
+    kwargs = dict(epochs=2, batch_size=32, patience=2, progress=False)
+    variables = train(flow, X, X, **kwargs)[0]
+
+    # older versions stored one pair of variables per column of ShiftBounds, except
+    # for fully bounded columns, here the last one
+    stats = variables["batch_stats"]["bijector"]["bijectors_0"]
+    legacy = {}
+    for i in (0, 1):
+        legacy[f"xmin_{i}"] = stats["xmin"][i : i + 1]
+        legacy[f"xmax_{i}"] = stats["xmax"][i : i + 1]
+    batch_stats = {**variables["batch_stats"]["bijector"], "bijectors_0": legacy}
+    legacy_variables = {
+        "params": variables["params"],
+        "batch_stats": {"bijector": batch_stats},
+    }
+
+    migrated = migrate_variables(legacy_variables, variables)
+    assert jax.tree_util.tree_structure(migrated) == jax.tree_util.tree_structure(
+        variables
+    )
+    assert_allclose(
+        migrated["batch_stats"]["bijector"]["bijectors_0"]["xmin"][:2],
+        stats["xmin"][:2],
+    )
+    assert migrated["batch_stats"]["bijector"]["bijectors_0"]["xmin"][2] == np.inf
+
+    res = train(
+        flow,
+        X,
+        X,
+        initial_variables=legacy_variables,
+        fused_epoch=fused_epoch,
+        **kwargs,
+    )
+    assert set(res[0]["batch_stats"]["bijector"]["bijectors_0"]) == {"xmin", "xmax"}
+    assert np.all(np.isfinite(res[2]))
+
+
+def test_data_parallel():
+    # the number of host devices must be set before jax is initialized
+    code = """
+import numpy as np
+import jax
+from numpy.testing import assert_allclose
+from zenflow import Flow, train
+from zenflow.bijectors import rolling_spline_coupling
+
+assert len(jax.devices()) == 4
+rng = np.random.default_rng(1)
+X = rng.normal(size=(100, 2))
+C = rng.normal(size=100)
+flow = Flow(rolling_spline_coupling(2, layers=(8,)))
+kwargs = dict(epochs=2, batch_size=32, patience=2, progress=False)
+ref = train(flow, X, X, C, C, **kwargs)
+res = train(flow, X, X, C, C, devices=jax.devices(), **kwargs)
+assert_allclose(res[2], ref[2], rtol=1e-4)
+assert_allclose(res[3], ref[3], rtol=1e-4)
+for a, b in zip(jax.tree_util.tree_leaves(res[0]), jax.tree_util.tree_leaves(ref[0])):
+    assert_allclose(a, b, rtol=1e-3, atol=1e-5)
+
+ref = train(flow, X, X, C, C, accumulate_steps=2, **kwargs)
+res = train(flow, X, X, C, C, accumulate_steps=2, devices=jax.devices(), **kwargs)
+assert_allclose(res[2], ref[2], rtol=1e-4)
+assert_allclose(res[3], ref[3], rtol=1e-4)
+"""
+    env = dict(os.environ)
+    env["XLA_FLAGS"] = "--xla_force_host_platform_device_count=4"
+    subprocess.run([sys.executable, "-c", code], env=env, check=True)
+
+
+def test_data_parallel_bad_batch_size():
+    import jax
+
+    flow = Flow(rolling_spline_coupling(2))
+    X = np.zeros((10, 2))
+    with pytest.raises(ValueError):
+        train(flow, X, X, batch_size=3, devices=[jax.devices()[0]] * 2)
+
+
+def test_eval_batch_size():
+    rng = np.random.default_rng(1)
+    X = rng.normal(size=(100, 2))
+    C = rng.normal(size=100)
+    flow = Flow(rolling_spline_coupling(2, layers=(8,)))
+    kwargs = dict(epochs=2, batch_size=32, patience=2, progress=False)
+    ref = train(flow, X, X, C, C, **kwargs)
+    res = train(flow, X, X, C, C, eval_batch_size=7, **kwargs)
+    assert_allclose(res[3], ref[3], rtol=1e-5)
+    variables = ref[0]
+    lp = flow.apply(variables, X, C)
+    assert_allclose(ref[3][ref[1]], -np.mean(lp), rtol=1e-5)
+
+
+def test_abort_on_non_finite_loss():
+    rng = np.random.default_rng(1)
+    X = rng.normal(size=(100, 2))
+    flow = Flow(rolling_spline_coupling(2, layers=(8,)))
+    with pytest.warns(RuntimeWarning, match="epoch 0"):
+        variables, best_epoch, loss_train, loss_test = train(
+            flow,
+            X,
+            X,
+            epochs=5,
+            patience=5,
+            optimizer=optax.sgd(1e30),
+            progress=False,
+        )
+    assert best_epoch == 0
+    assert len(loss_train) == 1
+    assert len(loss_test) == 1
+
+
+def test_train_ensemble():
+    rng = np.random.default_rng(1)
+    X = rng.normal(size=(100, 2))
+    flow = Flow(rolling_spline_coupling(2, layers=(8,)))
+    kwargs = dict(epochs=3, batch_size=32, patience=3, progress=False)
+    variables, best_epoch, loss_train, loss_test = train_ensemble(
+        flow, X, X, seeds=(0, 1), learning_rates=(1e-3, 1e-2), **kwargs
+    )
+    assert len(variables) == 2
+    ref = train(
+        flow, X, X, seed=1, optimizer=DEFAULT_OPTIMIZER(learning_rate=1e-2), **kwargs
+    )
+    assert best_epoch[1] == ref[1]
+    assert_allclose(loss_train[1], ref[2], rtol=1e-5)
+    assert_allclose(loss_test[1], ref[3], rtol=1e-5)
+
+    with pytest.raises(ValueError):
+        train_ensemble(flow, X, X, seeds=(1, 2), learning_rates=(1, 2, 3))
+
+
+def test_compute_dtype():
+    rng = np.random.default_rng(1)
+    X = rng.normal(size=(1000, 2)).astype(np.float32)
+    flow = Flow(rolling_spline_coupling(2, layers=(16,)))
+    kwargs = dict(epochs=5, batch_size=100, patience=5, progress=False)
+    variables, _, _, loss_test = train(flow, X, X, **kwargs)
+    variables16, _, _, loss_test16 = train(
+        flow, X, X, compute_dtype=jnp.bfloat16, **kwargs
+    )
+    for a, b in zip(
+        jax.tree_util.tree_leaves(variables), jax.tree_util.tree_leaves(variables16)
+    ):
+        assert a.dtype == b.dtype
+    assert_allclose(loss_test16, loss_test, rtol=0.05)
+    lp = flow.apply(variables16, X)
+    lp16 = flow.clone(dtype=jnp.bfloat16).apply(variables16, X)
+    assert_allclose(lp16, lp, atol=0.1)
+
+
+def test_accumulate_steps_update():
+    from zenflow.train import _update
+
+    rng = np.random.default_rng(1)
+    x = rng.normal(size=(32, 2)).astype(np.float32)
+    flow = Flow(rolling_spline_coupling(2, layers=(8,)))
+    variables = flow.init(jax.random.PRNGKey(0), x)
+    params, batch_stats = variables["params"], variables["batch_stats"]
+    opt = optax.sgd(1e-2)
+    opt_state = opt.init(params)
+
+    # micro-batches are copies of x, so their statistics equal those of the batch;
+    # last micro-batch contains only padding and must be ignored
+    xx = np.concatenate([x, x, x])
+    mask = np.arange(len(xx)) < 2 * len(x)
+    ref = _update(flow, opt, params, batch_stats, opt_state, xx, None, mask)
+    res = _update(
+        flow, opt, params, batch_stats, opt_state, xx, None, mask, accumulate_steps=3
+    )
+    for a, b in zip(
+        jax.tree_util.tree_leaves(ref[0]), jax.tree_util.tree_leaves(res[0])
+    ):
+        assert_allclose(a, b, rtol=1e-4, atol=1e-6)
+    for b in jax.tree_util.tree_leaves(res[1]):
+        assert np.all(np.isfinite(b))
+
+
+def test_accumulate_steps():
+    rng = np.random.default_rng(1)
+    X = rng.normal(size=(100, 2)).astype(np.float32)
+    flow = Flow(rolling_spline_coupling(2, layers=(8,)))
+    kwargs = dict(epochs=3, batch_size=64, patience=3, progress=False)
+    for fused_epoch in (False, True):
+        _, _, loss_train, loss_test = train(
+            flow, X, X, accumulate_steps=4, fused_epoch=fused_epoch, **kwargs
+        )
+        assert len(loss_test) == 3
+        assert np.all(np.isfinite(loss_train))
+        assert np.all(np.isfinite(loss_test))
+
+    with pytest.raises(ValueError):
+        train(flow, X, X, accumulate_steps=3, **kwargs)
+
+
+def test_eval_every():
+    rng = np.random.default_rng(1)
+    X = rng.normal(size=(100, 2))
+    flow = Flow(rolling_spline_coupling(2, layers=(8,)))
+    kwargs = dict(epochs=7, batch_size=32, patience=7, progress=False)
+    ref = train(flow, X, X, **kwargs)
+    variables, best_epoch, loss_train, loss_test = train(
+        flow, X, X, eval_every=3, **kwargs
+    )
+    evaluated = [0, 3, 6]
+    assert_allclose(loss_train, ref[2])
+    assert_allclose(np.array(loss_test)[evaluated], np.array(ref[3])[evaluated])
+    assert np.all(np.isnan(np.delete(loss_test, evaluated)))
+    assert best_epoch in evaluated
+    assert best_epoch == evaluated[np.argmin(np.array(ref[3])[evaluated])]
+
+    with pytest.raises(ValueError):
+        train(flow, X, X, eval_every=8, **kwargs)
+
+
+def test_eval_adaptive():
+    rng = np.random.default_rng(1)
+    X = rng.normal(size=(100, 2))
+    flow = Flow(rolling_spline_coupling(2, layers=(8,)))
+    # with sgd and a negative learning rate, the test loss increases
+    kwargs = dict(
+        epochs=8,
+        batch_size=32,
+        patience=8,
+        progress=False,
+        optimizer=optax.sgd(-1e-1),
+        eval_every=4,
+    )
+    _, _, _, loss_test = train(flow, X, X, **kwargs)
+    assert np.sum(np.isfinite(loss_test)) == 3
+    _, best_epoch, _, loss_test = train(flow, X, X, eval_adaptive=True, **kwargs)
+    # evaluated in every epoch after the first evaluation which did not improve
+    assert_equal(np.flatnonzero(np.isfinite(loss_test)), [0, 4, 5, 6, 7])
+    assert best_epoch == 0
+
+
+def test_eval_size():
+    rng = np.random.default_rng(1)
+    X = rng.normal(size=(1000, 2))
+    X_test = X
+    flow = Flow(rolling_spline_coupling(2, layers=(8,)))
+    kwargs = dict(epochs=2, batch_size=256, patience=2, progress=False)
+    _, _, _, loss_test = train(flow, X, X_test, **kwargs)
+    _, _, _, loss_test_sub = train(flow, X, X_test, eval_size=100, **kwargs)
+    assert np.all(np.isfinite(loss_test_sub))
+    assert np.all(np.array(loss_test_sub) != np.array(loss_test))
+    assert_allclose(loss_test_sub, loss_test, rtol=0.2)
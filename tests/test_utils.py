@@ -49,6 +49,10 @@ def test_rational_quadratic_spline_2():
     x2 = utils.rational_quadratic_spline_inverse(y, dx, dy, slope)
     assert_allclose(x2, x, atol=1e-4)
 
+    x3, log_det3 = utils.rational_quadratic_spline_inverse_and_log_det(y, dx, dy, slope)
+    assert_allclose(x3, x2)
+    assert_allclose(log_det3, log_det, atol=1e-4)
+
 
 def test_index():
     x = np.array([-2, -1, -0.5, -0.1, 0.0, 0.1, 0.5, 1.0, 1.5]).reshape(1, -1)